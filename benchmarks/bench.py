@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+"""
+This file is part of The Thresher.
+
+Time and memory benchmarks for the hot paths of `thresh` and TLI on
+synthetic data. Each case runs in its own process so that the peak memory
+can be measured. The results are written as JSON and can be compared to a
+stored baseline.
+
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import resource
+import platform
+import multiprocessing
+
+import numpy as np
+import pyfits
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                "..")))
+import thresher
+from thresher import utils
+from thresher.diagnostics import estimate_noise
+from thresher.make_fake import render_gaussian
+
+
+def _synthetic_frame(size, seed=0, nsources=5):
+    rng = np.random.RandomState(seed)
+    positions = rng.uniform(0.2, 0.8, size=(nsources, 2)) * size
+    fluxes = 100 * rng.uniform(1, 10, size=nsources)
+    img = render_gaussian((size, size), positions, fluxes, 1.8)
+    return img + 10 + rng.randn(size, size)
+
+
+def _scene(size, psf_hw, image_list=[]):
+    initial = _synthetic_frame(size + 2 * psf_hw, seed=1)
+    scene = thresher.Scene(initial, image_list, psf_hw=psf_hw)
+    scene.psf = np.zeros((2 * psf_hw + 1, 2 * psf_hw + 1))
+    scene.psf[psf_hw, psf_hw] = 1.0
+    return scene
+
+
+def _write_frames(tmpdir, size, n):
+    fns = []
+    for i in range(n):
+        fns.append(os.path.join(tmpdir, "{0:05d}.fits".format(i)))
+        pyfits.PrimaryHDU(_synthetic_frame(size, seed=i)).writeto(fns[-1])
+    return fns
+
+
+#
+# The benchmark cases. Each one takes the scene size, the PSF half width
+# and a temporary directory and returns a function to time.
+#
+# The index arrays are cached so time the functions without the cache.
+def bench_unravel_scene(size, psf_hw, tmpdir):
+    return lambda: utils.unravel_scene.__wrapped__(size + 2 * psf_hw, psf_hw)
+
+
+def bench_unravel_psf(size, psf_hw, tmpdir):
+    return lambda: utils.unravel_psf.__wrapped__(size + 2 * psf_hw, psf_hw)
+
+
+def bench_infer_psf(size, psf_hw, tmpdir):
+    scene = _scene(size, psf_hw)
+    data = _synthetic_frame(size)
+    mask = np.ones_like(data)
+    return lambda: scene.infer_psf(data, mask)
+
+
+def bench_get_dlds(size, psf_hw, tmpdir):
+    scene = _scene(size, psf_hw)
+    data = _synthetic_frame(size)
+    mask = np.ones_like(data)
+    return lambda: scene.get_dlds(data, mask)
+
+
+def bench_get_psf_matrix(size, psf_hw, tmpdir):
+    scene = _scene(size, psf_hw)
+    return lambda: scene.get_psf_matrix(L2=False)
+
+
+def bench_do_update(size, psf_hw, tmpdir):
+    fn = _write_frames(tmpdir, size, 1)[0]
+    scene = _scene(size, psf_hw, [fn])
+    return lambda: scene.do_update(fn, 0.1)
+
+
+def bench_run_tli(size, psf_hw, tmpdir):
+    fns = _write_frames(tmpdir, size, 20)
+    return lambda: thresher.run_tli(fns, top=5)
+
+
+def bench_centroid_image(size, psf_hw, tmpdir):
+    img = _synthetic_frame(2 * size)
+    scene = _synthetic_frame(size)
+    return lambda: utils.centroid_image(img, size, scene=scene)
+
+
+def bench_estimate_noise(size, psf_hw, tmpdir):
+    img = _synthetic_frame(size)
+    return lambda: estimate_noise(img, 1.8, N=1000, padding=0)
+
+
+BENCHMARKS = [(k[len("bench_"):], v) for k, v in sorted(globals().items())
+              if k.startswith("bench_")]
+
+
+def _run_case(name, size, psf_hw, repeat, conn):
+    # Silence the `print` statements in the inference code.
+    sys.stdout = open(os.devnull, "w")
+    tmpdir = tempfile.mkdtemp()
+    try:
+        rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        f = dict(BENCHMARKS)[name](size, psf_hw, tmpdir)
+        times = []
+        for i in range(repeat):
+            t = time.time()
+            f()
+            times.append(time.time() - t)
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        conn.send(dict(name=name, size=size, psf_hw=psf_hw,
+                       time=float(np.median(times)), time_min=min(times),
+                       repeat=repeat, peak_rss_kb=rss,
+                       delta_rss_kb=rss - rss0))
+    except Exception as e:
+        conn.send(dict(name=name, size=size, psf_hw=psf_hw, error=repr(e)))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _wait_for_case(conn, p, timeout=None):
+    """
+    Wait for the result of a case. If the process dies without sending a
+    result (e.g. it was killed for running out of memory) or it takes
+    longer than `timeout` seconds, the failure is reported as an error.
+
+    """
+    t0 = time.time()
+    while True:
+        if conn.poll(1.0):
+            return conn.recv()
+        if not p.is_alive():
+            # The result might have arrived just before the process exited.
+            if conn.poll():
+                return conn.recv()
+            return dict(error="The process died with exit code {0}."
+                        .format(p.exitcode))
+        if timeout is not None and time.time() - t0 > timeout:
+            p.terminate()
+            return dict(error="Timed out after {0} s.".format(timeout))
+
+
+def run_benchmarks(names=None, sizes=[32, 64], psf_hws=[5, 13], repeat=3,
+        timeout=None):
+    """
+    Run the benchmarks over a grid of scene sizes and PSF half widths.
+
+    ## Keyword Arguments
+
+    * `names` (list): The benchmarks to run. Defaults to all of them.
+    * `sizes` (list): The sizes of the data/scene.
+    * `psf_hws` (list): The half widths of the PSF.
+    * `repeat` (int): The number of times to run each case.
+    * `timeout` (float): Give up on a case after this many seconds.
+
+    ## Returns
+
+    * `results` (list): A `dict` for each case.
+
+    """
+    if names is None:
+        names = [n for n, f in BENCHMARKS]
+    results = []
+    for name in names:
+        for size in sizes:
+            for psf_hw in psf_hws:
+                a, b = multiprocessing.Pipe()
+                p = multiprocessing.Process(target=_run_case,
+                        args=(name, size, psf_hw, repeat, b))
+                p.start()
+                r = dict(dict(name=name, size=size, psf_hw=psf_hw),
+                         **_wait_for_case(a, p, timeout=timeout))
+                p.join()
+                results.append(r)
+                if "error" in r:
+                    print("{name:>16s} {size:4d} {psf_hw:3d}  ERROR: {error}"
+                          .format(**r))
+                else:
+                    print("{name:>16s} {size:4d} {psf_hw:3d}  {time:10.5f} s"
+                          "  {delta_rss_kb:8d} kB".format(**r))
+    return results
+
+
+def compare(results, baseline, threshold=0.2):
+    """
+    Compare a set of results to a baseline.
+
+    ## Arguments
+
+    * `results` (list): The current results.
+    * `baseline` (list): The baseline results.
+
+    ## Keyword Arguments
+
+    * `threshold` (float): The fractional slow down that counts as a
+      regression.
+
+    ## Returns
+
+    * `regressions` (list): The cases that are slower than the baseline by
+      more than `threshold` as `(result, ratio)` tuples.
+
+    """
+    key = lambda r: (r["name"], r["size"], r["psf_hw"])
+    base = dict([(key(r), r) for r in baseline if "time" in r])
+    regressions = []
+    for r in results:
+        b = base.get(key(r))
+        if b is None or "time" not in r:
+            continue
+        ratio = r["time"] / b["time"]
+        flag = ""
+        if ratio > 1 + threshold:
+            regressions.append((r, ratio))
+            flag = "  REGRESSION"
+        print("{0:>16s} {1:4d} {2:3d}  {3:6.2f}x{4}".format(r["name"],
+              r["size"], r["psf_hw"], ratio, flag))
+    return regressions
+
+
+if __name__ == "__main__":
+    import argparse
+
+    desc = "Benchmark the hot paths of The Thresher."
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument("names", type=str, nargs="*",
+            help="The benchmarks to run: {0}"
+                .format(", ".join([n for n, f in BENCHMARKS])))
+    parser.add_argument("--sizes", type=int, nargs="+", default=[32, 64],
+            help="The data sizes.")
+    parser.add_argument("--psf_hw", type=int, nargs="+", default=[5, 13],
+            help="The PSF half widths.")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+            help="The number of repeats for each case.")
+    parser.add_argument("--timeout", type=float, default=None,
+            help="Give up on a case after this many seconds.")
+    parser.add_argument("-o", "--output", type=str, default=None,
+            help="Save the results to this JSON file.")
+    parser.add_argument("-b", "--baseline", type=str, default=None,
+            help="Compare to the results in this JSON file.")
+    parser.add_argument("-t", "--threshold", type=float, default=0.2,
+            help="The fractional slow down that counts as a regression.")
+    args = parser.parse_args()
+
+    results = run_benchmarks(names=args.names or None, sizes=args.sizes,
+            psf_hws=args.psf_hw, repeat=args.repeat, timeout=args.timeout)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(dict(platform=platform.platform(),
+                           python=platform.python_version(),
+                           numpy=np.__version__,
+                           date=time.strftime("%Y-%m-%dT%H:%M:%S"),
+                           results=results), f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        if len(compare(results, baseline, threshold=args.threshold)):
+            sys.exit(1)
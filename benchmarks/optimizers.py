@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""
+This file is part of The Thresher.
+
+Compare the scene optimizers on a synthetic run. For each optimizer, the
+inference is run for a few passes and the reduced chi-squared of every frame
+(computed before the frame is used to update the scene) is recorded. The
+figure of merit is the number of frames needed before the running mean of
+the chi-squared over one pass drops below a target value. The noise is
+known so the chi-squared of a perfect model is one.
+
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                "..")))
+import thresher
+from thresher import utils
+from thresher.make_fake import make_imaging_run
+
+
+# The optimizers and their learning rate schedules: `(alpha, beta)`. The
+# adaptive methods take steps in the units of the scene so they need much
+# smaller values of `alpha`.
+CONFIGS = [("sgd", 2.0, 1.0), ("saga", 1.0, 1.0), ("adagrad", 0.5, 1.0),
+           ("adam", 0.2, 1.0)]
+
+
+def _run(fns, initial, name, alpha, beta, npasses, psf_hw, outdir):
+    np.random.seed(0)
+    scene = thresher.Scene(initial, list(fns), outdir=outdir, psf_hw=psf_hw,
+                           optimizer=name)
+    t = time.time()
+    scene.run_inference(npasses=npasses, alpha=alpha, beta=beta,
+                        thin=len(fns), nn=True, median=False, metrics=None,
+                        status=None)
+    dt = time.time() - t
+    chi2 = np.array(scene.metrics.history["chi2"])
+    return chi2, dt
+
+
+def frames_to_target(chi2, window, target):
+    """
+    The number of frames before the running mean of `chi2` over `window`
+    frames drops below `target` (or `None` if it never does).
+
+    """
+    if len(chi2) < window:
+        return None
+    c = np.append(0.0, np.cumsum(chi2))
+    running = (c[window:] - c[:-window]) / window
+    inds = np.arange(len(running))[running < target]
+    if not len(inds):
+        return None
+    return int(inds[0] + window)
+
+
+def run_benchmark(nframes=40, size=64, npasses=4, psf_hw=6, target=1.01,
+        configs=CONFIGS, seed=0):
+    """
+    Run each optimizer on the same synthetic data.
+
+    ## Keyword Arguments
+
+    * `nframes` (int): The number of frames in the run.
+    * `size` (int): The size of the frames.
+    * `npasses` (int): The number of passes to run for each optimizer.
+    * `psf_hw` (int): The half width of the inferred PSF.
+    * `target` (float): The target reduced chi-squared.
+    * `configs` (list): The `(name, alpha, beta)` of each optimizer.
+    * `seed` (int): The random seed for the synthetic data.
+
+    ## Returns
+
+    * `results` (list): A `dict` for each optimizer.
+
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        prefix = os.path.join(tmpdir, "fake")
+        make_imaging_run(nframes, prefix, shape=(size, size), nsources=5,
+                         jitter=0.0, seed=seed)
+        fns = sorted([os.path.join(tmpdir, fn) for fn in os.listdir(tmpdir)
+                      if fn.startswith("fake_0")])
+
+        # Initialize with the mean of the first few frames.
+        initial = np.mean([utils.load_image(fn) for fn in fns[:3]], axis=0)
+
+        results = []
+        for name, alpha, beta in configs:
+            chi2, dt = _run(fns, initial, name, alpha, beta, npasses, psf_hw,
+                            tmpdir)
+            r = dict(optimizer=name, alpha=alpha, beta=beta, time=dt,
+                     frames=len(chi2),
+                     frames_to_target=frames_to_target(chi2, len(fns),
+                                                       target),
+                     final_chi2=float(np.mean(chi2[-len(fns):])))
+            results.append(r)
+    finally:
+        shutil.rmtree(tmpdir)
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    desc = "Compare the scene optimizers on synthetic data."
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument("-n", "--nframes", type=int, default=40,
+            help="The number of frames.")
+    parser.add_argument("--size", type=int, default=64,
+            help="The size of the frames.")
+    parser.add_argument("-p", "--npasses", type=int, default=4,
+            help="The number of passes for each optimizer.")
+    parser.add_argument("--psf_hw", type=int, default=6,
+            help="The half width of the PSF.")
+    parser.add_argument("--target", type=float, default=1.01,
+            help="The target reduced chi-squared.")
+    parser.add_argument("-o", "--output", type=str, default=None,
+            help="Save the results to this JSON file.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    # Silence the `print` statements in the inference code.
+    stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+    try:
+        results = run_benchmark(nframes=args.nframes, size=args.size,
+                npasses=args.npasses, psf_hw=args.psf_hw, target=args.target)
+    finally:
+        sys.stdout = stdout
+    for r in results:
+        print("{optimizer:>8s}  {frames_to_target!s:>6s} frames to target  "
+              "final chi2 {final_chi2:.4f}  {time:.2f} s".format(**r))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -15,7 +15,9 @@ setup(
     author_email="danfm@nyu.edu",
     url="http://davidwhogg.github.com/TheThresher",
     packages=["thresher"],
-    scripts=["bin/thresh", "bin/thresh-plot", "bin/lucky"],
+    scripts=["bin/thresh", "bin/thresh-plot", "bin/lucky",
+             "bin/thresh-movie", "bin/thresh-fake", "bin/thresh-sweep",
+             "bin/thresh-pipeline"],
     install_requires=required,
     license="GPLv2",
     description="we Don't Throw Away Data (tm).",
@@ -5,4 +5,11 @@ This file is part of The Thresher
 from thresher import *
 from tli import *
 from plotting import *
+from multires import *
+from multiscene import *
+from tiles import *
+from frames import *
+from sweep import *
+from live import *
 import utils
+import stats
@@ -1,13 +1,13 @@
 import os
 import numpy as np
 import scipy.optimize as op
+from scipy.ndimage import maximum_filter
+from scipy.signal import fftconvolve as convolve
+from scipy.sparse import csr_matrix
 import matplotlib.pyplot as pl
 
-
-X, Y = np.meshgrid(range(-1, 2), range(-1, 2))
-X, Y = X.flatten(), Y.flatten()
-A = np.vstack([np.ones(9), X, Y, X * X, X * Y, Y * Y]).T
-ATAinvA = np.dot(np.linalg.inv(np.dot(A.T, A)), A.T)
+import utils
+import stats
 
 
 def centroid_source(img, x0, y0):
@@ -27,20 +27,17 @@ def centroid_source(img, x0, y0):
 
     """
     x0, y0 = int(x0), int(y0)
-    patch = img[x0 - 1:x0 + 2, y0 - 1:y0 + 2]
-    a, b, c, d, e, f = np.dot(ATAinvA, patch.flatten())
-    yc = (2 * c * d + e * b) / (e * e - 4 * f * d)
-    xc = (2 * b * f + e * c) / (e * e - 4 * f * d)
-    assert np.abs(xc) < 1 and np.abs(yc) < 1, \
-            "(x0, y0) = ({0}, {1}) and (dx, dy) = ({2}, {3}) {4}" \
-            .format(x0, y0, xc, yc, patch)
-    return x0 + xc, y0 + yc
+    centers, good = utils.quadratic_peak(img, [[x0, y0]])
+    assert good[0], "Couldn't centroid the source at (x0, y0) = ({0}, {1})" \
+            .format(x0, y0)
+    return centers[0, 0], centers[0, 1]
 
 
 def find_sources(img, K, delta=3, padding=0):
     """
-    Detect the K brightest sources in an image using brightest pixel and then
-    refined using `centroid_source`.
+    Detect the K brightest sources in an image as local maxima and then
+    refine their positions using `utils.quadratic_peak`. A source is only
+    kept if it is the brightest pixel within a distance `delta`.
 
     ## Arguments
 
@@ -60,42 +57,109 @@ def find_sources(img, K, delta=3, padding=0):
 
     """
     # Account for the size of centroiding patch.
-    padding += 1
-
-    # Find the brightest pixels.
-    inds = np.argsort(img.flatten())[::-1]
-    coords = np.array([(-delta, -delta)])
-
-    # Loop over the brightest pixels until we find `K` acceptable sources.
-    for i in inds[1:]:
-        tmp = np.array(np.unravel_index(i, img.shape))
-        if np.all(np.sum((coords - tmp) ** 2, axis=1) > delta ** 2) and \
-                padding <= tmp[0] < img.shape[0] - padding and \
-                padding <= tmp[1] < img.shape[1] - padding:
-            # Refine the centroiding.
-            try:
-                res = centroid_source(img, *tmp)
-            except Exception:
-                pass
-            else:
-                coords = np.concatenate([coords, [res]], axis=0)
-        if len(coords) >= K + 1:
+    padding = int(padding) + 1
+
+    # Find the pixels that are the brightest within a disk of radius
+    # `delta`. This does the minimum separation suppression for all the
+    # pixels at once.
+    r = int(np.ceil(delta))
+    dx, dy = np.meshgrid(range(-r, r + 1), range(-r, r + 1))
+    footprint = dx ** 2 + dy ** 2 <= delta ** 2
+    peaks = img == maximum_filter(img, footprint=footprint, mode="nearest")
+
+    # Ignore the edges.
+    peaks[:padding, :] = False
+    peaks[img.shape[0] - padding:, :] = False
+    peaks[:, :padding] = False
+    peaks[:, img.shape[1] - padding:] = False
+
+    # Sort the candidates by brightness.
+    candidates = np.argwhere(peaks)
+    candidates = candidates[np.argsort(img[peaks])[::-1]]
+
+    # Refine the positions in batches until we find `K` acceptable sources.
+    coords = []
+    for i in range(0, len(candidates), K):
+        centers, good = utils.quadratic_peak(img, candidates[i:i + K])
+        coords += list(centers[good])
+        if len(coords) >= K:
             break
 
-    return coords[1:]
+    return np.array(coords[:K], dtype=float).reshape((-1, 2))
 
 
-def _generate(shape, coords, p):
-    result = np.zeros(shape)
-    x, y = np.arange(shape[0]), np.arange(shape[1])
-    norm = 1.0 / (2 * np.pi)
-    gamma = 1.0 / p[0] ** 2
+def _stamps(shape, coords, radius):
+    """
+    Get the pixels in the truncated square stamps around a set of sources.
 
-    for i, c in enumerate(coords):
-        r2 = ((x - c[0]) ** 2)[:, None] + ((y - c[1]) ** 2)[None, :]
-        result += p[i + 1] * np.exp(-0.5 * r2 * gamma) * norm * gamma
+    ## Returns
 
-    return result
+    * `src` (numpy.ndarray): The index of the source for each stamp pixel.
+    * `pix` (numpy.ndarray): The flattened index of each stamp pixel.
+    * `r2` (numpy.ndarray): The squared distance between the pixel and the
+      source.
+
+    """
+    coords = np.atleast_2d(coords)
+    c = np.round(coords).astype(int)
+    r = np.arange(-radius, radius + 1)
+    x, y, src = np.broadcast_arrays(c[:, 0][:, None, None] + r[None, :, None],
+            c[:, 1][:, None, None] + r[None, None, :],
+            np.arange(len(c))[:, None, None])
+
+    # Drop the pixels that fall off the image.
+    m = (x >= 0) * (x < shape[0]) * (y >= 0) * (y < shape[1])
+    x, y, src = x[m], y[m], src[m]
+
+    r2 = (x - coords[src, 0]) ** 2 + (y - coords[src, 1]) ** 2
+    return src, x * shape[1] + y, r2
+
+
+def _design(stamps, npix, nsrc, w):
+    """
+    Evaluate the unit-flux Gaussian model for each source on its stamp and
+    the derivative with respect to the width `w`.
+
+    """
+    src, pix, r2 = stamps
+    gamma = 1.0 / w ** 2
+    vals = np.exp(-0.5 * r2 * gamma) * gamma / (2 * np.pi)
+    dvals = vals * (r2 * gamma - 2) / w
+    A = csr_matrix((vals, (pix, src)), shape=(npix, nsrc))
+    dA = csr_matrix((dvals, (pix, src)), shape=(npix, nsrc))
+    return A, dA
+
+
+def _solve_fluxes(A, y):
+    """
+    Solve for the linear fluxes given a design matrix. `y` can have one
+    column per snapshot.
+
+    """
+    ATA = A.T.dot(A).toarray()
+    return np.linalg.lstsq(ATA, A.T.dot(y), rcond=-1)[0]
+
+
+def _profile_chi2(w, stamps, nsrc, y):
+    """
+    The chi-squared with the fluxes profiled out and its derivative with
+    respect to the width.
+
+    """
+    w = float(w[0])
+    A, dA = _design(stamps, len(y), nsrc, w)
+    f = _solve_fluxes(A, y)
+    r = y - A.dot(f)
+
+    # The fluxes are optimal so they don't contribute to the gradient.
+    return np.dot(r, r), np.array([-2 * np.dot(r, dA.dot(f))])
+
+
+def _generate(shape, coords, p):
+    radius = int(np.ceil(5 * np.abs(p[0])))
+    stamps = _stamps(shape, coords, radius)
+    A, dA = _design(stamps, shape[0] * shape[1], len(coords), p[0])
+    return A.dot(p[1:]).reshape(shape)
 
 
 def _synthesize_patch(shape, coords, flux, sigma2):
@@ -105,95 +169,160 @@ def _synthesize_patch(shape, coords, flux, sigma2):
     return result
 
 
-def _get_patch(img, xc, yc, patch_size):
-    xmn = int(xc - patch_size)
-    xmx = xmn + 2 * patch_size
-    ymn = int(yc - patch_size)
-    ymx = ymn + 2 * patch_size
-    data = img[xmn:xmx, ymn:ymx]
-    return xmn, ymn, data
-
-
 def _chi(p, coords, img):
     model = _generate(img.shape, coords, p)
     return (img - model).flatten()
 
 
+def measure_snapshots(imgs, coords, w=3., fit_width=True):
+    """
+    Measure the width of the PSF and the fluxes of a set of sources in a
+    stack of snapshots. The sources are only evaluated on truncated stamps
+    (5 sigma in radius), the fluxes are solved for linearly and the width is
+    optimized using the analytic derivative of the profiled chi-squared.
+
+    ## Arguments
+
+    * `imgs` (numpy.ndarray): The snapshots with shape `(M, N0, N1)`.
+    * `coords` (list): The positions of the `K` sources.
+
+    ## Keyword Arguments
+
+    * `w` (float): Initial guess for the width of sources (in pixels).
+    * `fit_width` (bool): Fit for the width of each snapshot? Otherwise, the
+      width is fixed at `w` and all the fluxes are solved for at once. Only
+      the fixed-width case is batched: each width fit is a separate
+      L-BFGS-B run on the stamps sized for that snapshot.
+
+    ## Returns
+
+    * `widths` (numpy.ndarray): The `(M,)` widths of the snapshots.
+    * `fluxes` (numpy.ndarray): The `(M, K)` fluxes of the sources.
+
+    """
+    imgs = np.array(imgs, dtype=float)
+    if imgs.ndim == 2:
+        imgs = imgs[None, :, :]
+    coords = np.atleast_2d(coords)
+    M, shape, K = len(imgs), imgs.shape[1:], len(coords)
+    ys = imgs.reshape((M, -1))
+
+    # The fixed-width case only needs one factorization.
+    radius = int(np.ceil(5 * w))
+    stamps = _stamps(shape, coords, radius)
+    if not fit_width:
+        A, dA = _design(stamps, ys.shape[1], K, w)
+        return w + np.zeros(M), _solve_fluxes(A, ys.T).T
+
+    widths = np.empty(M)
+    fluxes = np.empty((M, K))
+    for i, y in enumerate(ys):
+        wi, st, r = w, stamps, radius
+        while 1:
+            p1 = op.fmin_l_bfgs_b(_profile_chi2, [wi], args=(st, K, y),
+                    bounds=[(0.1, None)])[0]
+            wi = float(p1[0])
+
+            # Make sure that the stamps are still big enough.
+            if 5 * wi <= r:
+                break
+            r = int(np.ceil(5 * wi))
+            st = _stamps(shape, coords, r)
+
+        A, dA = _design(st, len(y), K, wi)
+        widths[i] = wi
+        fluxes[i] = _solve_fluxes(A, y)
+
+    return widths, fluxes
+
+
 def measure_sources(img, coords, w=3., padding=None):
     """
-    Find and measure the flux of the K brightest sources in an image.
+    Measure the width and the fluxes of a set of sources in an image.
 
     ## Arguments
 
     * `img` (numpy.ndarray): The image.
-    * `coords` (list):
+    * `coords` (list): The positions of the sources.
 
     ## Keyword Arguments
 
     * `w` (float): Initial guess for the width of sources (in pixels).
 
-    """
-    if padding is None:
-        padding = 10
+    ## Returns
 
-    # Fit for the fluxes.
-    p0 = np.mean(img) * np.ones(len(coords) + 1)
-    p0[0] = w
+    * `w` (float): The width of the sources.
+    * `coords` (numpy.ndarray): The positions sorted by flux.
+    * `fluxes` (numpy.ndarray): The fluxes in decreasing order.
 
-    p1 = op.leastsq(_chi, p0, args=(coords, img), factor=0.1)
-    p1 = p1[0]
+    """
+    widths, fluxes = measure_snapshots([img], coords, w=w)
+    fluxes = fluxes[0]
 
-    fluxes = p1[1:]
     inds = np.argsort(fluxes)[::-1]
     coords = np.array(coords)[inds]
     fluxes = fluxes[inds]
 
-    return np.abs(p1[0]), coords, fluxes
+    return widths[0], coords, fluxes
 
 
 def robust_statistics(x, nsig=2.5):
     # Sigma-clipping.
-    fs = np.array(x)
-    mu = np.median(fs)
-    std = np.max(fs) - np.min(fs)
-    for i in range(100):
-        inrange = (fs - mu > -nsig * std) * (fs - mu < nsig * std)
-        mu = np.median(fs[inrange])
-        newstd = np.sqrt(np.mean((fs[inrange] - mu) ** 2))
-        if newstd - std == 0:
-            break
-        std = newstd
+    return stats.clipped_stats(x, nsigma=nsig, maxiter=100)
 
-    return mu, newstd
 
+def estimate_noise(img, w, N=10000, padding=None, full_output=False,
+        seed=0):
+    """
+    Estimate the photometric noise in an image by measuring the flux of a
+    Gaussian source with width `w` at `N` random positions.
 
-def estimate_noise(img, w, N=10000, padding=None, full_output=False):
+    ## Arguments
+
+    * `img` (numpy.ndarray): The image.
+    * `w` (float): The width of the sources (in pixels).
+
+    ## Keyword Arguments
+
+    * `N` (int): The number of random apertures.
+    * `padding` (float): The number of pixels around the outer edge of the
+      image to avoid.
+    * `full_output` (bool): Also return the mean and the list of fluxes.
+    * `seed` (int): The seed for the random number generator used to choose
+      the positions.
+
+    ## Returns
+
+    * `noise` (float): The sigma-clipped standard deviation of the fluxes.
+
+    """
     if padding is None:
         padding = 10
     sigma2 = w ** 2
 
     patch_size = int(5 * np.abs(w))
     shape = [2 * patch_size] * 2
-
-    fs = []
     patch = _synthesize_patch(shape, [0.5 * patch_size] * 2, 1.0, sigma2)
-    while 1:
-        xc, yc = padding + \
-                np.random.rand(2) * (np.array(img.shape) - 2 * padding)
-        xmn, ymn, data = _get_patch(img, xc, yc, patch_size)
-        chi = lambda p: (data - float(p) * patch).flatten()
-        try:
-            p1 = op.leastsq(chi, [np.mean(data)])
-        except:
-            pass
-        else:
-            fs.append(float(p1[0]))
-        if len(fs) >= N:
-            break
-
-    fs0 = np.array(fs)
 
-    mu, noise = robust_statistics(fs, nsig=2.5)
+    # The best fit linear amplitude of the patch at every position where it
+    # fits completely inside the image.
+    flux = convolve(img, patch[::-1, ::-1], mode="valid") \
+            / np.sum(patch ** 2)
+    assert flux.size > 0, "The image is too small for a patch of width {0}" \
+            .format(w)
+
+    # Draw random positions until we have enough that are valid.
+    rng = np.random.RandomState(seed)
+    fs = np.empty(0)
+    while len(fs) < N:
+        xc = padding + rng.rand(N, 2) * (np.array(img.shape) - 2 * padding)
+        mn = np.trunc(xc - patch_size).astype(int)
+        good = np.all((mn >= 0) * (mn < flux.shape), axis=1)
+        fs = np.append(fs, flux[mn[good, 0], mn[good, 1]])
+
+    fs0 = fs[:N]
+
+    mu, noise = robust_statistics(fs0, nsig=2.5)
 
     if full_output:
         return noise, mu, fs0
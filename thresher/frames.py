@@ -0,0 +1,179 @@
+"""
+This file is part of The Thresher.
+
+Sources of prepared (centered, cropped and masked) frames for `Scene`. A
+source has the frames that it can provide (`fn in source`) and returns
+them with `source.get(fn, size)`.
+
+* `FrameStore` is backed by memory-mapped files. Any number of processes
+  can open the same store and the operating system shares the pages
+  between them so the frames are only read from the original files once.
+* `CachedFrames` serves the frames that `run_tli` already decoded.
+
+"""
+
+__all__ = ["FrameStore", "CachedFrames"]
+
+import os
+import json
+import logging
+
+import numpy as np
+
+import utils
+from thresher import load_data, prepare_data
+
+
+class FrameStore(object):
+    """
+    Open a frame store created by `FrameStore.create`.
+
+    ## Arguments
+
+    * `path` (str): The directory containing the store.
+
+    """
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        with open(os.path.join(self.path, "index.json")) as f:
+            index = json.load(f)
+        self.filenames = index["filenames"]
+        self.shape = tuple(index["shape"])
+        self.index = dict((fn, i) for i, fn in enumerate(self.filenames))
+        self.data = np.load(os.path.join(self.path, "data.npy"),
+                            mmap_mode="r")
+        self.mask = np.load(os.path.join(self.path, "mask.npy"),
+                            mmap_mode="r")
+
+    @classmethod
+    def create(cls, path, image_list, size, mask_list=None, centers=None,
+            **kwargs):
+        """
+        Load every frame once and write the store.
+
+        ## Arguments
+
+        * `path` (str): The directory for the store.
+        * `image_list` (list): The frames.
+        * `size` (int or tuple): The size (or shape `(ny, nx)`) of the
+          prepared frames. This should be the largest size that will be
+          needed; `get` can crop the frames to smaller sizes.
+
+        ## Keyword Arguments
+
+        * `mask_list` (list): The mask file for each frame.
+        * `centers` (list): The center of each frame.
+
+        All the other keyword arguments (`hdu`, `invert`, `square`,
+        `maskhdu`) are passed to `load_data`. The DC offset isn't applied.
+
+        ## Returns
+
+        * `store` (FrameStore): The (read-only) store.
+
+        """
+        try:
+            os.makedirs(path)
+        except os.error:
+            pass
+        shape = utils.image_shape(size)
+        N = len(image_list)
+        data = np.lib.format.open_memmap(os.path.join(path, "data.npy"),
+                mode="w+", dtype=float, shape=(N,) + shape)
+        mask = np.lib.format.open_memmap(os.path.join(path, "mask.npy"),
+                mode="w+", dtype=float, shape=(N,) + shape)
+        for i, fn in enumerate(image_list):
+            data[i], mask[i] = load_data(fn, shape,
+                    maskfn=mask_list[i] if mask_list is not None else None,
+                    center=centers[i] if centers is not None else None,
+                    **kwargs)
+        data.flush()
+        mask.flush()
+        del data, mask
+        logging.info("Wrote {0} frames to {1}".format(N, path))
+
+        with open(os.path.join(path, "index.json"), "w") as f:
+            json.dump(dict(filenames=list(image_list), shape=shape), f)
+        return cls(path)
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __contains__(self, fn):
+        return fn in self.index
+
+    def get(self, fn, size=None):
+        """
+        Get a copy of a prepared frame.
+
+        ## Arguments
+
+        * `fn` (str): The filename of the frame.
+
+        ## Keyword Arguments
+
+        * `size` (int or tuple): Crop the frame about its center to this
+          size. The difference from the size of the store should be even
+          along both axes so that the result is the same as preparing the
+          frame at this size.
+
+        ## Returns
+
+        * `data` (numpy.ndarray): The prepared data.
+        * `mask` (numpy.ndarray): The corresponding inverse variance map.
+
+        """
+        i = self.index[fn]
+        data, mask = self.data[i], self.mask[i]
+        if size is not None:
+            data = utils.trim_image(data, size)
+            mask = utils.trim_image(mask, size)
+        return np.array(data), np.array(mask)
+
+
+class CachedFrames(object):
+    """
+    Serve the frames decoded by `run_tli` (through its `cache` argument) so
+    that they don't need to be read again. The TLI sky level is added back
+    and the TLI weights are used as the masks.
+
+    ## Arguments
+
+    * `cache` (dict): The cache filled by `run_tli`.
+
+    ## Keyword Arguments
+
+    * `centers` (dict): The center of each frame. If this isn't given, the
+      frames are assumed to be registered.
+
+    """
+    def __init__(self, cache, centers=None):
+        self.cache = cache
+        self.centers = centers
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __contains__(self, fn):
+        return fn in self.cache
+
+    def get(self, fn, size):
+        """
+        Center and crop a frame.
+
+        ## Arguments
+
+        * `fn` (str): The filename of the frame.
+        * `size` (int or tuple): The size (or shape `(ny, nx)`) of the
+          data.
+
+        ## Returns
+
+        * `data` (numpy.ndarray): The prepared data.
+        * `mask` (numpy.ndarray): The corresponding inverse variance map.
+
+        """
+        img, weight, sky = self.cache[fn]
+        center = self.centers[fn] if self.centers is not None else None
+        return prepare_data(img + sky, np.array(weight), size,
+                            center=center)
@@ -0,0 +1,188 @@
+"""
+This file is part of The Thresher.
+
+Thresh frames as they are written by the camera. The new files are
+reported by a file system watcher (see `bin/thresh --live`), each frame is
+centered by correlating it with the current scene and the scene is updated
+right away. The current scene is published periodically so that the
+reconstruction can be followed during the observation.
+
+"""
+
+__all__ = ["LiveThresher"]
+
+import os
+import time
+import logging
+import threading
+from fnmatch import fnmatch
+from collections import deque
+
+import numpy as np
+
+from thresher import load_data
+from status import StatusReporter
+
+
+class LiveThresher(object):
+    """
+    Update a scene with frames as they arrive.
+
+    The file system events are debounced per file: a frame is only used
+    once no event has been seen for it in `debounce` seconds. One frame is
+    processed per call to `poll`. If the frames come in faster than they
+    can be processed, the oldest waiting frames are skipped so that there
+    are never more than `maxlen` frames in the queue. This bounds the
+    latency. Frames that can't be read (e.g. truncated files) are skipped
+    too.
+
+    ## Arguments
+
+    * `scene` (Scene): The scene to update.
+
+    ## Keyword Arguments
+
+    * `alpha`, `beta` (float): The learning rate for the `n`-th frame is
+      `alpha / (beta + n)`.
+    * `median` (bool): Subtract the median of the scene at each update.
+    * `nn` (bool): Constrain the scene to be non-negative.
+    * `pattern` (str): Only the files matching this pattern are used.
+    * `maxlen` (int): The maximum number of frames waiting in the queue.
+    * `debounce` (float): The quiet time (in seconds) before a file is
+      considered to be complete.
+    * `interval` (float): The time between published snapshots (in
+      seconds).
+    * `status` (str): The name of the status file in the output directory
+      of the scene. If this isn't given, no status file is written.
+
+    """
+    def __init__(self, scene, alpha=2.0, beta=1.0, median=True, nn=False,
+            pattern="*.fits", maxlen=4, debounce=0.5, interval=10.0,
+            status=None):
+        self.scene = scene
+        self.alpha = alpha
+        self.beta = beta
+        self.median = median
+        self.nn = nn
+        self.pattern = pattern
+        self.maxlen = max(1, int(maxlen))
+        self.debounce = debounce
+        self.interval = interval
+        self.pending = {}
+        self.queue = deque()
+        self.seen = set(scene.image_list)
+        self.nframes = 0
+        self.skipped = 0
+        self.latest = None
+        self._last_publish = time.time()
+        self._lock = threading.Lock()
+        self.reporter = StatusReporter(
+                fn=os.path.join(scene.outdir, status) if status else None,
+                interval=interval)
+
+    def notify(self, fn):
+        """
+        Register an event for a file. Hidden files (like the temporary
+        files written by `Scene.save`) are ignored.
+
+        """
+        name = os.path.basename(fn)
+        if name.startswith(".") or not fnmatch(name, self.pattern):
+            return
+        with self._lock:
+            if fn not in self.seen:
+                self.pending[fn] = time.time()
+
+    def poll(self):
+        """
+        Queue the files that have settled and process the oldest frame in
+        the queue. This should be called periodically from the main thread.
+
+        ## Returns
+
+        * `fn` (str): The frame that was processed (or `None`).
+
+        """
+        now = time.time()
+        with self._lock:
+            ready = sorted([fn for fn, t in self.pending.iteritems()
+                            if now - t >= self.debounce],
+                           key=lambda fn: self.pending[fn])
+            for fn in ready:
+                del self.pending[fn]
+                self.seen.add(fn)
+        self.queue.extend([fn for fn in ready if os.path.exists(fn)])
+
+        # Under backlog, skip the oldest frames to stay real-time.
+        if len(self.queue) > self.maxlen:
+            n = len(self.queue) - self.maxlen
+            for i in range(n):
+                self.queue.popleft()
+            self.skipped += n
+            logging.info("Skipping {0} frames to keep up.".format(n))
+
+        fn = None
+        if len(self.queue):
+            fn = self.queue.popleft()
+            try:
+                self.process(fn)
+            except (IOError, ValueError, IndexError) as e:
+                self.skipped += 1
+                logging.warn("Skipping {0}: {1}".format(fn, e))
+
+        if self.latest is not None \
+                and time.time() - self._last_publish >= self.interval:
+            self.publish()
+        return fn
+
+    def process(self, fn):
+        """
+        Center a frame on the current scene and update the scene with it.
+        The mask listed for the frame in the scene (if any) is used.
+
+        """
+        scene = self.scene
+        scene.metrics.start_frame(fn=fn, pass_number=0,
+                                  img_number=self.nframes)
+        try:
+            data, mask = load_data(fn, scene.size, hdu=scene.hdu,
+                    maskfn=scene.mask_list.get(fn), invert=scene.invert,
+                    square=scene.square, reference=scene.scene,
+                    dc=scene.dc, metrics=scene.metrics)
+        except:
+            scene.metrics.discard_frame()
+            raise
+        scene.update(data, mask, self.alpha / (self.beta + self.nframes),
+                     median=self.median, nn=self.nn, key=fn)
+        scene.image_list.append(fn)
+        scene._record_frame(fn, 0)
+        stages = scene.metrics.end_frame()
+
+        self.latest = (fn, self.nframes, data)
+        self.nframes += 1
+        self.reporter.update(0, self.nframes, sky=scene.sky,
+                             psf_sum=np.sum(scene.psf), stages=stages)
+
+    def publish(self):
+        """
+        Save a snapshot of the current scene.
+
+        """
+        fn, img_number, data = self.latest
+        with self.scene.metrics.stage("save"):
+            self.scene.save(fn, 0, img_number, data)
+        self._last_publish = time.time()
+
+    def close(self):
+        """
+        Publish the final scene and the frame table.
+
+        """
+        if self.latest is not None:
+            self.publish()
+        self.reporter.close(skipped=self.skipped)
+        self.scene.save_frame_table(os.path.join(self.scene.outdir,
+                                                 "frames.fits"))
+        logging.info("Used {0} frames and skipped {1}."
+                     .format(self.nframes, self.skipped))
+        self.scene.metrics.report()
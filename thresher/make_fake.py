@@ -2,47 +2,289 @@
 This file is part of The Thresher.
 """
 
+import logging
+import multiprocessing
+
 import numpy as np
 import pyfits as pyf
+from scipy.signal import fftconvolve as convolve
 
 
 def make_image(shape, positions, fluxes, sky, sky_sigma, psf_sigma):
     """
-    Make one image.
+    Make one image. The `positions` are `(x, y)` pairs where `x` is the
+    column and `y` is the row.
     """
     img = np.zeros(shape)
     img += sky
     img += sky_sigma * np.random.normal(size=shape)
-    nx, ny = shape
-    xg, yg = np.meshgrid(range(nx), range(ny))
-    for pos, f in zip(positions, fluxes):
-        kernel = np.exp(-0.5 * ((xg - pos[0]) ** 2 + (yg - pos[1]) ** 2)
-                / psf_sigma ** 2)
-        img += f * kernel / (2. * np.pi * psf_sigma ** 2)
+    img += render_gaussian(shape, np.atleast_2d(positions)[:, ::-1], fluxes,
+            psf_sigma)
     return img
 
 
+def render_gaussian(shape, positions, fluxes, psf_sigma, nsigma=5):
+    """
+    Render a set of Gaussian sources. Each source is only evaluated on a
+    local stamp with a half width of `nsigma` times the width.
+
+    ## Arguments
+
+    * `shape` (tuple): The shape of the image.
+    * `positions` (numpy.ndarray): The `(K, 2)` positions of the sources
+      with two columns for the zeroth and first dimensions of the image
+      (i.e. `(row, column)`).
+    * `fluxes` (numpy.ndarray): The fluxes of the sources.
+    * `psf_sigma` (float): The width of the Gaussian.
+
+    ## Keyword Arguments
+
+    * `nsigma` (float): The size of the stamps in units of `psf_sigma`.
+
+    """
+    positions = np.atleast_2d(positions)
+    hw = int(np.ceil(nsigma * psf_sigma))
+    r = np.arange(-hw, hw + 1)
+
+    # The pixel coordinates of every stamp.
+    c = np.round(positions).astype(int)
+    x, y, f = np.broadcast_arrays(c[:, 0][:, None, None] + r[None, :, None],
+            c[:, 1][:, None, None] + r[None, None, :],
+            np.asarray(fluxes, dtype=float)[:, None, None])
+    dx = x - positions[:, 0][:, None, None]
+    dy = y - positions[:, 1][:, None, None]
+    vals = f * np.exp(-0.5 * (dx ** 2 + dy ** 2) / psf_sigma ** 2) \
+            / (2. * np.pi * psf_sigma ** 2)
+
+    # Drop the pixels off the edge and add up the stamps.
+    m = (x >= 0) * (x < shape[0]) * (y >= 0) * (y < shape[1])
+    img = np.bincount((x[m] * shape[1] + y[m]), weights=vals[m],
+            minlength=shape[0] * shape[1])
+    return img.reshape(shape)
+
+
+def render_points(shape, positions, fluxes):
+    """
+    Deposit a set of point sources onto a pixel grid using bilinear
+    weights. The `positions` are `(row, column)` like `render_gaussian`.
+
+    """
+    positions = np.atleast_2d(positions)
+    fluxes = np.asarray(fluxes, dtype=float)
+    i0 = np.floor(positions).astype(int)
+    t = positions - i0
+    img = np.zeros(shape[0] * shape[1])
+    for a in (0, 1):
+        for b in (0, 1):
+            x, y = i0[:, 0] + a, i0[:, 1] + b
+            w = (t[:, 0] if a else 1 - t[:, 0]) \
+                    * (t[:, 1] if b else 1 - t[:, 1])
+            m = (x >= 0) * (x < shape[0]) * (y >= 0) * (y < shape[1])
+            img += np.bincount(x[m] * shape[1] + y[m],
+                    weights=w[m] * fluxes[m], minlength=len(img))
+    return img.reshape(shape)
+
+
+def speckle_psf(hw, rng, pupil=16, pad=4, strength=2.0):
+    """
+    Generate a random atmospheric (speckle) PSF by propagating a pupil with
+    a Kolmogorov phase screen.
+
+    ## Arguments
+
+    * `hw` (int): The half width of the output PSF image.
+    * `rng` (numpy.random.RandomState): The random number generator.
+
+    ## Keyword Arguments
+
+    * `pupil` (int): The diameter of the pupil on the phase screen grid.
+    * `pad` (int): The oversampling of the pupil. This sets the width of the
+      diffraction limited core (in pixels).
+    * `strength` (float): The RMS of the phase across the pupil (in
+      radians).
+
+    ## Returns
+
+    * `psf` (numpy.ndarray): The `(2 * hw + 1, 2 * hw + 1)` PSF normalized
+      to sum to one.
+
+    """
+    n = max(pupil * pad, 2 * hw + 2)
+    k = np.sqrt(np.fft.fftfreq(n)[:, None] ** 2
+                + np.fft.fftfreq(n)[None, :] ** 2)
+    k[0, 0] = np.inf
+
+    # Kolmogorov turbulence.
+    screen = np.real(np.fft.ifft2(np.fft.fft2(rng.randn(n, n))
+                                  * k ** (-11. / 6)))
+
+    x = np.arange(n) - 0.5 * n
+    mask = x[:, None] ** 2 + x[None, :] ** 2 <= (0.5 * pupil) ** 2
+    screen -= np.mean(screen[mask])
+    screen *= strength / np.std(screen[mask])
+
+    field = mask * np.exp(1j * screen)
+    psf = np.abs(np.fft.fftshift(np.fft.fft2(field))) ** 2
+
+    c = n // 2
+    psf = psf[c - hw:c + hw + 1, c - hw:c + hw + 1]
+    return psf / np.sum(psf)
+
+
+def _make_frame(args):
+    """
+    Generate a single frame. Every frame has its own random number
+    generator so that the results don't depend on the number of processes.
+
+    """
+    n, config = args
+    rng = np.random.RandomState([config["seed"], n])
+
+    sky = config["sky"] * rng.uniform()
+    offset = config["jitter"] * rng.normal(size=(1, 2))
+    shape = config["shape"]
+
+    # The renderers take `(row, column)` positions.
+    positions = (config["positions"] + offset)[:, ::-1]
+
+    if config["psf"] == "speckle":
+        psf = speckle_psf(config["psf_hw"], rng, pupil=config["pupil"],
+                pad=config["pad"], strength=config["strength"])
+        img = convolve(render_points(shape, positions, config["fluxes"]),
+                psf, mode="same")
+    else:
+        psf = None
+        img = render_gaussian(shape, positions, config["fluxes"],
+                config["psf_sigma"])
+
+    img += sky + config["sky_sigma"] * rng.normal(size=shape)
+
+    if config["cube"]:
+        return img, psf, sky, offset[0]
+
+    fn = "{0}_{1:05d}.fits".format(config["prefix"], n)
+    hdus = [pyf.PrimaryHDU(img)]
+    if psf is not None:
+        hdus.append(pyf.ImageHDU(psf))
+    pyf.HDUList(hdus).writeto(fn, clobber=True)
+    return None, psf, sky, offset[0]
+
+
+def make_imaging_run(N, prefix, shape=(128, 128), positions=None,
+        fluxes=None, nsources=None, psf="gaussian", psf_sigma=1.8, psf_hw=13,
+        pupil=16, pad=4, strength=2.0, sky=10., sky_sigma=1.0, jitter=20.,
+        cube=False, nproc=1, seed=0):
+    """
+    Make a synthetic lucky imaging run.
+
+    ## Arguments
+
+    * `N` (int): The number of frames.
+    * `prefix` (str): The prefix for the output files. The frames are saved
+      as `{prefix}_00000.fits`, etc. (or `{prefix}_cube.fits` if `cube` is
+      set) and the ground truth is saved in `{prefix}_truth.fits`.
+
+    ## Keyword Arguments
+
+    * `shape` (tuple): The shape of the frames.
+    * `positions` (numpy.ndarray): The `(K, 2)` `(x, y)` positions of the
+      sources where `x` is the column and `y` is the row.
+    * `fluxes` (numpy.ndarray): The fluxes of the sources.
+    * `nsources` (int): If `positions` isn't given, draw this many sources
+      at random positions with a power law flux distribution.
+    * `psf` (str): The type of PSF: `gaussian` (constant) or `speckle`
+      (a new random atmospheric realization for every frame).
+    * `psf_sigma` (float): The width of the Gaussian PSF.
+    * `psf_hw` (int): The half width of the speckle PSF images.
+    * `pupil`, `pad`, `strength`: The parameters of `speckle_psf`.
+    * `sky` (float): The maximum sky level.
+    * `sky_sigma` (float): The per-pixel noise.
+    * `jitter` (float): The RMS offset of the frames (in pixels).
+    * `cube` (bool): Save the frames in a single data cube.
+    * `nproc` (int): The number of processes to use.
+    * `seed` (int): The random seed.
+
+    """
+    rng = np.random.RandomState(seed)
+    if positions is None:
+        nsources = 3 if nsources is None else nsources
+        positions = rng.uniform(0.1, 0.9, size=(nsources, 2)) \
+                * np.array(shape)[::-1]
+        fluxes = 10 * (1 - rng.uniform(size=nsources)) ** -1.5
+    positions = np.atleast_2d(positions).astype(float)
+    fluxes = np.asarray(fluxes, dtype=float)
+
+    config = dict(prefix=prefix, shape=tuple(shape), positions=positions,
+            fluxes=fluxes, psf=psf, psf_sigma=psf_sigma, psf_hw=psf_hw,
+            pupil=pupil, pad=pad, strength=strength, sky=sky,
+            sky_sigma=sky_sigma, jitter=jitter, cube=cube, seed=seed)
+
+    # Streaming outputs so that the memory use doesn't depend on `N`.
+    cube_hdu, psf_hdu = None, None
+    if cube:
+        header = pyf.PrimaryHDU(np.zeros((1,) + tuple(shape))).header
+        header.update("NAXIS3", N)
+        cube_hdu = pyf.StreamingHDU(prefix + "_cube.fits", header)
+    if psf == "speckle":
+        P = 2 * psf_hw + 1
+        header = pyf.PrimaryHDU(np.zeros((1, P, P))).header
+        header.update("NAXIS3", N)
+        psf_hdu = pyf.StreamingHDU(prefix + "_psfs.fits", header)
+
+    jobs = ((n, config) for n in xrange(N))
+    if nproc > 1:
+        pool = multiprocessing.Pool(nproc)
+        results = pool.imap(_make_frame, jobs, chunksize=16)
+    else:
+        pool = None
+        results = (_make_frame(j) for j in jobs)
+
+    skies, offsets = np.empty(N), np.empty((N, 2))
+    for n, (img, p, s, o) in enumerate(results):
+        if cube_hdu is not None:
+            cube_hdu.write(img)
+        if psf_hdu is not None:
+            psf_hdu.write(p)
+        skies[n], offsets[n] = s, o
+        if n % 1000 == 0:
+            logging.info("Generated {0} / {1} frames".format(n, N))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    for hdu in [cube_hdu, psf_hdu]:
+        if hdu is not None:
+            hdu.close()
+
+    # Save the ground truth.
+    truth = pyf.PrimaryHDU(render_points(shape, positions[:, ::-1],
+                                         fluxes))
+    truth.header.update("psf", psf)
+    truth.header.update("psfsig", psf_sigma)
+    sources = pyf.new_table(pyf.ColDefs([
+        pyf.Column(name="x0", format="D", array=positions[:, 0]),
+        pyf.Column(name="y0", format="D", array=positions[:, 1]),
+        pyf.Column(name="flux", format="D", array=fluxes)]))
+    frames = pyf.new_table(pyf.ColDefs([
+        pyf.Column(name="sky", format="D", array=skies),
+        pyf.Column(name="dx", format="D", array=offsets[:, 0]),
+        pyf.Column(name="dy", format="D", array=offsets[:, 1])]))
+    pyf.HDUList([truth, sources, frames]).writeto(prefix + "_truth.fits",
+            clobber=True)
+
+
 def make_constant_psf_imaging_run(N, prefix):
     """
     Make a set of images with identical PSF and sources.
     Save in a set of FITS files.
-    Lots of stuff hard-coded.
     """
-    shape = (128, 128)
     positions = np.array([[13.1, 45.5],
                           [65.3, 61.2],
                           [51.5, 73.7]])
     fluxes = 2 * np.array([10., 100., 50.])
-    sky_sigma = 1.0
-    psf_sigma = 1.8
-    for n in range(N):
-        sky = 10. * np.random.uniform()
-        offset = 20. * np.random.normal(size=(1, 2))
-        ps = positions + offset
-        fn = "%s_%05d.fits" % (prefix, n)
-        img = make_image(shape, ps, fluxes, sky, sky_sigma, psf_sigma)
-        pyf.PrimaryHDU(img).writeto(fn, clobber=True)
-    pass
+    make_imaging_run(N, prefix, shape=(128, 128), positions=positions,
+            fluxes=fluxes, psf_sigma=1.8, sky_sigma=1.0, sky=10.,
+            jitter=20.)
 
 if __name__ == "__main__":
     make_constant_psf_imaging_run(300, 'fake')
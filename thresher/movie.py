@@ -0,0 +1,198 @@
+"""
+This file is part of The Thresher.
+
+Stream the snapshots written by `Scene.save` straight into a video file by
+piping raw RGB frames to an external encoder (`ffmpeg` or `avconv`).
+
+"""
+
+__all__ = ["render_frame", "write_movie"]
+
+import logging
+import subprocess
+
+import numpy as np
+from scipy.signal import fftconvolve as convolve
+
+from snapshots import load_state, estimate_stretch
+
+
+def _stretch(img, mu, sigma, f):
+    """
+    The arcsinh stretch used by the plotting code mapped to an inverted
+    (black on white) grayscale in the range `[0, 1]`.
+
+    """
+    return 1 - np.clip(f * np.arcsinh((img - mu) / sigma) + 0.2, 0, 1)
+
+
+def _fit_panel(img, size):
+    """
+    Crop or pad an image to the shape `size` (`(ny, nx)`) around its
+    center.
+
+    """
+    result = np.ones(size)
+    shape = np.array(img.shape)
+    mn = (shape - size) // 2
+    src = [slice(max(m, 0), max(m, 0) + min(n, s)) for m, n, s in
+           zip(mn, shape, size)]
+    dst = [slice(max(-m, 0), max(-m, 0) + min(n, s)) for m, n, s in
+           zip(mn, shape, size)]
+    result[dst[0], dst[1]] = img[src[0], src[1]]
+    return result
+
+
+def render_frame(state, sigmas, downsample=1, zoom=1, border=2):
+    """
+    Render the scene, PSF, data and residual panels of a snapshot into a
+    single RGB frame.
+
+    ## Arguments
+
+    * `state` (dict): The snapshot as returned by `snapshots.load_state`.
+    * `sigmas` (tuple): The noise levels `(scene_sigma, data_sigma)` used
+      for the stretch.
+
+    ## Keyword Arguments
+
+    * `downsample` (int): Average the frame in blocks of this size.
+    * `zoom` (int): Blow up each pixel by this factor.
+    * `border` (int): The width of the border between panels (in pixels).
+
+    ## Returns
+
+    * `frame` (numpy.ndarray): The `(H, W, 3)` frame as `uint8`. Both
+      dimensions are even so that the frame can be encoded using `yuv420p`.
+
+    """
+    scene_sigma, data_sigma = sigmas
+    data, psf, sky = state["data"], state["psf"], state["sky"]
+    size = data.shape
+
+    # The residual of the update.
+    residual = data - sky - convolve(state["old_scene"], psf, mode="valid")
+
+    # The PSF is blown up to fill its panel.
+    k = max(1, min(size) // psf.shape[0])
+    psf = np.kron(psf, np.ones((k, k)))
+    psf_img = 1 - np.clip(psf / np.max(np.abs(psf)), 0, 1)
+
+    panels = [_stretch(_fit_panel(state["new_scene"], size), 0.0,
+                       scene_sigma, 0.15),
+              _fit_panel(psf_img, size),
+              _stretch(data, sky, data_sigma, 0.2),
+              _stretch(residual, 0.0, data_sigma, 0.2)]
+
+    # Tile the panels.
+    ny, nx = size
+    frame = np.zeros((2 * ny + 3 * border, 2 * nx + 3 * border))
+    for i, panel in enumerate(panels):
+        r, c = i // 2, i % 2
+        r0, c0 = border + r * (ny + border), border + c * (nx + border)
+        frame[r0:r0 + panel.shape[0], c0:c0 + panel.shape[1]] = panel
+
+    # Resample.
+    if downsample > 1:
+        n0, n1 = (np.array(frame.shape) // downsample) * downsample
+        frame = frame[:n0, :n1].reshape((n0 // downsample, downsample,
+            n1 // downsample, downsample)).mean(axis=(1, 3))
+    if zoom > 1:
+        frame = np.kron(frame, np.ones((zoom, zoom)))
+
+    # Make sure that the dimensions are even.
+    frame = frame[:2 * (frame.shape[0] // 2), :2 * (frame.shape[1] // 2)]
+
+    frame = (255 * frame).astype(np.uint8)
+    return np.dstack([frame] * 3)
+
+
+def write_movie(fns, outfn, every=1, downsample=1, zoom=1, fps=25,
+        encoder="ffmpeg", sigmas=None):
+    """
+    Stream a sequence of snapshots into a video (or animated GIF, depending
+    on the extension of `outfn`). Only one snapshot is held in memory at a
+    time.
+
+    ## Arguments
+
+    * `fns` (list): The snapshot files.
+    * `outfn` (str): The output filename.
+
+    ## Keyword Arguments
+
+    * `every` (int): Only use every few snapshots.
+    * `downsample` (int): Average the frames in blocks of this size.
+    * `zoom` (int): Blow up each pixel by this factor.
+    * `fps` (float): The frame rate of the output.
+    * `encoder` (str): The encoder executable. It needs to accept the
+      `ffmpeg` command line interface.
+    * `sigmas` (tuple): The stretch. This is estimated using
+      `snapshots.estimate_stretch` if it isn't given.
+
+    ## Returns
+
+    * `nframes` (int): The number of frames written.
+
+    Raises a `ValueError` if `sigmas` isn't given and none of the snapshots
+    can be read.
+
+    """
+    fns = sorted(fns)[::int(every)]
+    if not len(fns):
+        return 0
+    if sigmas is None:
+        sigmas = estimate_stretch(fns)
+        if sigmas is None:
+            raise ValueError("None of the snapshots can be read.")
+
+    proc, shape, nframes, err, broken = None, None, 0, "", False
+    try:
+        for fn in fns:
+            state = load_state(fn)
+            if state is None:
+                logging.warn("Couldn't read {0}. Skipping.".format(fn))
+                continue
+            frame = render_frame(state, sigmas, downsample=downsample,
+                    zoom=zoom)
+
+            # Start the encoder once we know the frame size.
+            if proc is None:
+                shape = frame.shape
+                cmd = [encoder, "-y", "-loglevel", "error",
+                       "-f", "rawvideo", "-pix_fmt", "rgb24",
+                       "-s", "{0}x{1}".format(shape[1], shape[0]),
+                       "-r", str(fps), "-i", "-"]
+                if not outfn.lower().endswith(".gif"):
+                    cmd += ["-pix_fmt", "yuv420p"]
+                cmd += [outfn]
+                logging.info("Running: {0}".format(" ".join(cmd)))
+                proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                        stderr=subprocess.PIPE)
+
+            if frame.shape != shape:
+                logging.warn("The shape of {0} doesn't match. Skipping."
+                        .format(fn))
+                continue
+
+            try:
+                proc.stdin.write(frame.tostring())
+            except IOError:
+                # The encoder exited early. Its error is reported below.
+                broken = True
+                break
+            nframes += 1
+    finally:
+        if proc is not None:
+            try:
+                proc.stdin.close()
+            except IOError:
+                pass
+            err = proc.stderr.read()
+            proc.wait()
+
+    if proc is not None and (proc.returncode or broken):
+        raise RuntimeError("The encoder failed with status {0}: {1}"
+                .format(proc.returncode, err.strip()))
+
+    return nframes
@@ -0,0 +1,189 @@
+"""
+This file is part of The Thresher.
+
+A coarse-to-fine schedule for the inference. The first updates are done on
+binned data with a binned scene and a smaller PSF, and the scene is then
+upsampled to initialize the next (finer) level.
+
+"""
+
+__all__ = ["BinnedScene", "run_multiresolution"]
+
+import os
+import logging
+
+import numpy as np
+
+import utils
+from thresher import Scene
+
+
+def bin_image(img, b):
+    """
+    Sum an image in `(b, b)` blocks. The shape must be divisible by `b`.
+
+    """
+    n0, n1 = img.shape[0] // b, img.shape[1] // b
+    return img.reshape((n0, b, n1, b)).sum(axis=(1, 3))
+
+
+def bin_weights(mask, b):
+    """
+    Bin an inverse variance map to match `bin_image`. A block with any
+    masked pixels is masked.
+
+    """
+    bad = bin_image(mask <= 0, b) > 0
+    var = bin_image(1.0 / np.where(mask > 0, mask, 1.0), b)
+    return np.where(bad, 0.0, 1.0 / var)
+
+
+def upsample_image(img, b):
+    """
+    Upsample an image by a factor `b`, conserving the flux.
+
+    """
+    return np.kron(img, np.ones((b, b))) / float(b * b)
+
+
+def _window(img, start, size):
+    """
+    The `(size, size)` (or `(ny, nx)` if `size` is a pair) window of an
+    image starting at pixel `(start, start)`. The parts that fall outside of
+    the image are zero.
+
+    """
+    shape = utils.image_shape(size)
+    result = np.zeros(shape)
+    lo = [max(start, 0)] * 2
+    hi = [min(start + n, m) for n, m in zip(shape, img.shape)]
+    if hi[0] > lo[0] and hi[1] > lo[1]:
+        result[lo[0] - start:hi[0] - start, lo[1] - start:hi[1] - start] = \
+                img[lo[0]:hi[0], lo[1]:hi[1]]
+    return result
+
+
+class BinnedScene(Scene):
+    """
+    A `Scene` that works on binned copies of the data of another scene. The
+    data are loaded, centered and masked exactly like for the parent and
+    then cropped to a multiple of the binning and binned.
+
+    ## Arguments
+
+    * `parent` (Scene): The full resolution scene.
+    * `binning` (int): The binning factor.
+
+    ## Keyword Arguments
+
+    * `outdir` (str): The output directory for this level. Defaults to
+      `level-{binning}` in the output directory of the parent.
+
+    """
+    def __init__(self, parent, binning, outdir=None):
+        b = int(binning)
+        self.binning = b
+        self.parent_size = parent.size
+        self.full_shape = tuple(b * (n // b) for n in parent.shape)
+        psf_hw = int(np.ceil(parent.psf_hw / float(b)))
+
+        # Bin the parent's scene over the footprint of this level.
+        initial = bin_image(_window(parent.scene, parent.psf_hw - b * psf_hw,
+                [n + 2 * b * psf_hw for n in self.full_shape]), b)
+
+        fns = parent.image_list
+        mask_list = [parent.mask_list.get(fn) for fn in fns] \
+                if len(parent.mask_list) else None
+        centers = [parent.centers[fn] for fn in fns] \
+                if parent.centers is not None else None
+        ranks = [parent.ranks[fn] for fn in fns] \
+                if parent.ranks is not None else None
+        if outdir is None:
+            outdir = os.path.join(parent.outdir, "level-{0}".format(b))
+        try:
+            os.makedirs(outdir)
+        except os.error:
+            pass
+
+        super(BinnedScene, self).__init__(initial, list(fns),
+                mask_list=mask_list, invert=parent.invert,
+                square=parent.square, outdir=outdir, centers=centers,
+                psf_hw=psf_hw, psfreg=parent.psfreg, sceneL2=parent.sceneL2,
+                dc=parent.dc, hdu=parent.hdu, ranks=ranks,
+                optimizer=parent.optimizer.clone(), store=parent.store)
+
+    def load_data(self, fn, maskfn=None, maskhdu=0, size=None):
+        data, mask = super(BinnedScene, self).load_data(fn, maskfn=maskfn,
+                maskhdu=maskhdu, size=self.parent_size)
+        ny, nx = self.full_shape
+        return bin_image(data[:ny, :nx], self.binning), \
+                bin_weights(mask[:ny, :nx], self.binning)
+
+    def window(self, size, psf_hw, binning=1):
+        """
+        Resample the scene onto the footprint of another level.
+
+        ## Arguments
+
+        * `size` (int or tuple): The size (or shape `(ny, nx)`) of the data
+          at full resolution.
+        * `psf_hw` (int): The PSF half width at the other level.
+
+        ## Keyword Arguments
+
+        * `binning` (int): The binning factor at the other level.
+
+        ## Returns
+
+        * `scene` (numpy.ndarray): The scene for the other level.
+
+        """
+        b = self.binning
+        full = _window(upsample_image(self.scene, b),
+                b * self.psf_hw - binning * psf_hw,
+                [binning * (n // binning) + 2 * binning * psf_hw
+                 for n in utils.image_shape(size)])
+        return bin_image(full, binning) if binning > 1 else full
+
+
+def run_multiresolution(scene, levels, level_passes=1, **kwargs):
+    """
+    Run the inference coarse-to-fine. For each binning factor in `levels`
+    (from coarsest to finest), a `BinnedScene` is initialized from the
+    current scene, run for `level_passes` passes and resampled onto the next
+    level. Finally, the inference is run at full resolution.
+
+    ## Arguments
+
+    * `scene` (Scene): The full resolution scene.
+    * `levels` (list): The binning factors (e.g. `[4, 2]`).
+
+    ## Keyword Arguments
+
+    * `level_passes` (int): The number of passes at each coarse level.
+
+    All the other keyword arguments are passed to `Scene.run_inference`.
+    The coarse levels don't run the final `polish`. The learning rate
+    schedule on each level picks up where the previous level left off.
+
+    """
+    levels = sorted([int(b) for b in levels if int(b) > 1], reverse=True)
+    nframes = len(scene.image_list[:kwargs.get("top")])
+
+    # The learning rate schedule continues across the levels so that the
+    # finer levels don't undo the work of the coarser ones.
+    child, start = None, kwargs.pop("start", 0)
+    for b in levels:
+        new = BinnedScene(scene, b)
+        if child is not None:
+            new.scene = child.window(scene.size, new.psf_hw, binning=b)
+        child = new
+        logging.info("Running the inference with {0}x{0} binning.".format(b))
+        child.run_inference(**dict(kwargs, npasses=level_passes, polish=0,
+                alpha=b * b * kwargs.get("alpha", 2.0), start=start))
+        start += len(child.convergence) * nframes
+
+    if child is not None:
+        scene.scene = child.window(scene.size, scene.psf_hw)
+    scene.run_inference(start=start, **kwargs)
+    return scene
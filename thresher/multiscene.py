@@ -0,0 +1,386 @@
+"""
+This file is part of The Thresher.
+
+Thresh several regions of the same frames at once. Every frame is read and
+centered once and the regions are cut out of it. Each region has its own
+`Scene` (and so its own PSF for every frame) and the regions are updated in
+parallel by worker processes that each own a fixed set of scenes.
+
+"""
+
+__all__ = ["MultiScene", "MultiTargetScene", "target_regions"]
+
+import os
+import logging
+import multiprocessing
+
+import numpy as np
+
+import utils
+from thresher import Scene, load_data, psf_width, _relative_change
+from status import StatusReporter
+
+
+class _SceneWorker(object):
+    """
+    The set of scenes owned by one worker.
+
+    """
+    def __init__(self, initials, outdirs, psf_hw, scene_kwargs):
+        self.scenes = [Scene(initial, [], psf_hw=psf_hw, outdir=outdir,
+                             **scene_kwargs)
+                       for initial, outdir in zip(initials, outdirs)]
+        self.data = [None] * len(self.scenes)
+
+    def update(self, key, cuts, alpha, median, nn):
+        result = []
+        for i, (scene, (data, mask)) in enumerate(zip(self.scenes, cuts)):
+            scene.update(data, mask, alpha, median=median, nn=nn, key=key)
+            self.data[i] = data
+            result.append((scene.chi2 / max(scene.ndata, 1), scene.sky,
+                           np.sum(scene.psf), psf_width(scene.psf)))
+        return result
+
+    def state(self):
+        # The PSF doesn't exist until the first update.
+        return [(s.scene, getattr(s, "psf",
+                                  np.zeros((2 * s.psf_hw + 1,) * 2)))
+                for s in self.scenes]
+
+    def save(self, fn, pass_number, img_number):
+        for scene, data in zip(self.scenes, self.data):
+            scene.save(fn, pass_number, img_number, data)
+        return [None] * len(self.scenes)
+
+
+def _serve(conn, initials, outdirs, psf_hw, scene_kwargs):
+    worker = _SceneWorker(initials, outdirs, psf_hw, scene_kwargs)
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        method, args = msg
+        conn.send(getattr(worker, method)(*args))
+    conn.close()
+
+
+def target_regions(targets):
+    """
+    Work out the field that needs to be loaded to cover a set of targets.
+
+    ## Arguments
+
+    * `targets` (list): The `(dy, dx, ny, nx)` of each target: the offset
+      of its center from the center of the frame and the shape of its data
+      region.
+
+    ## Returns
+
+    * `shape` (tuple): The shape of the field covering all the targets.
+    * `offset` (tuple): The offset of the center of the field from the
+      center of the frame.
+    * `origins` (list): The origin of each target in the field.
+
+    """
+    # This follows the conventions of `utils.centroid_image`: a cut-out of
+    # size `n` centered on `c` starts at `c - ceil(n / 2)`.
+    targets = np.atleast_2d(np.array(targets, dtype=int))
+    lo = targets[:, :2] - (targets[:, 2:] + 1) // 2
+    hi = lo + targets[:, 2:]
+    mn, mx = lo.min(axis=0), hi.max(axis=0)
+    shape = mx - mn
+    offset = mn + (shape + 1) // 2
+    return tuple(shape), tuple(offset), [tuple(o) for o in lo - mn]
+
+
+class MultiScene(object):
+    """
+    Thresh several regions of a field at once, reading each frame only
+    once.
+
+    ## Arguments
+
+    * `initials` (list): An initial scene (including the PSF padding) for
+      each region.
+    * `origins` (list): The `(y, x)` origin of the data region of each
+      scene in the field.
+    * `image_list` (list): The list of images to thresh.
+
+    ## Keyword Arguments
+
+    * `shape` (tuple): The shape of the field. Defaults to the bounding box
+      of the regions.
+    * `offset` (tuple): The offset of the center of the field from the
+      center of each frame. If this isn't given, the field is centered on
+      the frame.
+    * `nproc` (int): The number of worker processes.
+    * `outdir` (str): The directory for the metrics and status files.
+    * `outdirs` (list): An output directory for each scene.
+    * `mask_list`, `invert`, `square`, `centers`, `dc`, `hdu`: See `Scene`.
+    * `psf_hw` (int): The half width of the PSF of each scene.
+
+    All the other keyword arguments are passed to each `Scene`.
+
+    """
+    def __init__(self, initials, origins, image_list, shape=None,
+            offset=None, nproc=1, outdir="", outdirs=None, mask_list=None,
+            invert=False, square=False, centers=None, psf_hw=13, dc=0.0,
+            hdu=0, **scene_kwargs):
+        self.image_list = image_list
+        self.outdir = os.path.abspath(outdir)
+        self.mask_list = dict(zip(image_list, mask_list)) \
+                if mask_list is not None else {}
+        self.centers = dict(zip(image_list, centers)) \
+                if centers is not None else None
+        self.invert, self.square = invert, square
+        self.psf_hw = psf_hw
+        self.dc = dc
+        self.hdu = hdu
+        self.offset = offset
+        self.metrics = utils.Metrics()
+        self.convergence = []
+
+        initials = [np.array(initial, dtype=float) for initial in initials]
+        self.origins = [tuple(o) for o in origins]
+        self.shapes = [tuple(n - 2 * psf_hw for n in initial.shape)
+                       for initial in initials]
+        if shape is None:
+            shape = (max(o[0] + s[0] for o, s in zip(origins, self.shapes)),
+                     max(o[1] + s[1] for o, s in zip(origins, self.shapes)))
+        self.data_shape = tuple(shape)
+        if outdirs is None:
+            outdirs = [""] * len(initials)
+        self.outdirs = outdirs
+
+        # Deal the scenes out to the workers.
+        nproc = max(1, min(int(nproc), len(initials)))
+        self.groups = [range(i, len(initials), nproc) for i in range(nproc)]
+        if nproc == 1:
+            self.workers = [_SceneWorker(initials, outdirs, psf_hw,
+                                         scene_kwargs)]
+            self.procs = []
+        else:
+            self.workers, self.procs = [], []
+            for g in self.groups:
+                a, b = multiprocessing.Pipe()
+                p = multiprocessing.Process(target=_serve,
+                        args=(b, [initials[i] for i in g],
+                              [outdirs[i] for i in g], psf_hw,
+                              scene_kwargs))
+                p.daemon = True
+                p.start()
+                self.workers.append(a)
+                self.procs.append(p)
+
+    def _call(self, method, args_list):
+        """
+        Call a method on every worker in parallel and collect the results
+        in scene order.
+
+        """
+        if not len(self.procs):
+            results = [getattr(self.workers[0], method)(*args_list[0])]
+        else:
+            for conn, args in zip(self.workers, args_list):
+                conn.send((method, args))
+            results = [conn.recv() for conn in self.workers]
+        out = [None] * len(self.origins)
+        for g, r in zip(self.groups, results):
+            for i, v in zip(g, r):
+                out[i] = v
+        return out
+
+    def load_data(self, fn):
+        """
+        Load and center the field for a frame.
+
+        """
+        maskfn = self.mask_list.get(fn)
+        center = self.centers[fn] if self.centers is not None else None
+        return load_data(fn, self.data_shape, hdu=self.hdu, maskfn=maskfn,
+                invert=self.invert, square=self.square, center=center,
+                offset=self.offset, dc=self.dc, metrics=self.metrics)
+
+    def update(self, fn, alpha, median=True, nn=False):
+        """
+        Load a frame once and update every scene.
+
+        ## Returns
+
+        * `stats` (list): The `(chi2, sky, psf_sum, psf_width)` of each
+          scene.
+
+        """
+        data, mask = self.load_data(fn)
+        self.data = data
+
+        cuts = [(data[y:y + ny, x:x + nx], mask[y:y + ny, x:x + nx])
+                for (y, x), (ny, nx) in zip(self.origins, self.shapes)]
+        with self.metrics.stage("update"):
+            return self._call("update",
+                    [(fn, [cuts[i] for i in g], alpha, median, nn)
+                     for g in self.groups])
+
+    @property
+    def scenes(self):
+        """
+        The current scene of each region.
+
+        """
+        return [s for s, psf in self._call("state",
+                                           [()] * len(self.groups))]
+
+    def save(self, fn, pass_number, img_number):
+        """
+        Save a snapshot of every scene in its output directory.
+
+        """
+        self._call("save", [(fn, pass_number, img_number)] * len(self.groups))
+
+    def run_inference(self, npasses=5, median=False, nn=True, top=None,
+            thin=1, alpha=2.0, beta=1.0, tol=None, metrics=None,
+            status=None, status_port=None, status_interval=5.0):
+        """
+        Thresh the data. The learning rate schedule is the same as for
+        `Scene.run_inference`.
+
+        ## Keyword Arguments
+
+        * `npasses` (int): The number of times to run through the data.
+        * `median` (bool): Subtract the median of the scene at each update.
+        * `nn` (bool): Constrain the inferred scene to be non-negative.
+        * `top` (int): Only consider the top few images.
+        * `thin` (int): Only save the state every few images.
+        * `tol` (float): Stop early when the relative change over a full
+          pass is below this value for every scene.
+        * `metrics`, `status`, `status_port`, `status_interval`: See
+          `Scene.run_inference`. The files are written to `outdir` and the
+          chi-squared, sky and PSF sum are averaged over the scenes.
+
+        ## Returns
+
+        * `scenes` (list): The final scene of each region.
+
+        """
+        if metrics is not None:
+            self.metrics.open(os.path.join(self.outdir, metrics))
+
+        iml = list(self.image_list)
+        if top is not None:
+            iml = iml[:int(top)]
+        N = len(iml)
+        reporter = StatusReporter(
+                fn=os.path.join(self.outdir, status) if status else None,
+                port=status_port, interval=status_interval,
+                total=npasses * N)
+        pass_number = -1
+        try:
+            for pass_number in xrange(npasses):
+                if pass_number > 0:
+                    np.random.shuffle(iml)
+                start, chi2s = self.scenes, []
+                for img_number, fn in enumerate(iml):
+                    if pass_number == 0:
+                        learning_rate = alpha / (beta + img_number)
+                        use_nn = nn
+                    else:
+                        learning_rate = alpha / (beta + N)
+                        use_nn = False
+
+                    self.metrics.start_frame(fn=fn, pass_number=pass_number,
+                                             img_number=img_number)
+                    stats = np.mean(self.update(fn, learning_rate,
+                                                median=median, nn=use_nn),
+                                    axis=0)
+                    chi2s.append(stats[0])
+                    self.metrics.set("chi2", float(stats[0]))
+                    if img_number % thin == 0:
+                        with self.metrics.stage("save"):
+                            self.save(fn, pass_number, img_number)
+                    stages = self.metrics.end_frame()
+                    reporter.update(pass_number, img_number, sky=stats[1],
+                                    psf_sum=stats[2], stages=stages)
+
+                # Check for convergence.
+                diag = dict(pass_number=pass_number,
+                            mean_chi2=float(np.mean(chi2s)),
+                            scene_change=max(_relative_change(s, s0)
+                                for s, s0 in zip(self.scenes, start)))
+                self.convergence.append(diag)
+                logging.info("Pass {pass_number}: mean chi2 = "
+                             "{mean_chi2:.4g}, scene change = "
+                             "{scene_change:.4g}".format(**diag))
+                if tol is not None and pass_number > 0 \
+                        and diag["scene_change"] < tol:
+                    logging.info("Converged after {0} passes."
+                                 .format(pass_number + 1))
+                    break
+        finally:
+            reporter.close(pass_number=pass_number,
+                           convergence=self.convergence)
+            if metrics is not None:
+                self.metrics.report(os.path.join(self.outdir,
+                        os.path.splitext(metrics)[0] + "-summary.json"))
+                self.metrics.close()
+            else:
+                self.metrics.report()
+
+        return self.scenes
+
+    def close(self):
+        """
+        Shut down the worker processes.
+
+        """
+        for conn in self.workers if len(self.procs) else []:
+            conn.send(None)
+        for p in self.procs:
+            p.join()
+        self.procs, self.workers = [], []
+
+
+class MultiTargetScene(MultiScene):
+    """
+    Thresh several targets in the same frames. Each target is given by the
+    offset of its center from the center of the frame (as found by TLI)
+    and the shape of its data region.
+
+    ## Arguments
+
+    * `initial` (numpy.ndarray): An initial guess at the scene for the
+      whole frame, centered on the center of the frames.
+    * `targets` (list): The `(dy, dx, ny, nx)` of each target.
+    * `image_list` (list): The list of images to thresh.
+
+    ## Keyword Arguments
+
+    * `outdir` (str): The output files for target `i` are written to
+      `target-{i}` in this directory.
+
+    All the other keyword arguments are passed to `MultiScene`.
+
+    """
+    def __init__(self, initial, targets, image_list, outdir="", psf_hw=13,
+            **kwargs):
+        self.targets = [tuple(int(v) for v in t) for t in targets]
+        shape, offset, origins = target_regions(self.targets)
+
+        # Cut the initial scene for each target out of the full one. The
+        # parts that fall outside of the initial scene are zero.
+        center = np.array(initial.shape) // 2
+        initials = [utils.centroid_image(initial,
+                                         (ny + 2 * psf_hw, nx + 2 * psf_hw),
+                                         coords=center + (dy, dx))[1]
+                    for dy, dx, ny, nx in self.targets]
+
+        outdirs = [os.path.join(outdir, "target-{0}".format(i))
+                   for i in range(len(self.targets))]
+        for d in outdirs:
+            try:
+                os.makedirs(d)
+            except os.error:
+                pass
+
+        super(MultiTargetScene, self).__init__(initials, origins, image_list,
+                shape=shape, offset=offset, outdir=outdir, outdirs=outdirs,
+                psf_hw=psf_hw, **kwargs)
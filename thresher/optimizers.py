@@ -0,0 +1,161 @@
+"""
+This file is part of The Thresher.
+
+The stochastic optimizers used to update the scene. Each optimizer takes
+the gradient of the log-likelihood computed from one frame and returns the
+step to add to the scene.
+
+"""
+
+__all__ = ["SGD", "AdaGrad", "Adam", "SAGA", "get_optimizer"]
+
+import numpy as np
+
+
+class SGD(object):
+    """
+    Plain stochastic gradient ascent: the step is the learning rate times
+    the gradient.
+
+    """
+    # The names of the constructor arguments.
+    settings = ()
+
+    def clone(self):
+        """
+        Get a new optimizer with the same settings and no state.
+
+        """
+        return type(self)(**dict((k, getattr(self, k))
+                                 for k in self.settings))
+
+    def step(self, dlds, learning_rate, key=None):
+        """
+        Compute the step for a gradient.
+
+        ## Arguments
+
+        * `dlds` (numpy.ndarray): The gradient of the log-likelihood of the
+          frame with respect to the scene.
+        * `learning_rate` (float): The learning rate from the schedule.
+
+        ## Keyword Arguments
+
+        * `key`: An identifier for the frame (the filename).
+
+        ## Returns
+
+        * `delta` (numpy.ndarray): The update to add to the scene.
+
+        """
+        return learning_rate * dlds
+
+
+class AdaGrad(SGD):
+    """
+    AdaGrad: the step for each pixel is normalized by the root of the sum
+    of the squared gradients seen so far. The learning rate is then (about)
+    the size of the first step in the units of the scene.
+
+    ## Keyword Arguments
+
+    * `eps` (float): A small number to avoid dividing by zero.
+
+    """
+    settings = ("eps",)
+
+    def __init__(self, eps=1e-8):
+        self.eps = eps
+        self.G = None
+
+    def step(self, dlds, learning_rate, key=None):
+        if self.G is None:
+            self.G = np.zeros_like(dlds)
+        self.G += dlds ** 2
+        return learning_rate * dlds / (np.sqrt(self.G) + self.eps)
+
+
+class Adam(SGD):
+    """
+    Adam: the step for each pixel is a bias-corrected running mean of the
+    gradient divided by the root of a running mean of its square. The
+    learning rate is (about) the size of each step in the units of the
+    scene.
+
+    ## Keyword Arguments
+
+    * `beta1` (float): The decay rate of the first moment.
+    * `beta2` (float): The decay rate of the second moment.
+    * `eps` (float): A small number to avoid dividing by zero.
+
+    """
+    settings = ("beta1", "beta2", "eps")
+
+    def __init__(self, beta1=0.9, beta2=0.999, eps=1e-8):
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.eps = eps
+        self.m, self.v, self.t = None, None, 0
+
+    def step(self, dlds, learning_rate, key=None):
+        if self.m is None:
+            self.m = np.zeros_like(dlds)
+            self.v = np.zeros_like(dlds)
+        self.t += 1
+        self.m = self.beta1 * self.m + (1 - self.beta1) * dlds
+        self.v = self.beta2 * self.v + (1 - self.beta2) * dlds ** 2
+        m = self.m / (1 - self.beta1 ** self.t)
+        v = self.v / (1 - self.beta2 ** self.t)
+        return learning_rate * m / (np.sqrt(v) + self.eps)
+
+
+class SAGA(SGD):
+    """
+    SAGA: the latest gradient of every frame is stored and the step uses
+    the new gradient of the frame minus its stored value plus the mean of
+    all the stored gradients. This reduces the variance of the steps so the
+    learning rate doesn't need to decay. The first time a frame is seen,
+    a plain gradient step is taken.
+
+    This needs to keep one gradient image per frame in memory.
+
+    ## Keyword Arguments
+
+    * `dtype`: The type used to store the gradients.
+
+    """
+    settings = ("dtype",)
+
+    def __init__(self, dtype=np.float32):
+        self.dtype = dtype
+        self.table = {}
+        self.total = None
+
+    def step(self, dlds, learning_rate, key=None):
+        assert key is not None, "SAGA needs to know which frame this is."
+        if self.total is None:
+            self.total = np.zeros_like(dlds)
+
+        old = self.table.get(key)
+        new = np.array(dlds, dtype=self.dtype)
+        if old is None:
+            direction = dlds
+            self.total += new
+        else:
+            direction = dlds - old + self.total / len(self.table)
+            self.total += new - old
+        self.table[key] = new
+        return learning_rate * direction
+
+
+def get_optimizer(name, **kwargs):
+    """
+    Get an optimizer by name (`sgd`, `adagrad`, `adam` or `saga`). The
+    keyword arguments are passed to the constructor.
+
+    """
+    optimizers = dict(sgd=SGD, adagrad=AdaGrad, adam=Adam, saga=SAGA)
+    try:
+        return optimizers[name.lower()](**kwargs)
+    except KeyError:
+        raise ValueError("Unknown optimizer: {0}".format(name))
@@ -3,14 +3,14 @@ This file is part of The Thresher
 
 """
 
-__all__ = ["plot_inference_step"]
-
-import itertools
+__all__ = ["plot_inference_step", "InferencePlotter"]
 
 import numpy as np
-from scipy.signal import convolve
+from scipy.signal import fftconvolve as convolve
 from scipy.special import erf
 
+import stats
+
 
 def plot_image(ax, img, size=None, vrange=None):
     """
@@ -26,20 +26,17 @@ def plot_image(ax, img, size=None, vrange=None):
     * `size` (int): The size to crop/pad the image to.
     * `vrange` (tuple): The image stretch range.
 
+    ## Returns
+
+    * `im` (matplotlib.image.AxesImage): The image artist.
+
     """
-    if vrange is None:
-        a, b = np.median(img), np.max(img)
-        vmin, vmax = a - 0.2 * b, a + b
-    else:
-        vmin, vmax = vrange
+    vmin, vmax = _get_range(img, vrange)
 
     if size is None:
         size = np.mean(img.shape)
 
-    # Invert the image.
-    vmin, vmax = -vmax, -vmin
-
-    ax.imshow(-img, cmap="gray", interpolation="nearest",
+    im = ax.imshow(-img, cmap="gray", interpolation="nearest",
             vmin=vmin, vmax=vmax)
 
     # Crop/pad to the right size.
@@ -48,19 +45,27 @@ def plot_image(ax, img, size=None, vrange=None):
     ax.set_xlim(xmin, xmax)
     ax.set_ylim(ymin, ymax)
 
+    return im
 
-def estimate_sigma(scene, nsigma=3.5, tol=0.0):
-    img = scene.flatten()
-    mask = ~np.isnan(img)
-    ms_old = 0.0
-    for i in range(500):
-        m = np.median(img[mask])
-        ms = np.mean((img[mask] - m) ** 2)
-        mask = (img - m) ** 2 < nsigma ** 2 * ms
-        if i > 1 and np.abs(ms - ms_old) < tol:
-            break
-        ms_old = ms
-    return np.sqrt(ms)
+
+def _get_range(img, vrange=None):
+    """
+    Get the (inverted) stretch range for an image.
+
+    """
+    if vrange is None:
+        a, b = stats.median(img), np.max(img)
+        vmin, vmax = a - 0.2 * b, a + b
+    else:
+        vmin, vmax = vrange
+
+    # Invert the image.
+    return -vmax, -vmin
+
+
+def estimate_sigma(scene, nsigma=3.5, tol=0.0, subsample=None):
+    return stats.clipped_stats(scene, nsigma=nsigma, maxiter=500, tol=tol,
+            subsample=subsample)[1]
 
 
 def plot_inference_step(fig, data, old_scene, new_scene, dpsf, dlds,
@@ -74,84 +79,127 @@ def plot_inference_step(fig, data, old_scene, new_scene, dpsf, dlds,
 
     * `fig` (matplotlib.Figure): The figure to clear and plot into.
     * `data` (numpy.ndarray): The data image.
-    * `this_scene` (numpy.ndarray): The scene implied by _this datapoint
-      only_.
+    * `old_scene` (numpy.ndarray): The scene before the update.
     * `new_scene` (numpy.ndarray): The updated scene.
     * `dpsf` (numpy.ndarray): The deconvolved PSF image.
-    * `kernel` (numpy.ndarray): The user-defined kernel.
+    * `dlds` (numpy.ndarray): The gradient of the likelihood.
 
     """
-    fig.clf()
-    fig.subplots_adjust(left=0.02, bottom=0.02, right=0.98, top=0.95,
-            wspace=0.05, hspace=0.1)
+    InferencePlotter(fig).plot(data, old_scene, new_scene, dpsf, dlds,
+            meta=meta, sky=sky, dc=dc)
 
-    # Build the subplots.
+
+class InferencePlotter(object):
+    """
+    Plot a sequence of update steps into the same figure. The layout and
+    the image artists are built on the first call to `plot` and only the
+    data and the stretches are updated after that.
+
+    ## Arguments
+
+    * `fig` (matplotlib.Figure): The figure to plot into.
+
+    """
     rows, cols = 2, 3
-    axes = []
-
-    for ri, ci in itertools.product(range(rows), range(cols)):
-        axes.append(fig.add_subplot(rows, cols, ri * cols + ci + 1))
-        axes[-1].set_xticklabels([])
-        axes[-1].set_yticklabels([])
-
-    # Calculate stretch.
-    scene_sigma = estimate_sigma(new_scene)
-    data_sigma = estimate_sigma(data)
-
-    # scene_range = np.array([-2.5, 5]) * sigma
-
-    # Compute the predicted image.
-    predicted = convolve(old_scene, dpsf, mode="valid")
-
-    # Medians.
-    scene_median = np.median(new_scene)
-    data_median = np.median(data)
-
-    # Arcsinh.
-    asinh = lambda img, mu, sigma, f: f * np.arcsinh((img - mu) / sigma) + 0.2
-    plot_scene = asinh(new_scene, 0.0, scene_sigma, 0.15)
-    plot_data = asinh(data, sky, data_sigma, 0.2)
-    plot_predicted = asinh(predicted, 0.0, data_sigma, 0.2)
-
-    # Set up which data will go in which panel.
-    norm = np.sum(dpsf)
-    panels = [
-        [("Scene", plot_scene, [0, 1]),
-         ("PSF", dpsf),
-         (r"$\mathrm{d}\ell / \mathrm{d} s$", dlds)],
-        [("Predicted", plot_predicted, [0, 1]),
-         ("Data", plot_data, [0, 1]),
-         ("annotations", None)]]
-
-    # Do the plotting.
-    size = data.shape[0]  # The size to pad/crop to.
-    for i, (ri, ci) in enumerate(itertools.product(range(rows), range(cols))):
-        ax = axes[i]
-        panel = panels[ri][ci]
-        title, content = panel[0], panel[1]
-        if len(panel) > 2:
-            vrange = panel[2]
-        else:
-            vrange = None
-
-        if content is not None:
-            plot_image(ax, content, size=size, vrange=vrange)
-            ax.set_title(title)
-        elif title == "annotations":
-            # Put some stats in this axis.
-            line_height = 0.13
-            txt = meta
-            txt.append("Sky: {0:0.4f}".format(sky))
-            txt.append(r"$\sum \mathrm{{dPSF}} = {0:.4f}$"
-                    .format(norm))
-            txt.append("median(Data) = {0:.4f}".format(data_median))
-            txt.append("median(New Scene) = {0:.4f}"
-                    .format(scene_median))
-
-            for i in range(len(txt)):
-                ax.text(0, 1 - i * line_height, txt[i], ha="left", va="top",
-                        transform=ax.transAxes)
-
-            ax.set_axis_off()
+
+    def __init__(self, fig):
+        self.fig = fig
+        self.images = None
+        self.texts = None
+        self.text_ax = None
+        self.shapes = None
+
+    def _setup(self, panels, size):
+        self.fig.clf()
+        self.fig.subplots_adjust(left=0.02, bottom=0.02, right=0.98,
+                top=0.95, wspace=0.05, hspace=0.1)
+
+        self.images, self.texts = [], []
+        for i, (title, content, vrange) in enumerate(panels):
+            ax = self.fig.add_subplot(self.rows, self.cols, i + 1)
+            ax.set_xticklabels([])
+            ax.set_yticklabels([])
+
+            if content is not None:
+                self.images.append(plot_image(ax, content, size=size,
+                    vrange=vrange))
+                ax.set_title(title)
+            else:
+                # This axis is used for the annotations.
+                self.text_ax = ax
+                ax.set_axis_off()
+
+        self.shapes = [p[1].shape for p in panels if p[1] is not None]
+
+    def plot(self, data, old_scene, new_scene, dpsf, dlds, meta=[], sky=0.0,
+            dc=0.0, sigmas=None):
+        """
+        Plot the images produced by a single update step.
+
+        ## Arguments
+
+        * `data` (numpy.ndarray): The data image.
+        * `old_scene` (numpy.ndarray): The scene before the update.
+        * `new_scene` (numpy.ndarray): The updated scene.
+        * `dpsf` (numpy.ndarray): The deconvolved PSF image.
+        * `dlds` (numpy.ndarray): The gradient of the likelihood.
+
+        ## Keyword Arguments
+
+        * `meta` (list): Extra lines of text for the annotations.
+        * `sky` (float): The sky level.
+        * `sigmas` (tuple): The noise levels `(scene_sigma, data_sigma)`
+          used for the stretch. These are estimated from the images if not
+          provided. Use the same values for a whole sequence to save time
+          and get a consistent stretch.
+
+        """
+        # Calculate stretch.
+        if sigmas is None:
+            sigmas = (estimate_sigma(new_scene), estimate_sigma(data))
+        scene_sigma, data_sigma = sigmas
+
+        # Compute the predicted image.
+        predicted = convolve(old_scene, dpsf, mode="valid")
+
+        # Arcsinh.
+        asinh = lambda img, mu, sigma, f: f * np.arcsinh((img - mu) / sigma) \
+                + 0.2
+        plot_scene = asinh(new_scene, 0.0, scene_sigma, 0.15)
+        plot_data = asinh(data, sky, data_sigma, 0.2)
+        plot_predicted = asinh(predicted, 0.0, data_sigma, 0.2)
+
+        # Set up which data will go in which panel.
+        panels = [("Scene", plot_scene, [0, 1]),
+                  ("PSF", dpsf, None),
+                  (r"$\mathrm{d}\ell / \mathrm{d} s$", dlds, None),
+                  ("Predicted", plot_predicted, [0, 1]),
+                  ("Data", plot_data, [0, 1]),
+                  ("annotations", None, None)]
+
+        # Only build the figure if the layout has changed.
+        shapes = [p[1].shape for p in panels if p[1] is not None]
+        if self.images is None or shapes != self.shapes:
+            self._setup(panels, data.shape[0])
         else:
-            ax.set_axis_off()
+            contents = [p for p in panels if p[1] is not None]
+            for im, (title, content, vrange) in zip(self.images, contents):
+                im.set_data(-content)
+                im.set_clim(*_get_range(content, vrange))
+
+        # Update the annotations.
+        txt = list(meta)
+        txt.append("Sky: {0:0.4f}".format(sky))
+        txt.append(r"$\sum \mathrm{{dPSF}} = {0:.4f}$"
+                .format(np.sum(dpsf)))
+        txt.append("median(Data) = {0:.4f}".format(stats.median(data)))
+        txt.append("median(New Scene) = {0:.4f}"
+                .format(stats.median(new_scene)))
+
+        # Put some stats in the annotation axis.
+        line_height = 0.13
+        for i in range(len(self.texts), len(txt)):
+            self.texts.append(self.text_ax.text(0, 1 - i * line_height, "",
+                ha="left", va="top", transform=self.text_ax.transAxes))
+        for i, t in enumerate(self.texts):
+            t.set_text(txt[i] if i < len(txt) else "")
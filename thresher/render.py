@@ -0,0 +1,285 @@
+"""
+This file is part of The Thresher.
+
+Render the snapshots written by `Scene.save` to PNGs.
+
+"""
+
+__all__ = ["load_state", "plot_state", "estimate_stretch", "render_batch",
+           "MonitorRenderer"]
+
+import os
+import json
+import time
+import signal
+import logging
+import threading
+import multiprocessing
+
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from plotting import InferencePlotter
+from snapshots import load_state, estimate_stretch
+
+
+def _figure():
+    # Render with Agg directly so that no display is needed (in particular
+    # in the worker processes) and the figures aren't tracked by pyplot.
+    fig = Figure(figsize=(16, 12))
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def _png_name(fn, outdir):
+    return os.path.join(outdir, os.path.split(os.path.splitext(fn)[0])[1]
+            + ".png")
+
+
+def plot_state(fn, outdir, fig=None, plotter=None, sigmas=None):
+    """
+    Plot the state of the inference saved in a snapshot file.
+
+    ## Arguments
+
+    * `fn` (str): The path to the snapshot written by `Scene.save`.
+    * `outdir` (str): The directory where the PNG should be saved.
+
+    ## Keyword Arguments
+
+    * `fig` (matplotlib.Figure): The figure to plot into. A new one is
+      created if this isn't provided.
+    * `plotter` (InferencePlotter): A plotter to reuse. If this is given,
+      `fig` is ignored.
+    * `sigmas` (tuple): The shared stretch. See `InferencePlotter.plot`.
+
+    ## Returns
+
+    * `imgfn` (str): The path to the saved image or `None` if the snapshot
+      couldn't be read.
+
+    """
+    state = load_state(fn)
+    if state is None:
+        return None
+
+    imgfn = _png_name(fn, outdir)
+
+    if plotter is None:
+        if fig is None:
+            fig = _figure()
+        plotter = InferencePlotter(fig)
+
+    try:
+        plotter.plot(state["data"], state["old_scene"], state["new_scene"],
+                state["psf"], state["dlds"], meta=state["meta"],
+                sky=state["sky"], dc=state["dc"], sigmas=sigmas)
+        logging.info("Saving figure to: {0}".format(imgfn))
+        plotter.fig.savefig(imgfn)
+    except ValueError:
+        logging.warn("Got a value error. Couldn't save {0}.".format(imgfn))
+        return None
+
+    return imgfn
+
+
+# Each worker process keeps its own figure around.
+_worker_plotter = None
+_worker_sigmas = None
+
+
+def _init_worker(sigmas=None):
+    global _worker_plotter, _worker_sigmas
+    _worker_plotter = InferencePlotter(_figure())
+    _worker_sigmas = sigmas
+
+
+def _init_pool_worker(sigmas=None):
+    # Leave Ctrl-C to the parent so that a worker isn't killed in the middle
+    # of a job, which would leave its result hanging.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _init_worker(sigmas)
+
+
+def _render(args):
+    fn, outdir = args
+    return plot_state(fn, outdir, plotter=_worker_plotter,
+            sigmas=_worker_sigmas)
+
+
+def render_batch(fns, outdir, nproc=1, clobber=False, sigmas=None):
+    """
+    Render a sequence of snapshots. The stretch is estimated once for the
+    whole sequence, the figure layout is only built once per process and
+    the snapshots that have already been rendered are skipped. The stretch
+    is saved to `stretch.json` in `outdir` so that the snapshots rendered
+    by a later call match the earlier ones.
+
+    ## Arguments
+
+    * `fns` (list): The snapshot files.
+    * `outdir` (str): The directory where the PNGs should be saved.
+
+    ## Keyword Arguments
+
+    * `nproc` (int): The number of processes to use.
+    * `clobber` (bool): Re-render snapshots that already have a PNG that is
+      newer than the snapshot.
+    * `sigmas` (tuple): The shared stretch. If this isn't given, the saved
+      stretch is used or it is estimated from all of `fns` using
+      `estimate_stretch`.
+
+    ## Returns
+
+    * `imgfns` (list): The images that were saved.
+
+    """
+    todo = fns
+    if not clobber:
+        todo = [fn for fn in fns
+                if not os.path.exists(_png_name(fn, outdir))
+                or os.path.getmtime(_png_name(fn, outdir))
+                   < os.path.getmtime(fn)]
+    if not len(todo):
+        return []
+
+    if sigmas is None:
+        stretchfn = os.path.join(outdir, "stretch.json")
+        if not clobber and os.path.exists(stretchfn):
+            with open(stretchfn) as f:
+                sigmas = tuple(json.load(f))
+        else:
+            sigmas = estimate_stretch(fns)
+            if sigmas is not None:
+                with open(stretchfn, "w") as f:
+                    json.dump(map(float, sigmas), f)
+
+    jobs = [(fn, outdir) for fn in sorted(todo)]
+    if nproc > 1:
+        pool = multiprocessing.Pool(nproc, initializer=_init_pool_worker,
+                initargs=(sigmas,))
+        imgfns = pool.map(_render, jobs,
+                chunksize=max(1, len(jobs) // (4 * nproc)))
+        pool.close()
+        pool.join()
+    else:
+        _init_worker(sigmas)
+        imgfns = map(_render, jobs)
+
+    imgfns = [fn for fn in imgfns if fn is not None]
+    if len(imgfns) < len(jobs):
+        logging.warn("Couldn't render {0} of {1} snapshots."
+                     .format(len(jobs) - len(imgfns), len(jobs)))
+    return imgfns
+
+
+class MonitorRenderer(object):
+    """
+    Render snapshots as they are written by a running inference.
+
+    The file system events are debounced per file: a snapshot is only
+    rendered once no event has been seen for it in `debounce` seconds. The
+    rendering is done in a pool of worker processes and, if the snapshots
+    come in faster than they can be rendered, only the most recent ones are
+    kept and the intermediate frames are dropped. Errors in the workers are
+    logged and counted in `failed`.
+
+    ## Arguments
+
+    * `outdir` (str): The directory where the PNGs should be saved.
+
+    ## Keyword Arguments
+
+    * `nproc` (int): The number of worker processes.
+    * `debounce` (float): The quiet time (in seconds) before a file is
+      considered to be complete.
+
+    """
+    def __init__(self, outdir, nproc=1, debounce=0.5):
+        self.outdir = outdir
+        self.nproc = max(1, int(nproc))
+        self.debounce = debounce
+        self.pending = {}
+        self.inflight = []
+        self.dropped = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._pool = multiprocessing.Pool(self.nproc,
+                initializer=_init_pool_worker)
+
+    def notify(self, fn):
+        """
+        Register an event for a file. Only completed snapshots (with a
+        `.fits` extension; `Scene.save` writes to a temporary file first)
+        are considered.
+
+        """
+        if os.path.splitext(fn)[1].lower() != ".fits":
+            return
+        with self._lock:
+            self.pending[fn] = time.time()
+
+    def poll(self):
+        """
+        Submit the files that have settled to the worker pool. This should
+        be called periodically from the main thread.
+
+        """
+        now = time.time()
+        with self._lock:
+            ready = sorted([fn for fn, t in self.pending.iteritems()
+                            if now - t >= self.debounce])
+            for fn in ready:
+                del self.pending[fn]
+        ready = [fn for fn in ready if os.path.exists(fn)]
+
+        # Forget about the finished jobs.
+        self._collect()
+
+        # Under backlog, drop the intermediate frames and only keep the
+        # newest ones to stay real-time.
+        free = max(self.nproc - len(self.inflight), 0)
+        keep = max(free, 1)
+        if len(ready) > keep:
+            self.dropped += len(ready) - keep
+            logging.info("Dropping {0} frames to keep up."
+                    .format(len(ready) - keep))
+            ready = ready[-keep:]
+
+        # If all the workers are busy, hang on to the newest frame until the
+        # next poll.
+        if free == 0:
+            with self._lock:
+                for fn in ready:
+                    self.pending.setdefault(fn, now - self.debounce)
+            return
+
+        for fn in ready:
+            self.inflight.append(self._pool.apply_async(_render,
+                ((fn, self.outdir),)))
+
+    def _collect(self, wait=False):
+        # Check the results of the finished (or, if `wait`, all) jobs.
+        inflight = []
+        for r in self.inflight:
+            if not wait and not r.ready():
+                inflight.append(r)
+                continue
+            try:
+                r.get()
+            except Exception as e:
+                self.failed += 1
+                logging.warn("Rendering failed: {0!r}".format(e))
+        self.inflight = inflight
+
+    def close(self):
+        """
+        Wait for the submitted snapshots to be rendered and shut down the
+        workers.
+
+        """
+        self._pool.close()
+        try:
+            self._collect(wait=True)
+        finally:
+            self._pool.join()
@@ -0,0 +1,92 @@
+"""
+This file is part of The Thresher.
+
+Read the snapshots written by `Scene.save`. This doesn't use matplotlib so
+that the snapshots can be turned into a movie without it.
+
+"""
+
+__all__ = ["load_state", "estimate_stretch"]
+
+import os
+import logging
+
+import numpy as np
+import pyfits
+
+from plotting import estimate_sigma
+
+
+def load_state(fn):
+    """
+    Load the state of the inference saved in a snapshot file.
+
+    ## Arguments
+
+    * `fn` (str): The path to the snapshot written by `Scene.save`.
+
+    ## Returns
+
+    * `state` (dict): The images and metadata from the snapshot or `None` if
+      it couldn't be read.
+
+    """
+    try:
+        hdus = pyfits.open(fn)
+        if len(hdus) < 6:
+            # The snapshots of a `TiledScene` only have the mosaic, the
+            # data and the PSFs.
+            logging.warn("{0} isn't a full Scene snapshot. Skipping it."
+                         .format(fn))
+            hdus.close()
+            return None
+        state = dict(new_scene=np.array(hdus[0].data, dtype=float),
+                     dlds=np.array(hdus[1].data, dtype=float),
+                     data=np.array(hdus[2].data, dtype=float),
+                     psf=np.array(hdus[3].data, dtype=float),
+                     old_scene=np.array(hdus[5].data, dtype=float))
+        header = hdus[0].header
+        state["meta"] = ["Image {0:d}".format(header.get("image")),
+                os.path.split(header.get("datafn"))[-1].replace("_", "\\_")]
+        state["sky"] = float(header.get("sky"))
+        state["dc"] = float(header.get("dc"))
+        hdus.close()
+    except (ValueError, IndexError, IOError):
+        # The file is still being written or it was removed.
+        return None
+    return state
+
+
+def estimate_stretch(fns, nsamples=10, subsample=250000):
+    """
+    Estimate a stretch that can be shared by a whole sequence of snapshots
+    using the median of the noise estimates from a few of them.
+
+    ## Arguments
+
+    * `fns` (list): The snapshot files.
+
+    ## Keyword Arguments
+
+    * `nsamples` (int): The number of snapshots to use.
+    * `subsample` (int): The number of pixels used for the noise estimate
+      of each image (see `stats.clipped_stats`).
+
+    ## Returns
+
+    * `sigmas` (tuple): The noise levels `(scene_sigma, data_sigma)`.
+
+    """
+    fns = sorted(fns)
+    inds = np.unique(np.linspace(0, len(fns) - 1, nsamples).astype(int))
+    sigmas = []
+    for i in inds:
+        state = load_state(fns[i])
+        if state is not None:
+            sigmas.append([estimate_sigma(state["new_scene"],
+                                          subsample=subsample),
+                           estimate_sigma(state["data"],
+                                          subsample=subsample)])
+    if not len(sigmas):
+        return None
+    return tuple(np.median(sigmas, axis=0))
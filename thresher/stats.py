@@ -0,0 +1,109 @@
+"""
+This file is part of The Thresher.
+
+Fast robust statistics shared by the inference, TLI and plotting code.
+
+"""
+
+__all__ = ["median", "clipped_stats"]
+
+import numpy as np
+
+
+def median(x):
+    """
+    The median of the finite values in an array computed by selection
+    (`numpy.partition`) instead of a full sort.
+
+    ## Arguments
+
+    * `x` (numpy.ndarray): The values.
+
+    ## Returns
+
+    * `median` (float): The median. This is `nan` if there are no finite
+      values.
+
+    """
+    x = np.asarray(x, dtype=float).flatten()
+    x = x[np.isfinite(x)]
+    n = len(x)
+    if n == 0:
+        return np.nan
+
+    k = n // 2
+    if n % 2:
+        return np.partition(x, k)[k]
+    p = np.partition(x, [k - 1, k])
+    return 0.5 * (p[k - 1] + p[k])
+
+
+def clipped_stats(x, nsigma=2.5, maxiter=100, tol=0.0, subsample=None,
+        seed=0):
+    """
+    Iterative sigma-clipping. At each iteration, the median and the RMS
+    deviation from the median are computed using only the values within
+    `nsigma` of the previous estimate.
+
+    The finite values are sorted once so that the set of values that
+    survive the clipping is always a contiguous window. Each iteration then
+    only needs two binary searches to update the window, a lookup for the
+    median and cumulative sums for the RMS.
+
+    ## Arguments
+
+    * `x` (numpy.ndarray): The values. Non-finite values are ignored.
+
+    ## Keyword Arguments
+
+    * `nsigma` (float): The clipping threshold in units of the RMS.
+    * `maxiter` (int): The maximum number of iterations.
+    * `tol` (float): Stop when the RMS changes by less than this.
+    * `subsample` (int): If there are more than this many values, estimate
+      the statistics from a random subsample of this size.
+    * `seed` (int): The seed for the random subsample.
+
+    ## Returns
+
+    * `mu` (float): The clipped median.
+    * `sigma` (float): The clipped RMS deviation from the median.
+
+    """
+    x = np.asarray(x, dtype=float).flatten()
+    x = x[np.isfinite(x)]
+    if subsample is not None and len(x) > subsample:
+        x = x[np.random.RandomState(seed).randint(len(x), size=subsample)]
+    if len(x) == 0:
+        return np.nan, np.nan
+    x = np.sort(x)
+
+    # Cumulative sums of the values relative to the full median so that the
+    # mean square in any window can be computed without cancellation
+    # problems.
+    x0 = x[len(x) // 2]
+    s1 = np.append(0.0, np.cumsum(x - x0))
+    s2 = np.append(0.0, np.cumsum((x - x0) ** 2))
+
+    lo, hi = 0, len(x)
+    mu, sigma = x0, np.inf
+    for i in range(maxiter):
+        n = hi - lo
+        if n <= 0:
+            break
+
+        # The median and mean square deviation in the current window.
+        mu = 0.5 * (x[lo + (n - 1) // 2] + x[lo + n // 2])
+        d = mu - x0
+        ms = (s2[hi] - s2[lo] - 2 * d * (s1[hi] - s1[lo])) / n + d * d
+        newsigma = np.sqrt(max(ms, 0.0))
+
+        converged = np.abs(newsigma - sigma) <= tol
+        sigma = newsigma
+        if converged:
+            break
+
+        # Update the window.
+        lo = np.searchsorted(x, mu - nsigma * sigma, side="right")
+        hi = np.searchsorted(x, mu + nsigma * sigma, side="left")
+
+    return mu, sigma
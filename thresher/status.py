@@ -0,0 +1,138 @@
+"""
+This file is part of The Thresher.
+
+Publish the progress of a long running inference to a JSON status file
+and, optionally, a tiny HTTP endpoint on localhost.
+
+"""
+
+__all__ = ["StatusReporter"]
+
+import os
+import json
+import time
+import logging
+import threading
+from collections import deque
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = self.server.reporter.latest
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StatusReporter(object):
+    """
+    Keep track of the progress of a run and publish it periodically.
+
+    Calling `update` only does a few arithmetic operations. The status is
+    only serialized at most every `interval` seconds and the file is
+    written to a temporary file first and then moved into place so that a
+    reader never sees a partial file.
+
+    ## Keyword Arguments
+
+    * `fn` (str): The path to the status file.
+    * `port` (int): Serve the status at `http://127.0.0.1:{port}/`.
+    * `interval` (float): The minimum time between updates (in seconds).
+    * `total` (int): The total number of frames in the run (for the ETA).
+    * `history` (int): The number of recent sky and PSF values to keep.
+
+    """
+    def __init__(self, fn=None, port=None, interval=5.0, total=None,
+            history=10):
+        self.fn = fn
+        self.interval = interval
+        self.total = total
+        self.nframes = 0
+        self.skies = deque(maxlen=history)
+        self.psf_sums = deque(maxlen=history)
+        self.t0 = time.time()
+        self._last = None
+        self.latest = json.dumps(dict(state="starting"))
+
+        self._server = None
+        if port is not None:
+            self._server = HTTPServer(("127.0.0.1", int(port)), _Handler)
+            self._server.reporter = self
+            thread = threading.Thread(target=self._server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            logging.info("Serving the status at http://127.0.0.1:{0}/"
+                         .format(self._server.server_port))
+
+    def update(self, pass_number, img_number, sky=None, psf_sum=None,
+            stages=None, force=False):
+        """
+        Register a finished frame.
+
+        ## Arguments
+
+        * `pass_number` (int): The current pass.
+        * `img_number` (int): The index of the frame within the pass.
+
+        ## Keyword Arguments
+
+        * `sky` (float): The sky level inferred for the frame.
+        * `psf_sum` (float): The sum of the PSF inferred for the frame.
+        * `stages` (dict): The latest per-stage timings.
+        * `force` (bool): Publish now even if the interval hasn't passed.
+
+        """
+        self.nframes += 1
+        if sky is not None:
+            self.skies.append(float(sky))
+        if psf_sum is not None:
+            self.psf_sums.append(float(psf_sum))
+
+        now = time.time()
+        if not force and self._last is not None \
+                and now - self._last < self.interval:
+            return
+        self._last = now
+        self.publish(pass_number=pass_number, img_number=img_number,
+                     stages=stages)
+
+    def publish(self, state="running", **status):
+        """
+        Serialize the current status and write it out.
+
+        """
+        dt = time.time() - self.t0
+        fps = self.nframes / dt if dt > 0 else 0.0
+        eta = None
+        if self.total is not None and fps > 0:
+            eta = max(self.total - self.nframes, 0) / fps
+        status.update(state=state, nframes=self.nframes, total=self.total,
+                      elapsed=dt, frames_per_second=fps, eta=eta,
+                      sky=list(self.skies), psf_sum=list(self.psf_sums),
+                      updated=time.strftime("%Y-%m-%dT%H:%M:%S"))
+        self.latest = json.dumps(status)
+
+        if self.fn is not None:
+            tmpfn = os.path.join(os.path.dirname(self.fn),
+                    "." + os.path.basename(self.fn) + ".part")
+            with open(tmpfn, "w") as f:
+                f.write(self.latest)
+            os.rename(tmpfn, self.fn)
+
+    def close(self, **status):
+        """
+        Publish the final status and shut down the server.
+
+        """
+        self.publish(state="finished", **status)
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
@@ -0,0 +1,168 @@
+"""
+This file is part of The Thresher.
+
+Run a grid of inference settings on the same data. The frames are prepared
+once into a memory-mapped `FrameStore` that all the runs read from and the
+runs are spread over a pool of processes.
+
+"""
+
+__all__ = ["parameter_grid", "run_sweep", "save_summary"]
+
+import os
+import time
+import logging
+import itertools
+import multiprocessing
+
+import numpy as np
+import pyfits
+
+import utils
+from thresher import Scene
+from frames import FrameStore
+
+# The settings that can be swept and their defaults.
+PARAMETERS = [("alpha", 2.0), ("beta", 1.0), ("psfreg", 0.0),
+              ("sceneL2", 0.0), ("dc", 0.0), ("psf_hw", 13)]
+
+
+def parameter_grid(**grid):
+    """
+    Expand lists of values for the parameters in `PARAMETERS` into the list
+    of all their combinations. Missing parameters get their default value.
+
+    """
+    names = [k for k, v in PARAMETERS]
+    for k in grid:
+        if k not in names:
+            raise ValueError("Unknown parameter: {0}".format(k))
+    values = [np.atleast_1d(grid.get(k, [v])).tolist() for k, v in PARAMETERS]
+    return [dict(zip(names, v)) for v in itertools.product(*values)]
+
+
+# The shared state of the runs. This is set in each worker process by the
+# pool initializer.
+_worker_setup = None
+
+
+def _init_worker(setup):
+    global _worker_setup
+    _worker_setup = dict(setup, store=FrameStore(setup["store"]))
+
+
+def _run(args):
+    i, params = args
+    setup = _worker_setup
+    outdir = os.path.join(setup["outdir"], "config-{0:03d}".format(i))
+    try:
+        os.makedirs(outdir)
+    except os.error:
+        pass
+
+    # The scene only needs to be padded by the PSF half width of this run.
+    hw = int(params["psf_hw"])
+    d = setup["max_hw"] - hw
+    initial = setup["initial"]
+    initial = initial[d:initial.shape[0] - d, d:initial.shape[1] - d]
+
+    t = time.time()
+    scene = Scene(initial, list(setup["image_list"]), outdir=outdir,
+            psf_hw=hw, psfreg=params["psfreg"], sceneL2=params["sceneL2"],
+            dc=params["dc"], store=setup["store"], **setup["scene_kwargs"])
+    scene.run_inference(alpha=params["alpha"], beta=params["beta"],
+                        status=None, **setup["run_kwargs"])
+    pyfits.PrimaryHDU(scene.scene).writeto(os.path.join(outdir,
+                                                        "final.fits"),
+                                           clobber=True)
+
+    last = scene.convergence[-1] if len(scene.convergence) else {}
+    return dict(params, config=i, outdir=outdir,
+                npasses=len(scene.convergence),
+                chi2=last.get("mean_chi2", np.nan),
+                scene_change=last.get("scene_change", np.nan),
+                time=time.time() - t)
+
+
+def run_sweep(initial, image_list, grid, outdir, nproc=1, mask_list=None,
+        centers=None, hdu=0, invert=False, square=False, scene_kwargs={},
+        run_kwargs={}):
+    """
+    Run the inference for every setting in a grid.
+
+    ## Arguments
+
+    * `initial` (numpy.ndarray): The initial scene. This includes the
+      padding for the largest PSF in the grid and the data regions of all
+      the runs are the same.
+    * `image_list` (list): The list of images to thresh.
+    * `grid` (list): The settings for each run (see `parameter_grid`).
+    * `outdir` (str): The output directory. Each run writes its files to
+      `config-{i}` and the frames are stored in `frames`.
+
+    ## Keyword Arguments
+
+    * `nproc` (int): The number of processes.
+    * `mask_list`, `centers`, `hdu`, `invert`, `square`: See `Scene`.
+    * `scene_kwargs` (dict): Other arguments for each `Scene`.
+    * `run_kwargs` (dict): Other arguments for `Scene.run_inference`.
+
+    ## Returns
+
+    * `results` (list): The settings and the final reduced chi-squared,
+      scene change, number of passes and run time of each run.
+
+    """
+    initial = np.array(initial, dtype=float)
+    max_hw = max(int(p["psf_hw"]) for p in grid)
+    shape = tuple(n - 2 * max_hw for n in initial.shape)
+
+    # Load every frame once.
+    store = FrameStore.create(os.path.join(outdir, "frames"), image_list,
+            shape, mask_list=mask_list, centers=centers, hdu=hdu,
+            invert=invert, square=square)
+
+    # Build the index arrays for each PSF size before forking so that the
+    # workers share them.
+    for hw in set(int(p["psf_hw"]) for p in grid):
+        utils.unravel_scene((shape[0] + 2 * hw, shape[1] + 2 * hw), hw)
+        utils.unravel_psf((shape[0] + 2 * hw, shape[1] + 2 * hw), hw)
+
+    setup = dict(initial=initial, image_list=list(image_list),
+                 outdir=outdir, max_hw=max_hw, store=store.path,
+                 scene_kwargs=dict(scene_kwargs, mask_list=mask_list,
+                                   centers=centers, hdu=hdu, invert=invert,
+                                   square=square),
+                 run_kwargs=run_kwargs)
+    jobs = list(enumerate(grid))
+    logging.info("Running {0} configurations on {1} processes."
+                 .format(len(jobs), nproc))
+    if nproc > 1:
+        pool = multiprocessing.Pool(nproc, initializer=_init_worker,
+                initargs=(setup,))
+        results = pool.map(_run, jobs, chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        _init_worker(setup)
+        results = map(_run, jobs)
+
+    return results
+
+
+def save_summary(results, fn):
+    """
+    Save the results of a sweep as a FITS table.
+
+    """
+    col = lambda k: np.array([r[k] for r in results])
+    cols = [pyfits.Column(name="config", format="J", array=col("config"))]
+    for k, v in PARAMETERS:
+        cols.append(pyfits.Column(name=k, format="J" if k == "psf_hw"
+                                  else "D", array=col(k)))
+    cols += [pyfits.Column(name="chi2", format="D", array=col("chi2")),
+             pyfits.Column(name="scene_change", format="D",
+                           array=col("scene_change")),
+             pyfits.Column(name="npasses", format="J", array=col("npasses")),
+             pyfits.Column(name="time", format="D", array=col("time"))]
+    pyfits.new_table(pyfits.ColDefs(cols)).writeto(fn, clobber=True)
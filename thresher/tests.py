@@ -6,12 +6,37 @@ A set of unit tests.
 """
 
 import os
+import json
+import time
+import shutil
+import urllib2
+import tempfile
+
 import numpy as np
+import matplotlib
+matplotlib.use("Agg")  # The tests that plot shouldn't need a display.
+import matplotlib.pyplot as pl
+import pyfits
 
 from scipy.sparse import csr_matrix
 
 import thresher
 import utils
+import tli
+import diagnostics
+import stats
+import make_fake
+import status
+import optimizers
+import multires
+import multiscene
+import tiles
+import frames
+import sweep
+import live
+import plotting
+import render
+import movie
 
 
 class Tests(object):
@@ -79,6 +104,14 @@ class Tests(object):
 
         assert np.all(rows == b_rows) and np.all(cols == b_cols)
 
+        # Only the most recent geometries are cached.
+        utils.unravel_psf.cache_clear()
+        for s in range(4, 30):
+            utils.unravel_psf(s, P)
+        assert len(utils.unravel_psf.cache) == 16
+        assert utils.unravel_psf(29, P) is utils.unravel_psf(29, P)
+        assert (4, 4) not in [k[0] for k in utils.unravel_psf.cache]
+
     def test_convolution(self):
         """
         Test that the matrix operation and convolution give the same result.
@@ -178,6 +211,786 @@ class Tests(object):
 
         print psf
 
+    def test_rectangular(self):
+        """
+        Check the index utilities and the model of a rectangular scene
+        against a direct convolution.
+
+        """
+        np.random.seed(42)
+        hw = 2
+        initial = np.random.rand(11, 16)
+        psf = np.random.rand(2 * hw + 1, 2 * hw + 1)
+
+        scene = thresher.Scene(initial, [], psf_hw=hw)
+        assert scene.shape == (7, 12) and scene.size == (7, 12)
+        assert scene.scene_mask.shape == (7 * 12, (2 * hw + 1) ** 2)
+
+        # The PSF matrix gives the convolution of the scene with the PSF.
+        scene.psf = psf
+        model = scene.get_psf_matrix(L2=False).dot(scene.scene.flatten())
+        np.testing.assert_allclose(model.reshape(scene.shape),
+                thresher.convolve(scene.scene, psf, mode="valid"))
+
+        # Trimming and centroiding.
+        img = np.arange(200.).reshape((10, 20))
+        assert utils.trim_image(img, (6, 8)).shape == (6, 8)
+        np.testing.assert_allclose(utils.trim_image(img, (6, 8))[0, 0], 46.)
+        coords, data, mask = utils.centroid_image(img, (4, 6),
+                                                  coords=(5, 10))
+        assert data.shape == mask.shape == (4, 6)
+        np.testing.assert_allclose(data, img[3:7, 7:13])
+
+    def test_tli_cache(self):
+        """
+        Make sure that a second TLI pass using the frame cache gives the same
+        result as loading the data from disk.
+
+        """
+        d = tempfile.mkdtemp()
+        try:
+            np.random.seed(42)
+            fns = []
+            for i in range(5):
+                img = np.random.randn(32, 32)
+                img[10 + i, 12] += 50.0
+                fns.append(os.path.join(d, "{0}.fits".format(i)))
+                pyfits.PrimaryHDU(img).writeto(fns[-1])
+
+            cache = {}
+            r1 = tli.run_tli(fns, cache=cache)
+            assert sorted(cache.keys()) == sorted(fns)
+
+            # The second pass shouldn't touch the disk.
+            [os.remove(fn) for fn in fns]
+            r2 = tli.run_tli(fns, cache=cache)
+        finally:
+            shutil.rmtree(d)
+
+        assert r1[0] == r2[0]
+        np.testing.assert_allclose(r1[2], r2[2])
+        np.testing.assert_allclose(r1[-1], r2[-1])
+
+    def test_metrics(self):
+        """
+        Check the per-frame records and the summary of `utils.Metrics`.
+
+        """
+        d = tempfile.mkdtemp()
+        try:
+            fn = os.path.join(d, "metrics.jsonl")
+            metrics = utils.Metrics(fn)
+            for i in range(4):
+                metrics.start_frame(fn="{0}.fits".format(i))
+                with metrics.stage("io"):
+                    pass
+                metrics.add("bytes_read", 10)
+                metrics.add("bytes_read", i)
+                metrics.end_frame()
+            with metrics.stage("coadd"):
+                pass
+            metrics.close()
+            lines = [json.loads(l) for l in open(fn)]
+        finally:
+            shutil.rmtree(d)
+
+        assert len(lines) == 4
+        assert [l["bytes_read"] for l in lines] == [10, 11, 12, 13]
+        assert all([l["io"] >= 0 and "total" in l for l in lines])
+
+        summary = metrics.summary()
+        assert summary["nframes"] == 4
+        assert "fn" not in summary["stages"]
+        assert summary["stages"]["bytes_read"]["total"] == 46
+        assert summary["stages"]["bytes_read"]["p50"] == 11.5
+        assert "coadd" in summary["totals"]
+
+    def test_status(self):
+        """
+        Check that the status file and the HTTP endpoint are published.
+
+        """
+        d = tempfile.mkdtemp()
+        try:
+            fn = os.path.join(d, "status.json")
+            reporter = status.StatusReporter(fn=fn, port=0, interval=1e10,
+                                             total=10)
+            reporter.update(0, 0, sky=1.0, psf_sum=2.0)
+            reporter.update(0, 1, sky=3.0, psf_sum=2.0)
+            s = json.load(open(fn))
+            assert s["nframes"] == 1 and s["img_number"] == 0
+
+            reporter.update(0, 2, sky=3.0, psf_sum=2.0, force=True)
+            port = reporter._server.server_port
+            s = json.loads(urllib2.urlopen("http://127.0.0.1:{0}/"
+                                           .format(port)).read())
+            reporter.close()
+        finally:
+            shutil.rmtree(d)
+
+        assert s["nframes"] == 3 and s["total"] == 10
+        assert s["sky"] == [1.0, 3.0, 3.0]
+
+    def test_early_stopping(self):
+        """
+        Make sure that the inference stops once the scene has converged.
+
+        """
+        d = tempfile.mkdtemp()
+        try:
+            np.random.seed(42)
+            fns = []
+            for i in range(3):
+                img = make_fake.render_gaussian((20, 20), [[10, 9]], [100.],
+                                                1.5) + np.random.randn(20, 20)
+                fns.append(os.path.join(d, "{0}.fits".format(i)))
+                pyfits.PrimaryHDU(img + 5.0).writeto(fns[-1])
+
+            scene = thresher.Scene(np.array(img), fns, outdir=d, psf_hw=2)
+            scene.run_inference(npasses=5, thin=10, tol=np.inf, status=None,
+                                metrics=None)
+        finally:
+            shutil.rmtree(d)
+
+        assert len(scene.convergence) == 2
+        assert all([np.isfinite(c["mean_chi2"]) for c in scene.convergence])
+
+    def test_learning_rate(self):
+        """
+        The first pass uses the scalar rate `alpha / (beta + start + n)`.
+
+        """
+        d = tempfile.mkdtemp()
+        try:
+            np.random.seed(42)
+            fns = []
+            for i in range(3):
+                img = make_fake.render_gaussian((20, 20), [[10, 9]], [100.],
+                                                1.5) + np.random.randn(20, 20)
+                fns.append(os.path.join(d, "{0}.fits".format(i)))
+                pyfits.PrimaryHDU(img + 5.0).writeto(fns[-1])
+
+            rates = {}
+            for start in [0, 10]:
+                scene = thresher.Scene(np.array(img), fns, outdir=d,
+                                       psf_hw=2)
+                rates[start] = []
+                do_update = scene.do_update
+
+                def record(fn, alpha, rates=rates[start], **kwargs):
+                    rates.append(alpha)
+                    return do_update(fn, alpha, **kwargs)
+                scene.do_update = record
+                scene.run_inference(npasses=1, thin=10, alpha=2.0,
+                                    beta=1.0, status=None, metrics=None,
+                                    start=start)
+        finally:
+            shutil.rmtree(d)
+
+        for start, r in rates.iteritems():
+            assert all([np.isscalar(a) for a in r])
+            np.testing.assert_allclose(r, 2.0 / (1.0 + start + np.arange(3)))
+        assert rates[10][0] < rates[0][0]
+
+    def test_frame_rejection(self):
+        """
+        Test the PSF width and the rejection of frames with bad fits.
+
+        """
+        psf = make_fake.render_gaussian((21, 21), [[10.3, 9.8]], [1.], 2.0)
+        np.testing.assert_allclose(thresher.psf_width(psf), 2.0,
+                                   rtol=1e-3)
+
+        scene = thresher.Scene(np.zeros((24, 24)), [], psf_hw=2)
+        np.random.seed(42)
+        for i in range(50):
+            scene.frames[str(i)] = dict(chi2=1 + 0.1 * np.random.randn(),
+                    psf_sum=1 + 0.05 * np.random.randn(), rejected=False)
+        scene.frames["2"]["chi2"] = 10.0
+        scene.frames["7"]["psf_sum"] = 0.2
+        assert sorted(scene.reject_frames(5.0)) == ["2", "7"]
+        assert scene.frames["7"]["rejected"]
+        assert scene.reject_frames(5.0) == []
+
+    def test_importance_sampling(self):
+        """
+        Check that the importance weights give an unbiased mean.
+
+        """
+        fns = [str(i) for i in range(20)]
+        ranks = np.arange(20) + 1.0
+        scene = thresher.Scene(np.zeros((24, 24)), fns, psf_hw=2,
+                               ranks=ranks)
+        scene.frames["3"] = dict(rejected=True)
+
+        np.random.seed(42)
+        values = np.random.randn(20)
+        good = np.arange(20) != 3
+        estimates = []
+        for i in range(2000):
+            schedule, weights = scene.sample_frames(fns, "rank", mix=0.2)
+            assert "3" not in schedule
+            estimates.append(np.mean(weights * values[map(int, schedule)]))
+        np.testing.assert_allclose(np.mean(estimates),
+                                   np.sum(values[good]) / 20., atol=0.02)
+
+    def test_saga(self):
+        """
+        Once every frame has been seen, a SAGA step for a frame with an
+        unchanged gradient is the mean gradient.
+
+        """
+        np.random.seed(42)
+        grads = np.random.randn(5, 4, 4)
+        opt = optimizers.get_optimizer("saga")
+        for i, g in enumerate(grads):
+            np.testing.assert_allclose(opt.step(g, 0.5, key=i), 0.5 * g)
+        np.testing.assert_allclose(opt.step(grads[2], 0.5, key=2),
+                                   0.5 * np.mean(grads, axis=0), rtol=1e-5)
+
+    def test_polish(self):
+        """
+        Check that the full-batch polish fits all the frames.
+
+        """
+        d = tempfile.mkdtemp()
+        try:
+            np.random.seed(42)
+            truth = np.random.rand(20, 20) * 10
+            fns, psfs = [], []
+            for i in range(4):
+                psf = make_fake.render_gaussian((5, 5), [[2 + 0.3 * i, 2]],
+                                                [1.], 0.8 + 0.2 * i)
+                img = thresher.convolve(truth, psf, mode="valid") + i \
+                        + 0.01 * np.random.randn(16, 16)
+                fns.append(os.path.join(d, "{0}.fits".format(i)))
+                pyfits.PrimaryHDU(img).writeto(fns[-1])
+                psfs.append(psf)
+
+            scene = thresher.Scene(np.zeros((20, 20)), fns, psf_hw=2)
+            for i, fn in enumerate(fns):
+                scene.psfs[fn] = (psfs[i], float(i))
+            scene.polish(maxiter=100, tol=1e-10)
+            for i, fn in enumerate(fns):
+                model = thresher.convolve(scene.scene, psfs[i], mode="valid")
+                data = pyfits.getdata(fn)
+                assert np.std(data - i - model) < 0.02
+        finally:
+            shutil.rmtree(d)
+
+    def test_multiresolution(self):
+        """
+        Check the resampling of the scene between resolution levels.
+
+        """
+        d = tempfile.mkdtemp()
+        try:
+            initial = np.zeros((28, 28))
+            initial[10, 13] = 10.0
+            initial[17, 6] = 5.0
+            parent = thresher.Scene(initial, [], outdir=d, psf_hw=4)
+            child = multires.BinnedScene(parent, 2)
+            assert child.psf_hw == 2 and child.size == 10
+            np.testing.assert_allclose(child.scene,
+                                       multires.bin_image(initial, 2))
+
+            back = child.window(parent.size, parent.psf_hw)
+            np.testing.assert_allclose(back,
+                                       multires.upsample_image(child.scene, 2))
+            np.testing.assert_allclose(np.sum(back), 15.0)
+
+            # An odd PSF half width needs padding.
+            parent = thresher.Scene(np.zeros((26, 26)) + initial[:26, :26],
+                                    [], outdir=d, psf_hw=3)
+            child = multires.BinnedScene(parent, 4)
+            assert child.scene.shape == (7, 7)
+            np.testing.assert_allclose(np.sum(child.scene), 15.0)
+            back = child.window(parent.size, parent.psf_hw)
+            assert back.shape == (26, 26)
+            np.testing.assert_allclose(np.sum(back), 15.0)
+
+            # Rectangular scenes and the optimizer settings.
+            initial = np.zeros((28, 36))
+            initial[10, 23] = 10.0
+            parent = thresher.Scene(initial, [], outdir=d, psf_hw=4,
+                    optimizer=optimizers.Adam(beta1=0.5))
+            parent.optimizer.step(np.ones((28, 36)), 0.1)
+            child = multires.BinnedScene(parent, 2)
+            assert child.shape == (10, 14)
+            assert child.optimizer.beta1 == 0.5 and child.optimizer.t == 0
+            np.testing.assert_allclose(child.scene,
+                                       multires.bin_image(initial, 2))
+            back = child.window(parent.size, parent.psf_hw)
+            np.testing.assert_allclose(back,
+                                       multires.upsample_image(child.scene, 2))
+        finally:
+            shutil.rmtree(d)
+
+    def test_tiles(self):
+        """
+        Check that the feathered mosaic of the tiles reproduces the scene.
+
+        """
+        origins = tiles.tile_origins(100, 32, 8)
+        assert origins[0] == 0 and origins[-1] == 68
+        assert np.all(np.diff(origins) <= 24)
+        assert tiles.tile_origins(20, 32, 8) == [0]
+        for overlap in [16, 20]:
+            try:
+                tiles.tile_origins(100, 16, overlap)
+            except ValueError:
+                pass
+            else:
+                assert False, "The overlap should be smaller than the tiles."
+
+        d = tempfile.mkdtemp()
+        try:
+            initial = np.zeros((48, 48))
+            initial[10, 13] = 10.0
+            initial[30, 36] = 5.0
+            initial[22, 24] = 2.0
+            scene = tiles.TiledScene(initial, [], tile=24, overlap=8,
+                                     outdir=d, psf_hw=4)
+            assert len(scene.origins) == 4
+            np.testing.assert_allclose(scene.mosaic()[0], initial)
+        finally:
+            shutil.rmtree(d)
+
+    def test_multi_target(self):
+        """
+        Check that the regions cut out of the field loaded once match
+        loading each target on its own.
+
+        """
+        shape, offset, origins = multiscene.target_regions(
+                [(0, 0, 5, 5), (3, -6, 4, 6)])
+        assert shape == (8, 11) and offset == (1, -3)
+        assert origins == [(0, 6), (4, 0)]
+
+        d = tempfile.mkdtemp()
+        try:
+            np.random.seed(42)
+            fn = os.path.join(d, "frame.fits")
+            pyfits.PrimaryHDU(np.random.rand(40, 50)).writeto(fn)
+            targets = [(0, 0, 8, 8), (5, -10, 6, 9), (-7, 12, 5, 5)]
+            center = (18, 27)
+            ms = multiscene.MultiTargetScene(np.random.rand(40, 50), targets,
+                                             [fn], outdir=d, psf_hw=2,
+                                             centers=[center])
+            data, mask = ms.load_data(fn)
+            for (dy, dx, ny, nx), (y, x) in zip(targets, ms.origins):
+                truth, m = thresher.load_data(fn, (ny, nx),
+                                              center=(center[0] + dy,
+                                                      center[1] + dx))
+                np.testing.assert_allclose(data[y:y + ny, x:x + nx], truth)
+            assert os.path.exists(os.path.join(d, "target-2"))
+
+            # Early stopping and the metrics and status files.
+            ms.run_inference(npasses=5, thin=10, tol=np.inf,
+                             metrics="metrics.jsonl", status="status.json")
+            assert len(ms.convergence) == 2
+            with open(os.path.join(d, "status.json")) as f:
+                assert json.load(f)["state"] == "finished"
+            assert os.path.exists(os.path.join(d, "metrics.jsonl"))
+        finally:
+            shutil.rmtree(d)
+
+    def test_frame_store(self):
+        """
+        Check that the prepared frames in a store match loading them from
+        disk and that a parameter sweep reads from it.
+
+        """
+        d = tempfile.mkdtemp()
+        try:
+            np.random.seed(42)
+            fns = []
+            for i in range(3):
+                fns.append(os.path.join(d, "frame-{0}.fits".format(i)))
+                pyfits.PrimaryHDU(10 + np.random.rand(30, 30)).writeto(fns[-1])
+            centers = [(15, 15), (14, 16), (16, 13)]
+            store = frames.FrameStore.create(os.path.join(d, "frames"), fns,
+                                             (16, 18), centers=centers)
+            store = frames.FrameStore(os.path.join(d, "frames"))
+            assert len(store) == 3 and fns[1] in store
+            for fn, c in zip(fns, centers):
+                for size in [(16, 18), (12, 14)]:
+                    truth = thresher.load_data(fn, size, center=c)
+                    data, mask = store.get(fn, size)
+                    np.testing.assert_allclose(data, truth[0])
+                    np.testing.assert_allclose(mask, truth[1])
+
+            # The geometry is shared between scenes.
+            s1 = thresher.Scene(np.zeros((20, 22)), [], psf_hw=2)
+            s2 = thresher.Scene(np.zeros((20, 22)), [], psf_hw=2)
+            assert s1.scene_mask is s2.scene_mask
+
+            grid = sweep.parameter_grid(alpha=[1.0, 2.0], psf_hw=[2, 3])
+            assert len(grid) == 4 and grid[0]["beta"] == 1.0
+            results = sweep.run_sweep(np.random.rand(20, 22), fns, grid,
+                    d, centers=centers,
+                    run_kwargs=dict(npasses=1, metrics=None, thin=10))
+            assert [r["config"] for r in results] == range(4)
+            assert np.all(np.isfinite([r["chi2"] for r in results]))
+            sweep.save_summary(results, os.path.join(d, "summary.fits"))
+        finally:
+            shutil.rmtree(d)
+
+    def test_live(self):
+        """
+        Check that the live mode processes the new frames and skips the
+        oldest ones under backlog and the ones that can't be read.
+
+        """
+        d = tempfile.mkdtemp()
+        try:
+            np.random.seed(42)
+            x = np.arange(40)
+            fns = []
+            for i, (x0, y0) in enumerate([(20, 20), (22, 19), (18, 21),
+                                          (21, 23), (19, 18)]):
+                img = 10 * np.exp(-0.5 * ((x[:, None] - y0) ** 2
+                                          + (x[None, :] - x0) ** 2) / 2.0)
+                fns.append(os.path.join(d, "frame-{0}.fits".format(i)))
+                pyfits.PrimaryHDU(img + 1 + 0.1 * np.random.randn(40, 40)) \
+                        .writeto(fns[-1])
+
+            initial = np.zeros((24, 24))
+            initial[11:13, 11:13] = 1.0
+            scene = thresher.Scene(initial, [], outdir=d, psf_hw=3)
+            runner = live.LiveThresher(scene, debounce=0.0, maxlen=2,
+                                       interval=0.0, status=None)
+            runner.notify(os.path.join(d, ".hidden.fits"))
+            for fn in fns:
+                runner.notify(fn)
+            assert runner.poll() == fns[3]
+            assert runner.poll() == fns[4]
+            assert runner.poll() is None
+            assert runner.nframes == 2 and runner.skipped == 3
+
+            # A frame that was already used isn't used again.
+            runner.notify(fns[4])
+            assert runner.poll() is None
+
+            # A corrupt frame is skipped.
+            bad = os.path.join(d, "frame-bad.fits")
+            open(bad, "w").write("SIMPLE  =")
+            runner.notify(bad)
+            assert runner.poll() == bad
+            assert runner.nframes == 2 and runner.skipped == 4
+            assert scene.metrics.nframes == 2
+            runner.close()
+            assert os.path.exists(os.path.join(d, "000-00000001.fits"))
+        finally:
+            shutil.rmtree(d)
+
+    def _snapshot(self, outdir, img_number, shape=(24, 24)):
+        """
+        Run one update of a small scene and save the snapshot.
+
+        """
+        np.random.seed(img_number)
+        hw = 3
+        y, x = np.mgrid[:shape[0], :shape[1]]
+        data = 1 + 10 * np.exp(-0.5 * ((y - shape[0] // 2) ** 2
+                                       + (x - shape[1] // 2) ** 2) / 2.0) \
+                + 0.1 * np.random.randn(*shape)
+        scene = thresher.Scene(np.random.rand(shape[0] + 2 * hw,
+                                              shape[1] + 2 * hw),
+                               [], outdir=outdir, psf_hw=hw)
+        scene.update(data, np.ones(shape), 0.5)
+        scene.save("frame.fits", 0, img_number, data)
+        return os.path.join(outdir, "000-{0:08}.fits".format(img_number))
+
+    def test_monitor_debounce(self):
+        """
+        Check that the monitor ignores the temporary files, only renders
+        a snapshot once it has settled and reports the failed renders.
+
+        """
+        d = tempfile.mkdtemp()
+        try:
+            fn = self._snapshot(d, 0)
+            monitor = render.MonitorRenderer(d, debounce=0.3)
+
+            # `Scene.save` writes a temporary file and then renames it.
+            monitor.notify(os.path.join(d, ".000-00000000.fits.part"))
+            assert not len(monitor.pending)
+            monitor.notify(fn)
+            monitor.poll()
+            assert fn in monitor.pending and not len(monitor.inflight)
+
+            time.sleep(0.4)
+            monitor.poll()
+            assert not len(monitor.pending) and len(monitor.inflight) == 1
+            monitor.close()
+            assert os.path.exists(os.path.join(d, "000-00000000.png"))
+            assert monitor.failed == 0
+
+            # The errors in the workers are counted.
+            monitor = render.MonitorRenderer(os.path.join(d, "missing"),
+                                             debounce=0.0)
+            monitor.notify(fn)
+            monitor.poll()
+            monitor.close()
+            assert monitor.failed == 1
+        finally:
+            shutil.rmtree(d)
+
+    def test_render_batch(self):
+        """
+        Check that the snapshots rendered in a later batch share the stretch
+        of the first one and that incomplete snapshots are skipped.
+
+        """
+        d = tempfile.mkdtemp()
+        try:
+            fns = [self._snapshot(d, i) for i in range(2)]
+            assert len(render.render_batch(fns[:1], d)) == 1
+            with open(os.path.join(d, "stretch.json")) as f:
+                sigmas = json.load(f)
+            assert len(render.render_batch(fns, d)) == 1
+            with open(os.path.join(d, "stretch.json")) as f:
+                assert json.load(f) == sigmas
+
+            # A snapshot without the full state can't be rendered.
+            pyfits.PrimaryHDU(np.zeros((4, 4))).writeto(os.path.join(d,
+                "000-00000002.fits"))
+            assert render.load_state(os.path.join(d,
+                "000-00000002.fits")) is None
+        finally:
+            shutil.rmtree(d)
+
+    def test_render_frame(self):
+        """
+        Check the layout of a movie frame for a rectangular scene and that
+        an encoder failure and unreadable snapshots are reported.
+
+        """
+        np.random.seed(42)
+        state = dict(data=np.random.rand(10, 16), psf=np.random.rand(5, 5),
+                     old_scene=np.random.rand(14, 20),
+                     new_scene=np.random.rand(14, 20), sky=0.0)
+        frame = movie.render_frame(state, (1.0, 1.0), border=2)
+        assert frame.shape == (26, 38, 3) and frame.dtype == np.uint8
+
+        d = tempfile.mkdtemp()
+        try:
+            encoder = os.path.join(d, "encoder")
+            with open(encoder, "w") as f:
+                f.write("#!/bin/sh\necho 'no codec' >&2\nexit 3\n")
+            os.chmod(encoder, 0755)
+            fn = self._snapshot(d, 0, shape=(10, 16))
+            try:
+                movie.write_movie([fn], os.path.join(d, "out.mp4"),
+                                  encoder=encoder)
+            except RuntimeError as e:
+                assert "no codec" in str(e)
+            else:
+                assert False, "The encoder failure wasn't reported."
+
+            # Without any readable snapshots, there is no stretch.
+            bad = os.path.join(d, "bad.fits")
+            pyfits.PrimaryHDU(np.zeros((4, 4))).writeto(bad)
+            try:
+                movie.write_movie([bad], os.path.join(d, "out.mp4"),
+                                  encoder=encoder)
+            except ValueError:
+                pass
+            else:
+                assert False, "The missing stretch wasn't reported."
+        finally:
+            shutil.rmtree(d)
+
+    def test_plotter_reuse(self):
+        """
+        Check that the plotter only builds the figure once for a sequence
+        of frames with the same shape.
+
+        """
+        np.random.seed(42)
+        plotter = plotting.InferencePlotter(pl.figure())
+        args = lambda n: [np.random.rand(n, n), np.random.rand(n + 6, n + 6),
+                          np.random.rand(n + 6, n + 6), np.random.rand(7, 7),
+                          np.random.rand(n + 6, n + 6)]
+        plotter.plot(*args(20))
+        images = list(plotter.images)
+        plotter.plot(*args(20))
+        assert all(a is b for a, b in zip(images, plotter.images))
+        assert len(plotter.fig.axes) == 6
+
+        # A new shape rebuilds the layout.
+        plotter.plot(*args(16))
+        assert not any(a is b for a, b in zip(images, plotter.images))
+        assert len(plotter.fig.axes) == 6
+        pl.close(plotter.fig)
+
+    def test_cached_frames(self):
+        """
+        Check that the frames served from the TLI cache match loading them
+        from disk.
+
+        """
+        d = tempfile.mkdtemp()
+        try:
+            fns = []
+            for i in range(4):
+                fns.append(os.path.join(d, "frame-{0}.fits".format(i)))
+                img = 5 + np.random.rand(30, 32)
+                img[10 + i, 12] += 50.0
+                img[3, 4] = np.nan
+                pyfits.PrimaryHDU(img).writeto(fns[-1])
+            cache = {}
+            fns, masks, ranks, centers, final = tli.run_tli(fns,
+                                                            cache=cache)
+            centers = dict(zip(fns, np.array(centers).astype(int)))
+            source = frames.CachedFrames(cache, centers=centers)
+            assert len(source) == 4 and fns[0] in source
+            for fn in fns:
+                for size in [16, (12, 20)]:
+                    truth = thresher.load_data(fn, size, center=centers[fn])
+                    data, mask = source.get(fn, size)
+                    np.testing.assert_allclose(data, truth[0])
+                    np.testing.assert_allclose(mask, truth[1])
+        finally:
+            shutil.rmtree(d)
+
+    def test_quadratic_peak(self):
+        """
+        Test the sub-pixel peak refinement and Fourier shifting.
+
+        """
+        x = np.arange(32)
+        truth = np.array([[10.3, 7.8], [20.6, 21.1]])
+        img = np.zeros((32, 32))
+        for c in truth:
+            img += np.exp(-0.5 * ((x[:, None] - c[0]) ** 2
+                                  + (x[None, :] - c[1]) ** 2) / 2.0)
+
+        centers, good = utils.quadratic_peak(img, np.round(truth))
+        assert np.all(good)
+        assert np.all(np.abs(centers - truth) < 0.1)
+
+        # Shift the image so that the first source lands on a pixel.
+        shifted = utils.fourier_shift(np.fft.rfftn(img)[None, :, :],
+                img.shape, [[-0.3, 0.2]])[0]
+        centers, good = utils.quadratic_peak(shifted, [[10, 8]])
+        assert good[0] and np.all(np.abs(centers - [10, 8]) < 0.1)
+
+        # A local minimum next to a peak shouldn't be refined.
+        img -= 2 * np.exp(-0.5 * ((x[:, None] - 14.2) ** 2
+                                  + (x[None, :] - 7.9) ** 2) / 2.0)
+        centers, good = utils.quadratic_peak(img, [[10, 8], [14, 8]])
+        assert good[0] and not good[1]
+        assert np.all(centers[1] == [14, 8])
+
+    def test_find_sources(self):
+        """
+        Make sure that the source finder recovers the brightest sources in
+        order and respects the minimum separation.
+
+        """
+        np.random.seed(123)
+        x = np.arange(80)
+        truth = np.array([[40.2, 40.7], [33.4, 44.1], [29.8, 19.3],
+                          [60.1, 65.6]])
+        amps = [10.0, 8.0, 6.0, 4.0]
+        img = 0.01 * np.random.randn(80, 80)
+        for a, c in zip(amps, truth):
+            img += a * np.exp(-0.5 * ((x[:, None] - c[0]) ** 2
+                                      + (x[None, :] - c[1]) ** 2) / 4.0)
+
+        coords = diagnostics.find_sources(img, 3, delta=5, padding=5)
+        assert coords.shape == (3, 2)
+        assert np.all(np.abs(coords - truth[:3]) < 0.3)
+
+    def test_estimate_noise(self):
+        """
+        Make sure that the random aperture noise estimate is reproducible and
+        has about the right amplitude for white noise.
+
+        """
+        img = np.random.RandomState(5).randn(80, 80)
+        w = 2.0
+        n1, mu, fs = diagnostics.estimate_noise(img, w, N=500,
+                full_output=True)
+        n2 = diagnostics.estimate_noise(img, w, N=500)
+        assert len(fs) == 500 and n1 == n2
+
+        # Compare to the expected photometric noise.
+        ps = int(5 * w)
+        patch = diagnostics._synthesize_patch([2 * ps] * 2, [0.5 * ps] * 2,
+                1.0, w ** 2)
+        expected = 1.0 / np.sqrt(np.sum(patch ** 2))
+        assert 0.7 < n1 / expected < 1.3
+
+    def test_measure_snapshots(self):
+        """
+        Make sure that the local-patch photometry recovers the width and
+        fluxes of noiseless sources in a batch of snapshots.
+
+        """
+        coords = np.array([[40.2, 40.7], [33.4, 44.1], [29.8, 19.3]])
+        imgs = [diagnostics._generate((80, 80), coords, [w, 10., 5., 3.])
+                for w in [1.5, 2.5]]
+        widths, fluxes = diagnostics.measure_snapshots(imgs, coords, w=2.)
+        np.testing.assert_allclose(widths, [1.5, 2.5], rtol=1e-4)
+        np.testing.assert_allclose(fluxes, [[10., 5., 3.]] * 2, rtol=1e-4)
+
+    def test_clipped_stats(self):
+        """
+        Compare the fast sigma-clipping to the brute force version.
+
+        """
+        rng = np.random.RandomState(42)
+        x = np.append(rng.randn(5000), 10 + 5 * rng.rand(200))
+
+        # Brute force.
+        mu, std = np.median(x), np.inf
+        for i in range(100):
+            inrange = np.abs(x - mu) < 2.5 * std
+            mu = np.median(x[inrange])
+            newstd = np.sqrt(np.mean((x[inrange] - mu) ** 2))
+            if newstd == std:
+                break
+            std = newstd
+
+        mu2, std2 = stats.clipped_stats(x, nsigma=2.5)
+        np.testing.assert_allclose([mu2, std2], [mu, std])
+
+        assert stats.median([3, np.nan, 1, 2, 4]) == 2.5
+        assert stats.median([3, 1, 2]) == 2
+
+    def test_render_gaussian(self):
+        """
+        Make sure that rendering the sources on local stamps matches the
+        full-frame evaluation.
+
+        """
+        shape = (40, 50)
+        positions = np.array([[10.3, 12.7], [1.2, 48.9], [30.5, 25.0]])
+        fluxes = np.array([10., 5., 1.])
+        sigma = 1.8
+
+        x, y = np.arange(shape[0]), np.arange(shape[1])
+        truth = np.zeros(shape)
+        for p, f in zip(positions, fluxes):
+            r2 = (x[:, None] - p[0]) ** 2 + (y[None, :] - p[1]) ** 2
+            truth += f * np.exp(-0.5 * r2 / sigma ** 2) \
+                    / (2 * np.pi * sigma ** 2)
+
+        img = make_fake.render_gaussian(shape, positions, fluxes, sigma)
+        np.testing.assert_allclose(img, truth, atol=1e-5)
+
+        # `make_image` takes `(x, y)` positions like the original meshgrid
+        # implementation.
+        xg, yg = np.meshgrid(range(32), range(32))
+        truth = 10. * np.exp(-0.5 * ((xg - 5.3) ** 2 + (yg - 20.6) ** 2)
+                             / sigma ** 2) / (2. * np.pi * sigma ** 2)
+        img = make_fake.make_image((32, 32), [[5.3, 20.6]], [10.], 0.0, 0.0,
+                                   sigma)
+        np.testing.assert_allclose(img, truth, atol=1e-5)
+
 
 if __name__ == "__main__":
     tests = Tests()
@@ -3,7 +3,7 @@ This file is part of The Thresher.
 
 """
 
-__all__ = ["Scene"]
+__all__ = ["Scene", "load_data", "prepare_data"]
 
 import os
 import gc
@@ -12,13 +12,16 @@ import logging
 import numpy as np
 
 from scipy.sparse import csr_matrix
-from scipy.sparse.linalg import lsqr
+from scipy.sparse.linalg import lsqr, cg, LinearOperator
 from scipy.signal import fftconvolve as convolve
 import scipy.optimize as op
 
 import pyfits
 
 import utils
+import stats
+import optimizers
+from status import StatusReporter
 
 
 class Scene(object):
@@ -28,8 +31,8 @@ class Scene(object):
 
     ## Arguments
 
-    * `initial` (numpy.ndarray): An initial guess at the scene. It needs to
-      be square for now, unfortunately.
+    * `initial` (numpy.ndarray): An initial guess at the scene. This can be
+      rectangular.
     * `img_list` (list): The list of images to thresh.
 
     ## Keyword Arguments
@@ -47,11 +50,19 @@ class Scene(object):
     * `psfreg` (float): The strength of the PSF "sum-to-one" regularization.
     * `sceneL2` (float): The strength of the L2 regularization to apply to
       the scene.
+    * `ranks` (numpy.ndarray): The TLI ranks of the images (used for
+      importance sampling).
+    * `optimizer`: The optimizer used to update the scene. This can be an
+      object from the `optimizers` module or its name. Defaults to plain
+      stochastic gradient.
+    * `store`: A source of prepared frames (e.g. a `FrameStore`). The
+      frames found there aren't loaded from disk.
 
     """
     def __init__(self, initial, image_list, mask_list=None, invert=False,
             square=False, outdir="", centers=None, psf_hw=13, kernel=None,
-            psfreg=0., sceneL2=0.0, dc=0.0, light=False, hdu=0):
+            psfreg=0., sceneL2=0.0, dc=0.0, light=False, hdu=0, ranks=None,
+            optimizer=None, store=None):
         # Metadata.
         self.image_list = image_list
         if mask_list is not None:
@@ -68,6 +79,7 @@ class Scene(object):
         self.dc = dc
         self.light = False
         self.hdu = hdu
+        self.store = store
 
         # Sort out the center vector and save it as a dictionary associated
         # with specific filenames.
@@ -75,22 +87,29 @@ class Scene(object):
         if centers is not None:
             self.centers = dict([(image_list[i], centers[i])
                 for i in range(len(image_list))])
+        self.ranks = ranks
+        if ranks is not None:
+            self.ranks = dict([(image_list[i], ranks[i])
+                for i in range(len(image_list))])
 
         # Inference parameters.
         self.sky = 0
         self.scene = np.array(initial)
 
         # 'Sky'-subtract the initial scene.
-        self.scene -= np.median(self.scene)
+        self.scene -= stats.median(self.scene)
 
         # Deal with the masked pixels if there are any in the initial scene
         # by setting them to the 'sky' level.
         self.scene[np.isnan(self.scene)] = 0.0
 
-        # Check the dimensions of the initial scene and set the size.
-        shape = self.scene.shape
-        assert shape[0] == shape[1], "The initial scene needs to be square."
-        self.size = shape[0] - 2 * self.psf_hw
+        # Set the shape of the data from the dimensions of the initial
+        # scene. The scene can be rectangular but `size` stays an integer
+        # for square scenes.
+        self.shape = tuple(n - 2 * self.psf_hw for n in self.scene.shape)
+        assert min(self.shape) > 0, "The initial scene is too small."
+        self.size = self.shape[0] if self.shape[0] == self.shape[1] \
+                else self.shape
 
         # The 'kernel' used for 'light deconvolution'.
         if kernel is None:
@@ -101,10 +120,62 @@ class Scene(object):
             self.kernel = kernel
 
         # Index gymnastics.
-        self.scene_mask = utils.unravel_scene(self.size + 2 * self.psf_hw,
-                self.psf_hw)
+        self.scene_mask = utils.unravel_scene(self.scene.shape, self.psf_hw)
         self.psf_rows, self.psf_cols = \
-                utils.unravel_psf(self.size + 2 * self.psf_hw, self.psf_hw)
+                utils.unravel_psf(self.scene.shape, self.psf_hw)
+
+        # The optimizer.
+        if optimizer is None:
+            optimizer = optimizers.SGD()
+        elif isinstance(optimizer, basestring):
+            optimizer = optimizers.get_optimizer(optimizer)
+        self.optimizer = optimizer
+
+        # Per-frame timings and counters.
+        self.metrics = utils.Metrics()
+
+        # Convergence diagnostics.
+        self.chi2, self.ndata, self.step = np.nan, 0, np.nan
+        self.scene_change = 0.0
+        self.convergence = []
+
+        # The per-frame fit statistics and the latest PSF and sky for each
+        # frame.
+        self.frames = {}
+        self.psfs = {}
+
+    def load_data(self, fn, maskfn=None, maskhdu=0, size=None):
+        """
+        Load, center and clean up the data and mask for an image.
+
+        ## Arguments
+
+        * `fn` (str): The filename of the image.
+
+        ## Keyword Arguments
+
+        * `maskfn` (str): Path to the mask file.
+        * `maskhdu` (int): The HDU number for the mask.
+        * `size` (int or tuple): The size (or shape `(ny, nx)`) of the
+          cropped data. Defaults to the shape of the scene minus the PSF
+          padding.
+
+        ## Returns
+
+        * `data` (numpy.ndarray): The centered and cropped data.
+        * `mask` (numpy.ndarray): The corresponding inverse variance map.
+
+        """
+        if size is None:
+            size = self.size
+        if self.store is not None and fn in self.store:
+            with self.metrics.stage("io"):
+                data, mask = self.store.get(fn, size)
+            return data + self.dc, mask
+        center = self.centers[fn] if self.centers is not None else None
+        return load_data(fn, size, hdu=self.hdu, maskfn=maskfn,
+                maskhdu=maskhdu, invert=self.invert, square=self.square,
+                center=center, dc=self.dc, metrics=self.metrics)
 
     def do_update(self, fn, alpha, maskfn=None, maskhdu=0, median=True,
             nn=False, hack=True):
@@ -115,7 +186,8 @@ class Scene(object):
         ## Arguments
 
         * `fn` (str): The filename of the image to be used.
-        * `alpha` (float): The learning rate.
+        * `alpha` (float): The learning rate. How this is used depends on
+          the optimizer.
 
         ## Keyword Arguments
 
@@ -130,73 +202,84 @@ class Scene(object):
           for this update.
 
         """
-        image = utils.load_image(fn, hdu=self.hdu)
-        if maskfn is not None:
-            mask = utils.load_image(maskfn, hdu=maskhdu)
-            if self.invert:
-                inds = np.isnan(mask) + np.isinf(mask)
-                mask[~inds] = 1.0 / mask[~inds]
-                mask[inds] = 0.0
-            if self.square:
-                mask = mask ** 2
-        else:
-            mask = np.ones_like(image)
+        data, mask = self.load_data(fn, maskfn=maskfn, maskhdu=maskhdu)
+        self.update(data, mask, alpha, median=median, nn=nn, hack=hack,
+                    key=fn)
+        return data
 
-        # Center the data.
-        if self.centers is None:
-            data = utils.trim_image(image, self.size)
-            mask = utils.trim_image(mask, self.size)
-        else:
-            result = utils.centroid_image(image, self.size,
-                    coords=self.centers[fn], mask=mask)
-            data = result[1]
-            mask = result[2]
+    def update(self, data, mask, alpha, median=True, nn=False, hack=True,
+            key=None):
+        """
+        Do a single stochastic gradient update using a data image that has
+        already been loaded.
+
+        ## Arguments
+
+        * `data` (numpy.ndarray): The centered and cropped data.
+        * `mask` (numpy.ndarray): The inverse variance map for the data.
+        * `alpha` (float): The learning rate.
+
+        ## Keyword Arguments
 
-        # Deal with NaNs and infinities.
-        if maskfn is None:
-            mask *= ~(np.isnan(data) + np.isinf(data))
-        data[mask == 0.0] = 0.0
-        assert np.all(~(np.isnan(data) + np.isinf(data))), \
-                "Yer data's got some unmasked NaNs or infs, dude."
+        * `median` (bool): Subtract the median of the scene?
+        * `nn` (bool): Project onto the non-negative plane?
+        * `hack` (bool): Subtract the outer part of the PSF.
+        * `key`: An identifier for the frame (used by the optimizer).
 
-        # Add the DC offset.
-        data += self.dc
+        """
+        metrics = self.metrics
 
         # Do the inference.
         self.old_scene = np.array(self.scene)
 
-        self.psf, self.sky = self.infer_psf(data, mask)
+        with metrics.stage("psf"):
+            self.psf, self.sky = self.infer_psf(data, mask)
+
+        # NNLS doesn't report its number of iterations so keep track of the
+        # size of the active set instead.
+        metrics.set("psf_active", int(np.sum(self.psf > 0)))
 
         if hack:
             logging.info("Hacking.")
-            X, Y = np.meshgrid(np.arange(-self.psf_hw, self.psf_hw + 1),
-                    np.arange(-self.psf_hw, self.psf_hw + 1))
-            R = np.sqrt(X ** 2 + Y ** 2)
-            outer = self.psf[R > 0.9 * self.psf_hw]
-            inds = outer > 0
-            if np.any(inds):
-                self.psf -= np.sum(inds) / float(outer.size) \
-                    * np.median(outer[inds])
+            with metrics.stage("hack"):
+                X, Y = np.meshgrid(np.arange(-self.psf_hw, self.psf_hw + 1),
+                        np.arange(-self.psf_hw, self.psf_hw + 1))
+                R = np.sqrt(X ** 2 + Y ** 2)
+                outer = self.psf[R > 0.9 * self.psf_hw]
+                inds = outer > 0
+                if np.any(inds):
+                    self.psf -= np.sum(inds) / float(outer.size) \
+                        * stats.median(outer[inds])
 
         print "sky:", self.sky
-        self.dlds = self.get_dlds(data, mask)
+        with metrics.stage("dlds"):
+            self.dlds = self.get_dlds(data, mask)
 
         # self.old_scene = self.scene + alpha * self.dlds
-        self.scene += alpha * self.dlds
+        with metrics.stage("update"):
+            delta = self.optimizer.step(self.dlds, alpha, key=key)
+            self.scene += delta
+
+        # The size of the step and the (reduced) chi-squared of this frame.
+        self.step = np.sqrt(np.sum(delta ** 2))
+        metrics.set("step", self.step)
+        metrics.set("chi2", self.chi2 / max(self.ndata, 1))
 
         # WTF?!?
-        gc.collect()
+        with metrics.stage("gc"):
+            gc.collect()
 
         # Apply some serious HACKS!
         if median:
-            self.scene -= np.median(self.scene)
+            self.scene -= stats.median(self.scene)
         if nn:
             self.scene[self.scene < 0] = 0.0
 
-        return data
-
     def run_inference(self, npasses=5, median=False, nn=True, top=None,
-            thin=1, alpha=2.0, beta=1.0):
+            thin=1, alpha=2.0, beta=1.0, metrics=None, status=None,
+            status_port=None, status_interval=5.0,
+            tol=None, reject=None, sampling="uniform", power=1.0, mix=0.1,
+            polish=0, start=0):
         """
         Thresh the data.
 
@@ -207,32 +290,329 @@ class Scene(object):
         * `nn` (bool): Constrain the inferred scene to be non-negative.
         * `top` (int): Only consider the top few images.
         * `thin` (int): Only save the state every few images.
+        * `metrics` (str): The name of the file in `outdir` where the
+          per-frame timings are written (one JSON record per line). A
+          summary is saved next to it. The files are only written if this
+          is given.
+        * `status` (str): The name of the file in `outdir` where the
+          progress of the run is published. The status file is only written
+          if this is given.
+        * `status_port` (int): Also serve the status over HTTP on this port
+          on localhost.
+        * `status_interval` (float): The minimum time between status updates
+          (in seconds).
+        * `tol` (float): Stop early when the RMS change in the scene over a
+          full pass, relative to the RMS of the scene, drops below this
+          value. In this case, `npasses` is the maximum number of passes.
+          The first pass is never treated as converged.
+        * `reject` (float): Skip the frames with pathological fits on the
+          passes after the first. See `reject_frames`.
+        * `sampling` (str): How to choose the frames on the passes after the
+          first. `uniform` visits every frame once in a random order. `rank`
+          and `chi2` draw the frames (with replacement) with a probability
+          proportional to the TLI rank or the latest reduced chi-squared of
+          the frame to the power `power`. The learning rate is scaled by the
+          inverse of the relative probability so that the gradient is
+          unbiased.
+        * `power` (float): The exponent for the sampling probabilities.
+        * `mix` (float): The fraction of uniform probability mixed into the
+          sampling distribution. This bounds the importance weights by
+          `1 / mix`.
+        * `polish` (int): After the stochastic passes, run this many
+          iterations of `polish` and save the result in `polished.fits`.
+        * `start` (int): The number of updates that the scene has already
+          had (e.g. at a coarser resolution). The learning rate on the first
+          pass continues the schedule from there.
 
         """
+        if metrics is not None:
+            self.metrics.open(os.path.join(self.outdir, metrics))
+
         N = len([i for i in self.image_list])
 
         iml = self.image_list
         if top is not None:
             iml = iml[:int(top)]
+
+        reporter = StatusReporter(
+                fn=os.path.join(self.outdir, status) if status else None,
+                port=status_port, interval=status_interval,
+                total=npasses * len(iml))
+        last_saved = np.array(self.scene)
+        pass_number = -1
         for pass_number in xrange(npasses):
+            if pass_number > 0 and reject is not None:
+                self.reject_frames(reject)
             if pass_number > 0:
                 np.random.shuffle(iml)
-            for img_number, fn in enumerate(iml):
+            schedule, weights = iml, np.ones(len(iml))
+            if pass_number > 0 and sampling != "uniform":
+                schedule, weights = self.sample_frames(iml, sampling,
+                        power=power, mix=mix)
+            pass_scene = np.array(self.scene)
+            chi2s, steps = [], []
+            for img_number, fn in enumerate(schedule):
+                if self.frames.get(fn, {}).get("rejected", False):
+                    continue
+
                 # If it's the first pass, `alpha` should decay and we
                 # should use _non-negative_ optimization.
                 if pass_number == 0:
-                    learning_rate = alpha / (beta + img_number)
+                    learning_rate = alpha / (beta + start + img_number)
                     use_nn = nn
                 else:
-                    learning_rate = alpha / (beta + N)
+                    learning_rate = weights[img_number] * alpha / (beta + N)
                     use_nn = False
 
+                self.metrics.start_frame(fn=fn, pass_number=pass_number,
+                                         img_number=img_number)
                 data = self.do_update(fn, learning_rate, median=median,
                         nn=use_nn, maskfn=self.mask_list.get(fn, None))
 
+                self._record_frame(fn, pass_number)
+                self.psfs[fn] = (np.array(self.psf), self.sky)
+                chi2s.append(self.frames[fn]["chi2"])
+                steps.append(self.step)
+
                 # Save the current state of the scene.
                 if img_number % thin == 0:
-                    self.save(fn, pass_number, img_number, data)
+                    self.scene_change = _relative_change(self.scene,
+                                                         last_saved)
+                    self.metrics.set("scene_change", self.scene_change)
+                    last_saved = np.array(self.scene)
+                    with self.metrics.stage("save"):
+                        self.save(fn, pass_number, img_number, data)
+                stages = self.metrics.end_frame()
+                reporter.update(pass_number, img_number, sky=self.sky,
+                                psf_sum=np.sum(self.psf), stages=stages)
+
+            # Check for convergence.
+            diag = dict(pass_number=pass_number,
+                        mean_chi2=float(np.mean(chi2s)),
+                        mean_step=float(np.mean(steps)),
+                        scene_change=_relative_change(self.scene,
+                                                      pass_scene))
+            self.convergence.append(diag)
+            logging.info("Pass {pass_number}: mean chi2 = {mean_chi2:.4g}, "
+                         "mean step = {mean_step:.4g}, scene change = "
+                         "{scene_change:.4g}".format(**diag))
+            if tol is not None and pass_number > 0 \
+                    and diag["scene_change"] < tol:
+                logging.info("Converged after {0} passes."
+                             .format(pass_number + 1))
+                break
+
+        reporter.close(pass_number=pass_number,
+                       convergence=self.convergence)
+        self.save_frame_table(os.path.join(self.outdir, "frames.fits"))
+
+        if polish:
+            self.polish(maxiter=polish)
+            pyfits.PrimaryHDU(self.scene).writeto(
+                    os.path.join(self.outdir, "polished.fits"), clobber=True)
+
+        if metrics is not None:
+            self.metrics.report(os.path.join(self.outdir,
+                    os.path.splitext(metrics)[0] + "-summary.json"))
+            self.metrics.close()
+        else:
+            self.metrics.report()
+
+    def _record_frame(self, fn, pass_number):
+        """
+        Save the fit statistics of the latest update in the frame table.
+
+        """
+        self.frames[fn] = dict(pass_number=pass_number,
+                               chi2=self.chi2 / max(self.ndata, 1),
+                               ndata=self.ndata, sky=self.sky,
+                               psf_sum=np.sum(self.psf),
+                               psf_width=psf_width(self.psf),
+                               rejected=False)
+
+    def sample_frames(self, fns, sampling, power=1.0, mix=0.1):
+        """
+        Draw a pass worth of frames by importance sampling.
+
+        ## Arguments
+
+        * `fns` (list): The frames to sample from.
+        * `sampling` (str): The score used for the probabilities: `rank` for
+          the TLI rank or `chi2` for the latest reduced chi-squared.
+
+        ## Keyword Arguments
+
+        * `power` (float): The probabilities are proportional to the scores
+          to this power.
+        * `mix` (float): The fraction of uniform probability to mix in.
+
+        ## Returns
+
+        * `schedule` (list): The `len(fns)` sampled frames.
+        * `weights` (numpy.ndarray): The importance weight of each sampled
+          frame: the uniform probability divided by the probability of
+          drawing it. These have a mean of one.
+
+        """
+        if sampling == "rank":
+            assert self.ranks is not None, "Rank sampling needs the ranks."
+            scores = np.array([self.ranks[fn] for fn in fns], dtype=float)
+        elif sampling == "chi2":
+            scores = np.array([self.frames.get(fn, {}).get("chi2", np.nan)
+                               for fn in fns])
+            # Frames that haven't been seen yet get the typical value.
+            m = np.isfinite(scores)
+            scores[~m] = stats.median(scores[m]) if np.any(m) else 1.0
+        else:
+            raise ValueError("Unknown sampling mode: {0}".format(sampling))
+
+        # Rejected frames are never drawn.
+        good = np.array([not self.frames.get(fn, {}).get("rejected", False)
+                         for fn in fns])
+        q = np.clip(scores, 0, np.inf) ** power * good
+        if np.sum(q) <= 0:
+            q = np.array(good, dtype=float)
+        p = (1 - mix) * q / np.sum(q) + mix * good / float(np.sum(good))
+
+        inds = np.random.choice(len(fns), size=len(fns), p=p)
+        return [fns[i] for i in inds], 1.0 / (len(fns) * p[inds])
+
+    def reject_frames(self, nsigma=5.0):
+        """
+        Flag the frames with pathological fits. A frame is rejected if its
+        reduced chi-squared is more than `nsigma` (robust) standard
+        deviations above the typical value (cosmic rays, readout glitches)
+        or if the sum of its PSF is more than `nsigma` away from the typical
+        value (clouds). Rejected frames are skipped by `run_inference`.
+
+        ## Keyword Arguments
+
+        * `nsigma` (float): The rejection threshold.
+
+        ## Returns
+
+        * `rejected` (list): The newly rejected frames.
+
+        """
+        fns = [fn for fn, f in self.frames.iteritems() if not f["rejected"]]
+        if len(fns) < 3:
+            return []
+
+        chi2 = np.array([self.frames[fn]["chi2"] for fn in fns])
+        psf_sum = np.array([self.frames[fn]["psf_sum"] for fn in fns])
+        mu1, sig1 = stats.clipped_stats(chi2)
+        mu2, sig2 = stats.clipped_stats(psf_sum)
+        bad = (chi2 > mu1 + nsigma * sig1) \
+                + (np.abs(psf_sum - mu2) > nsigma * sig2) \
+                + ~np.isfinite(chi2)
+
+        rejected = [fn for fn, b in zip(fns, bad) if b]
+        for fn in rejected:
+            self.frames[fn]["rejected"] = True
+        if len(rejected):
+            logging.info("Rejecting {0} frames.".format(len(rejected)))
+        return rejected
+
+    def save_frame_table(self, fn):
+        """
+        Save the per-frame fit statistics as a FITS table.
+
+        ## Arguments
+
+        * `fn` (str): The output filename.
+
+        """
+        if not len(self.frames):
+            return
+        fns = sorted(self.frames)
+        col = lambda k: np.array([self.frames[f][k] for f in fns])
+        length = max([len(f) for f in fns])
+        cols = pyfits.ColDefs([
+            pyfits.Column(name="filename", format="{0:d}A".format(length),
+                          array=np.array(fns)),
+            pyfits.Column(name="pass", format="J", array=col("pass_number")),
+            pyfits.Column(name="chi2", format="D", array=col("chi2")),
+            pyfits.Column(name="ndata", format="J", array=col("ndata")),
+            pyfits.Column(name="sky", format="D", array=col("sky")),
+            pyfits.Column(name="psf_sum", format="D", array=col("psf_sum")),
+            pyfits.Column(name="psf_width", format="D",
+                          array=col("psf_width")),
+            pyfits.Column(name="rejected", format="L",
+                          array=col("rejected"))])
+        pyfits.new_table(cols).writeto(fn, clobber=True)
+
+    def polish(self, maxiter=20, tol=1e-6, nn=False):
+        """
+        Solve for the scene using all the frames at once, keeping the PSF
+        and sky of each frame fixed at the values from the latest pass.
+
+        The normal equations of the weighted least-squares problem (with the
+        `sceneL2` regularization) are solved using conjugate gradient. The
+        operator is never built explicitly: each product convolves the scene
+        with the PSF of every frame (using FFTs) and applies the adjoint,
+        streaming the masks from disk. Each iteration costs one pass through
+        the data.
+
+        ## Keyword Arguments
+
+        * `maxiter` (int): The maximum number of iterations.
+        * `tol` (float): The relative tolerance on the residual.
+        * `nn` (bool): Clip the solution to be non-negative.
+
+        ## Returns
+
+        * `scene` (numpy.ndarray): The new scene. This also replaces
+          `self.scene`.
+
+        """
+        fns = [fn for fn in sorted(self.psfs)
+               if not self.frames.get(fn, {}).get("rejected", False)]
+        assert len(fns), "There are no PSFs. Run some inference first."
+
+        S = self.scene.shape
+        P = 2 * self.psf_hw + 1
+        fshape = (S[0] + P - 1, S[1] + P - 1)
+        valid = (slice(P - 1, S[0]), slice(P - 1, S[1]))
+
+        def load(fn):
+            data, mask = self.load_data(fn, maskfn=self.mask_list.get(fn))
+            psf, sky = self.psfs[fn]
+            return data - sky, mask, np.fft.rfftn(psf, fshape)
+
+        def adjoint(r, psf_ft):
+            z = np.zeros(fshape)
+            z[valid] = r
+            return np.fft.irfftn(np.fft.rfftn(z) * np.conj(psf_ft),
+                                 fshape)[:S[0], :S[1]]
+
+        # The right-hand side (the first pass through the data).
+        b = np.zeros(S)
+        for fn in fns:
+            data, mask, psf_ft = load(fn)
+            b += adjoint(data * mask, psf_ft)
+
+        def matvec(x):
+            x_ft = np.fft.rfftn(x.reshape(S), fshape)
+            result = self.sceneL2 ** 2 * x.reshape(S)
+            for fn in fns:
+                data, mask, psf_ft = load(fn)
+                model = np.fft.irfftn(x_ft * psf_ft, fshape)[valid]
+                result += adjoint(model * mask, psf_ft)
+            return result.flatten()
+
+        A = LinearOperator((b.size, b.size), matvec=matvec, dtype=float)
+
+        with self.metrics.stage("polish"):
+            x, info = cg(A, b.flatten(), x0=self.scene.flatten(), tol=tol,
+                         maxiter=maxiter)
+        if info > 0:
+            logging.info("The polish didn't converge in {0} iterations."
+                         .format(info))
+
+        self.scene = x.reshape(S)
+        if nn:
+            self.scene[self.scene < 0] = 0.0
+        return self.scene
 
     def get_psf_matrix(self, L2=True):
         """
@@ -248,12 +628,9 @@ class Scene(object):
           matrix.
 
         """
-        S = len(self.scene)
         P = self.psf_hw
-
-        D = S - 2 * P
-        data_size = D ** 2
-        scene_size = S ** 2
+        data_size = self.shape[0] * self.shape[1]
+        scene_size = self.scene.size
         psf_size = (2 * P + 1) ** 2
 
         # NOTE: the PSF is reversed here.
@@ -303,8 +680,7 @@ class Scene(object):
         P = 2 * self.psf_hw + 1
         psf_size = P ** 2
 
-        D = data.shape[0]
-        data_size = D ** 2
+        data_size = data.size
 
         # Build scene matrix from kernel-convolved scene.
         if self.light:
@@ -393,11 +769,17 @@ class Scene(object):
         """
         psf_matrix = self.get_psf_matrix(L2=False)
 
-        dlds = psf_matrix.transpose().dot((data.flatten() - self.sky -
-                psf_matrix.dot(self.scene.flatten()))
-                * mask.flatten())
+        residual = data.flatten() - self.sky \
+                - psf_matrix.dot(self.scene.flatten())
+        weighted = residual * mask.flatten()
+        dlds = psf_matrix.transpose().dot(weighted)
         dlds = dlds.reshape(self.scene.shape)
 
+        # The chi-squared of the data under the current model comes for free
+        # with the residuals.
+        self.chi2 = np.dot(weighted, residual)
+        self.ndata = np.sum(mask > 0)
+
         return dlds
 
     def save(self, fn, pass_number, img_number, data):
@@ -412,10 +794,164 @@ class Scene(object):
                 pyfits.ImageHDU(self.old_scene)]
 
         hdus[0].header.update("datafn", fn)
-        hdus[0].header.update("size", self.size)
+        hdus[0].header.update("size", self.shape[0])
+        hdus[0].header.update("size_x", self.shape[1])
         hdus[0].header.update("pass", pass_number)
         hdus[0].header.update("image", img_number)
         hdus[0].header.update("sky", self.sky)
         hdus[0].header.update("dc", self.dc)
+        hdus[0].header.update("chi2", self.chi2 / max(self.ndata, 1))
+        hdus[0].header.update("dscene", self.scene_change)
+
+        # Write to a temporary file first and then move it into place so
+        # that anyone watching the output directory never sees a partially
+        # written snapshot.
+        tmpfn = os.path.join(self.outdir, "." + _id + ".fits.part")
+        pyfits.HDUList(hdus).writeto(tmpfn, clobber=True)
+        self.metrics.add("bytes_written", os.path.getsize(tmpfn))
+        os.rename(tmpfn, outfn)
+
+
+def load_data(fn, size, hdu=0, maskfn=None, maskhdu=0, invert=False,
+        square=False, center=None, offset=None, reference=None, dc=0.0,
+        metrics=None):
+    """
+    Load, center and clean up the data and mask for an image.
+
+    ## Arguments
+
+    * `fn` (str): The filename of the image.
+    * `size` (int or tuple): The size (or shape `(ny, nx)`) of the cropped
+      data.
+
+    ## Keyword Arguments
+
+    * `hdu` (int): The HDU number for the data.
+    * `maskfn` (str): Path to the mask file.
+    * `maskhdu` (int): The HDU number for the mask.
+    * `invert` (bool): The mask is a variance map.
+    * `square` (bool): The mask is a standard deviation map.
+    * `center` (tuple): The coordinates of the center of the image. If this
+      isn't given, the image is assumed to be registered.
+    * `offset` (tuple): Cut out the data centered at this offset from the
+      center of the image (or from `center`).
+    * `reference` (numpy.ndarray): Find the center by correlating the image
+      with this scene (when `center` isn't given).
+    * `dc` (float): A constant to add to the data.
+    * `metrics` (utils.Metrics): Record the timings here.
+
+    ## Returns
+
+    * `data` (numpy.ndarray): The centered and cropped data.
+    * `mask` (numpy.ndarray): The corresponding inverse variance map.
 
-        pyfits.HDUList(hdus).writeto(outfn, clobber=True)
+    """
+    if metrics is None:
+        metrics = utils.Metrics()
+    with metrics.stage("io"):
+        image = utils.load_image(fn, hdu=hdu)
+        metrics.add("bytes_read", os.path.getsize(fn))
+        if maskfn is not None:
+            mask = utils.load_image(maskfn, hdu=maskhdu)
+            metrics.add("bytes_read", os.path.getsize(maskfn))
+            if invert:
+                inds = np.isnan(mask) + np.isinf(mask)
+                mask[~inds] = 1.0 / mask[~inds]
+                mask[inds] = 0.0
+            if square:
+                mask = mask ** 2
+        else:
+            mask = np.ones_like(image)
+
+    return prepare_data(image, mask, size, center=center, offset=offset,
+            reference=reference, dc=dc, mask_invalid=maskfn is None,
+            metrics=metrics)
+
+
+def prepare_data(image, mask, size, center=None, offset=None,
+        reference=None, dc=0.0, mask_invalid=True, metrics=None):
+    """
+    Center and clean up an image and its mask that are already in memory.
+    The arrays may be modified in place.
+
+    ## Arguments
+
+    * `image` (numpy.ndarray): The image.
+    * `mask` (numpy.ndarray): The inverse variance map for the image.
+    * `size` (int or tuple): The size (or shape `(ny, nx)`) of the cropped
+      data.
+
+    ## Keyword Arguments
+
+    * `mask_invalid` (bool): Mask the NaNs and infinities in the image.
+      Otherwise, they need to be masked already.
+
+    See `load_data` for the other arguments.
+
+    ## Returns
+
+    * `data` (numpy.ndarray): The centered and cropped data.
+    * `mask` (numpy.ndarray): The corresponding inverse variance map.
+
+    """
+    if metrics is None:
+        metrics = utils.Metrics()
+
+    # Center the data.
+    with metrics.stage("center"):
+        if center is None and reference is not None:
+            clean = np.where(np.isfinite(image), image, 0.0)
+            center = utils.centroid_image(clean, size, scene=reference)[0]
+        if offset is not None:
+            if center is None:
+                center = np.array(image.shape) // 2
+            center = np.array(center) + np.array(offset)
+        if center is None:
+            data = utils.trim_image(image, size)
+            mask = utils.trim_image(mask, size)
+        else:
+            result = utils.centroid_image(image, size, coords=center,
+                    mask=mask)
+            data = result[1]
+            mask = result[2]
+
+    # Deal with NaNs and infinities.
+    if mask_invalid:
+        mask *= ~(np.isnan(data) + np.isinf(data))
+    data[mask == 0.0] = 0.0
+    assert np.all(~(np.isnan(data) + np.isinf(data))), \
+            "Yer data's got some unmasked NaNs or infs, dude."
+
+    # Add the DC offset.
+    data += dc
+
+    return data, mask
+
+
+def psf_width(psf):
+    """
+    The effective width of a PSF image: the RMS radius (per axis) of the
+    positive part of the PSF around its centroid. For a Gaussian, this is
+    the standard deviation.
+
+    """
+    p = np.clip(psf, 0, np.inf)
+    norm = np.sum(p)
+    if norm <= 0:
+        return np.nan
+    x, y = np.meshgrid(np.arange(psf.shape[0]), np.arange(psf.shape[1]),
+                       indexing="ij")
+    x0, y0 = np.sum(p * x) / norm, np.sum(p * y) / norm
+    return float(np.sqrt(0.5 * np.sum(p * ((x - x0) ** 2 + (y - y0) ** 2))
+                         / norm))
+
+
+def _relative_change(a, b):
+    """
+    The RMS difference between two scenes relative to the RMS of the first.
+
+    """
+    norm = np.sqrt(np.sum(a ** 2))
+    if norm == 0:
+        return np.inf
+    return float(np.sqrt(np.sum((a - b) ** 2)) / norm)
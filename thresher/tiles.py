@@ -0,0 +1,157 @@
+"""
+This file is part of The Thresher.
+
+Thresh a large field by splitting it into overlapping tiles. Each tile has
+its own `Scene` (and so its own PSF for every frame); see `MultiScene` for
+how the frames are read and the tiles are updated. The tile scenes are
+feathered together into a single mosaic.
+
+"""
+
+__all__ = ["tile_origins", "feather_weights", "TiledScene"]
+
+import os
+import logging
+
+import numpy as np
+import pyfits
+
+from multiscene import MultiScene
+
+
+def tile_origins(size, tile, overlap):
+    """
+    The origins of a set of overlapping tiles covering `[0, size)`. The
+    tiles are spread evenly so that the overlaps are at least `overlap`.
+
+    """
+    if tile >= size:
+        return [0]
+    if tile <= overlap:
+        raise ValueError("The tiles ({0}) must be larger than the overlap "
+                         "({1}).".format(tile, overlap))
+    n = int(np.ceil((size - overlap) / float(tile - overlap)))
+    return [int(round(x)) for x in np.linspace(0, size - tile, n)]
+
+
+def feather_weights(shape, ramps):
+    """
+    Weights that ramp linearly from zero to one at the edges of a tile.
+
+    ## Arguments
+
+    * `shape` (tuple): The shape of the tile.
+    * `ramps` (tuple): The width of the ramp on the `(top, bottom, left,
+      right)` edges. A width of zero means no ramp (the edge of the field).
+
+    """
+    w = []
+    for n, (lo, hi) in zip(shape, [ramps[:2], ramps[2:]]):
+        x = np.ones(n)
+        if lo > 0:
+            x = np.minimum(x, (np.arange(n) + 0.5) / lo)
+        if hi > 0:
+            x = np.minimum(x, (n - np.arange(n) - 0.5) / hi)
+        w.append(x)
+    return w[0][:, None] * w[1][None, :]
+
+
+class TiledScene(MultiScene):
+    """
+    Thresh a large field as a set of overlapping tiles.
+
+    ## Arguments
+
+    * `initial` (numpy.ndarray): An initial guess at the scene for the full
+      field (including the PSF padding).
+    * `image_list` (list): The list of images to thresh.
+
+    ## Keyword Arguments
+
+    * `tile` (int): The size of the data region of each tile. The tiles are
+      cropped to the field if it is smaller.
+    * `overlap` (int): The minimum overlap between neighbouring tiles.
+    * `outdir` (str): The directory for the output files.
+    * `psf_hw` (int): The half width of the PSF of each tile.
+
+    All the other keyword arguments are passed to `MultiScene`.
+
+    """
+    def __init__(self, initial, image_list, tile=64, overlap=16, outdir="",
+            psf_hw=13, **kwargs):
+        initial = np.array(initial, dtype=float)
+        self.shape = initial.shape
+        ny, nx = tuple(n - 2 * psf_hw for n in self.shape)
+
+        # The tile geometry in the coordinates of the data.
+        ty, tx = self.tile = (min(tile, ny), min(tile, nx))
+        origins = [(y, x) for y in tile_origins(ny, ty, overlap)
+                   for x in tile_origins(nx, tx, overlap)]
+        logging.info("Splitting the field into {0} tiles."
+                     .format(len(origins)))
+
+        # The feathering weights for each tile scene: ramp over the overlap
+        # on the edges that are inside the field.
+        P = 2 * psf_hw
+        self.weights = []
+        for y, x in origins:
+            ramps = [overlap if y > 0 else 0,
+                     overlap if y + ty < ny else 0,
+                     overlap if x > 0 else 0,
+                     overlap if x + tx < nx else 0]
+            self.weights.append(feather_weights((ty + P, tx + P), ramps))
+
+        tiles = [initial[y:y + ty + P, x:x + tx + P] for y, x in origins]
+        super(TiledScene, self).__init__(tiles, origins, image_list,
+                shape=(ny, nx), psf_hw=psf_hw, outdir=outdir,
+                outdirs=[outdir] * len(tiles), **kwargs)
+
+    def mosaic(self):
+        """
+        Feather the tile scenes into one scene for the full field.
+
+        ## Returns
+
+        * `scene` (numpy.ndarray): The mosaic.
+        * `psfs` (numpy.ndarray): The latest PSF of each tile.
+
+        """
+        state = self._call("state", [()] * len(self.groups))
+        scene = np.zeros(self.shape)
+        norm = np.zeros(self.shape)
+        for (y, x), w, (s, psf) in zip(self.origins, self.weights, state):
+            scene[y:y + w.shape[0], x:x + w.shape[1]] += w * s
+            norm[y:y + w.shape[0], x:x + w.shape[1]] += w
+        m = norm > 0
+        scene[m] /= norm[m]
+        return scene, np.array([psf for s, psf in state])
+
+    def save(self, fn, pass_number, img_number):
+        _id = "{0:03}-{1:08}".format(pass_number, img_number)
+        scene, psfs = self.mosaic()
+        hdus = [pyfits.PrimaryHDU(scene), pyfits.ImageHDU(self.data),
+                pyfits.ImageHDU(psfs)]
+        hdus[0].header.update("datafn", fn)
+        hdus[0].header.update("size", self.data_shape[0])
+        hdus[0].header.update("size_x", self.data_shape[1])
+        hdus[0].header.update("pass", pass_number)
+        hdus[0].header.update("image", img_number)
+        hdus[0].header.update("tile", self.tile[0])
+        hdus[0].header.update("tile_x", self.tile[1])
+        hdus[0].header.update("ntiles", len(self.origins))
+
+        tmpfn = os.path.join(self.outdir, "." + _id + ".fits.part")
+        pyfits.HDUList(hdus).writeto(tmpfn, clobber=True)
+        os.rename(tmpfn, os.path.join(self.outdir, _id + ".fits"))
+
+    def run_inference(self, **kwargs):
+        """
+        Thresh the data. See `MultiScene.run_inference` for the arguments.
+
+        ## Returns
+
+        * `scene` (numpy.ndarray): The final mosaic.
+
+        """
+        super(TiledScene, self).run_inference(**kwargs)
+        return self.mosaic()[0]
@@ -1,10 +1,13 @@
-__all__ = ["run_tli"]
+__all__ = ["run_tli", "load_frame", "save_tli_product", "load_tli_product"]
 
+import os
 
 import numpy as np
+import pyfits
 from scipy.signal import fftconvolve as convolve
 
 import utils
+import stats
 
 
 def pad_image_and_weight(image, weight, final_shape, offset=None):
@@ -25,9 +28,59 @@ def pad_image_and_weight(image, weight, final_shape, offset=None):
     return final_image, final_weight
 
 
+def load_frame(fn, maskfn=None, invert=False, square=False, hdu=0):
+    """
+    Load a single frame and its weight map and do the TLI sky subtraction.
+
+    ## Arguments
+
+    * `fn` (str): The filename of the image.
+
+    ## Keyword Arguments
+
+    * `maskfn` (str): The filename of the mask/weight image.
+    * `invert` (bool): Should the mask be inverted?
+    * `square` (bool): Should the mask be squared?
+    * `hdu` (int): The HDU number for the data.
+
+    ## Returns
+
+    * `img` (numpy.ndarray): The sky-subtracted image with the masked pixels
+      set to zero.
+    * `weight` (numpy.ndarray): The weight (inverse variance) map.
+    * `sky` (float): The sky level that was subtracted.
+
+    """
+    img = utils.load_image(fn, hdu=hdu)
+
+    if maskfn is not None:
+        weight = utils.load_image(maskfn)
+        if invert:
+            inds = np.isnan(weight) + np.isinf(weight)
+            weight[~inds] = 1.0 / weight[~inds]
+            weight[inds] = 0.0
+        if square:
+            weight *= weight
+    else:
+        weight = np.ones_like(img)
+        weight[np.isnan(img) + np.isinf(img)] = 0.0
+
+    sky = 0.0
+    if np.sum(weight):
+        # This is a sky subtraction hack.
+        sky = stats.median(img[weight > 0])
+        img -= sky
+
+        # Set those same pixels to the median value. This is a hack to
+        # make the centroiding work.
+        img[weight == 0.0] = 0.0
+
+    return img, weight, sky
+
+
 def run_tli(image_list, top=None, top_percent=None, shift=True,
         mask_list=None, invert=False, square=False, scene=None,
-        hdu=0):
+        hdu=0, cache=None, subpixel=False, metrics=None):
     """
     Run traditional lucky imaging on a stream of data.
 
@@ -45,6 +98,17 @@ def run_tli(image_list, top=None, top_percent=None, shift=True,
     * `shift` (bool): Should the images be shifted before co-adding? This
       defaults to `True`.
     * `hdu` (int): The HDU number for the data.
+    * `cache` (dict): A dictionary used to store the decoded, weighted and
+      sky-subtracted frames keyed by filename. If a frame is already in the
+      cache, it isn't re-loaded from disk. Pass the same `dict` to
+      consecutive calls to only pay for the I/O once.
+    * `subpixel` (bool): Register the images to sub-pixel precision. The
+      peak of the correlation is refined using a quadratic fit and the
+      fractional part of the shift is applied in Fourier space. The weights
+      are only shifted by the integer part.
+    * `metrics` (str): The path to a file where the per-frame timings
+      should be written (one JSON record per line). A summary is saved next
+      to it.
 
     ## Returns
 
@@ -69,6 +133,13 @@ def run_tli(image_list, top=None, top_percent=None, shift=True,
 
     s_dim = (np.array(scene.shape) - 1) / 2
 
+    # In sub-pixel mode, we do the correlation by hand so that we can keep
+    # the transforms of the frames around for the shifting. The transform of
+    # the scene is only computed once for each image shape.
+    scene_fts = {}
+    transforms = {}
+    fractions = {}
+
     # Initialized the first time through the data.
     final_shape = None
 
@@ -78,57 +149,75 @@ def run_tli(image_list, top=None, top_percent=None, shift=True,
     ranks = {}
     images = {}
     weights = {}
+    timings = utils.Metrics(metrics)
     for n, fn in enumerate(image_list):
-        img = utils.load_image(fn, hdu=hdu)
-
-        if mask_list is not None:
-            weight = utils.load_image(mask_list[n])
-            if invert:
-                inds = np.isnan(weight) + np.isinf(weight)
-                weight[~inds] = 1.0 / weight[~inds]
-                weight[inds] = 0.0
-            if square:
-                weight *= weight
-        else:
-            weight = np.ones_like(img)
-            weight[np.isnan(img) + np.isinf(img)] = 0.0
+        timings.start_frame(fn=fn)
+        with timings.stage("io"):
+            if cache is not None and fn in cache:
+                img, weight, sky = cache[fn]
+                timings.set("cached", 1)
+            else:
+                maskfn = mask_list[n] if mask_list is not None else None
+                img, weight, sky = load_frame(fn, maskfn=maskfn,
+                        invert=invert, square=square, hdu=hdu)
+                timings.add("bytes_read", os.path.getsize(fn))
+                if cache is not None:
+                    cache[fn] = (img, weight, sky)
 
         # Discard the image if no pixels are included.
-        if np.sum(weight):
-            # This is a sky subtraction hack.
-            img -= np.median(img[weight > 0])
-
-            # Set those same pixels to the median value. This is a hack to
-            # make the centroiding work.
-            img[weight == 0.0] = 0.0
+        if not np.sum(weight):
+            timings.end_frame()
+            continue
 
+        with timings.stage("correlate"):
             # Do the centroiding and find the rank.
-            convolved = convolve(img, scene, mode="valid")
+            if subpixel:
+                fshape = tuple(np.array(img.shape) + scene.shape - 1)
+                if fshape not in scene_fts:
+                    scene_fts[fshape] = np.fft.rfftn(scene, fshape)
+                img_ft = np.fft.rfftn(img, fshape)
+                convolved = np.fft.irfftn(img_ft * scene_fts[fshape], fshape)
+                convolved = convolved[scene.shape[0] - 1:img.shape[0],
+                                      scene.shape[1] - 1:img.shape[1]]
+            else:
+                convolved = convolve(img, scene, mode="valid")
             ind_max = convolved.argmax()
             center = np.unravel_index(ind_max, convolved.shape)
             rank = convolved.flat[ind_max]
 
-            # Because of the "valid" in the convolve, we need to offset
-            # based on the size of the "scene".
-            center = np.array(center) + s_dim
+            if subpixel:
+                center = utils.quadratic_peak(convolved, [center])[0][0]
 
-            offset = (center - 0.5 * np.array(img.shape)).astype(int)
+        # Because of the "valid" in the convolve, we need to offset
+        # based on the size of the "scene".
+        center = np.array(center) + s_dim
 
-            # Keep track of how the largest offset affects the final shape
-            # of the image.
-            shape = np.array(img.shape)
-            if final_shape is None:
-                final_shape = shape
-            if shift:
-                final_shape = np.max(np.vstack(
-                    [final_shape, shape + 2 * np.abs(offset)]), axis=0)
+        offset = center - 0.5 * np.array(img.shape)
+        if subpixel:
+            # Split the offset into an integer part (applied by padding)
+            # and a fractional part (applied in Fourier space).
+            transforms[fn] = (img_ft, fshape)
+            fractions[fn] = offset - np.round(offset)
+            offset = np.round(offset).astype(int)
+        else:
+            offset = offset.astype(int)
 
-            # Save the image, weight and metadata.
-            centers[fn] = center
-            offsets[fn] = offset
-            images[fn] = img
-            weights[fn] = weight
-            ranks[fn] = (n, rank)
+        # Keep track of how the largest offset affects the final shape
+        # of the image.
+        shape = np.array(img.shape)
+        if final_shape is None:
+            final_shape = shape
+        if shift:
+            final_shape = np.max(np.vstack(
+                [final_shape, shape + 2 * np.abs(offset)]), axis=0)
+
+        # Save the image, weight and metadata.
+        centers[fn] = center
+        offsets[fn] = offset
+        images[fn] = img
+        weights[fn] = weight
+        ranks[fn] = (n, rank)
+        timings.end_frame()
 
     # Sort by brightest centroided pixel.
     ranked = sorted(ranks, reverse=True, key=lambda k: ranks[k][1])
@@ -145,16 +234,34 @@ def run_tli(image_list, top=None, top_percent=None, shift=True,
     ordered_ranks = np.array(ordered_ranks)
     ordered_centers = np.array(ordered_centers)
 
+    # Apply the fractional shifts in batches of images with the same shape.
+    if shift and subpixel:
+        with timings.stage("shift"):
+            groups = {}
+            for k in ordered_fns:
+                groups[transforms[k][1]] = \
+                        groups.get(transforms[k][1], []) + [k]
+            for fshape, ks in groups.iteritems():
+                for i in range(0, len(ks), 64):
+                    chunk = ks[i:i + 64]
+                    shifted = utils.fourier_shift(
+                        np.array([transforms[k][0] for k in chunk]), fshape,
+                        -np.array([fractions[k] for k in chunk]))
+                    for k, img in zip(chunk, shifted):
+                        images[k] = img[:images[k].shape[0],
+                                        :images[k].shape[1]]
+
     # Pad the images to the right size.
-    for k in ordered_fns:
-        if shift:
-            offset = offsets[k]
-        else:
-            offset = np.zeros(2)
+    with timings.stage("pad"):
+        for k in ordered_fns:
+            if shift:
+                offset = offsets[k]
+            else:
+                offset = np.zeros(2)
 
-        images[k], weights[k] = \
-                pad_image_and_weight(images[k], weights[k], final_shape,
-                        offset=offset)
+            images[k], weights[k] = \
+                    pad_image_and_weight(images[k], weights[k], final_shape,
+                            offset=offset)
 
     # Figure out the number of images that should be co-added.
     if top is None and top_percent is None:
@@ -170,14 +277,134 @@ def run_tli(image_list, top=None, top_percent=None, shift=True,
     final_weight = np.zeros([len(top)] + list(final_shape))
 
     # Do the co-add.
-    for j, t in enumerate(top):
-        for i, k in enumerate(ordered_fns[:t]):
-            final_image[j] += images[k] * weights[k]
-            final_weight[j] += weights[k]
-
-    m = final_weight > 0
-    final_image[m] /= final_weight[m]
-    final_image[~m] = np.nan
+    with timings.stage("coadd"):
+        for j, t in enumerate(top):
+            for i, k in enumerate(ordered_fns[:t]):
+                final_image[j] += images[k] * weights[k]
+                final_weight[j] += weights[k]
+
+        m = final_weight > 0
+        final_image[m] /= final_weight[m]
+        final_image[~m] = np.nan
+
+    if metrics is not None:
+        timings.report(os.path.splitext(metrics)[0] + "-summary.json")
+        timings.close()
+    else:
+        timings.report()
 
     return ordered_fns, ordered_masks, ordered_ranks, ordered_centers, \
             final_image
+
+
+def save_tli_product(fn, fns, masks, ranks, centers, final, top=None,
+        invert=False, square=False, hdu=0, cli=None):
+    """
+    Save the results of `run_tli`: the full co-add, the co-adds of the top
+    frames and the metadata table. This is the format read by
+    `load_tli_product`.
+
+    ## Arguments
+
+    * `fn` (str): The output FITS file.
+    * `fns`, `masks`, `ranks`, `centers`, `final`: The outputs of
+      `run_tli`.
+
+    ## Keyword Arguments
+
+    * `top` (list): The numbers of frames in the partial co-adds.
+    * `invert`, `square`, `hdu`: How the frames were loaded.
+    * `cli` (str): The command line to record in the header.
+
+    """
+    fns = [os.path.split(f)[-1] for f in fns]
+
+    # Get the maximum file length.
+    length = 0
+    if masks is not None and not np.any([m is None for m in masks]):
+        masks = [os.path.split(f)[-1] for f in masks]
+        length = np.max([len(f) for f in masks])
+    length = np.max([np.max([len(f) for f in fns]), length])
+
+    # Metadata table HDU.
+    col1 = pyfits.Column(name="filename", format="{0:d}A".format(length),
+            array=np.array(fns))
+    col2 = pyfits.Column(name="mask", format="{0:d}A".format(length),
+            array=np.array(masks))
+    col3 = pyfits.Column(name="rank", format="E", array=np.array(ranks))
+    col4 = pyfits.Column(name="x0", format="E", array=centers[:, 0])
+    col5 = pyfits.Column(name="y0", format="E", array=centers[:, 1])
+    cols = pyfits.ColDefs([col1, col2, col3, col4, col5])
+    table_hdu = pyfits.new_table(cols)
+    table_hdu.header.update("invert", invert)
+    table_hdu.header.update("square", square)
+    table_hdu.header.update("hdunum", hdu)
+
+    # Full co-add HDU.
+    image_hdu = pyfits.PrimaryHDU(final[-1])
+    if cli is not None:
+        image_hdu.header.update("cli", cli)
+    hdus = [image_hdu]
+    if top is not None:
+        for i, t in enumerate(top):
+            hdus += [pyfits.ImageHDU(final[i])]
+            hdus[-1].header.update("number", t)
+    hdus += [table_hdu]
+
+    pyfits.HDUList(hdus).writeto(fn, clobber=True)
+
+
+def load_tli_product(fn, scene_hdu=0, table_hdu=None, data_path="."):
+    """
+    Load a co-add and its metadata table as written by `bin/tli`.
+
+    ## Arguments
+
+    * `fn` (str): The FITS file.
+
+    ## Keyword Arguments
+
+    * `scene_hdu` (int): The HDU number of the co-add.
+    * `table_hdu` (int): The HDU number of the metadata table. Defaults to
+      the HDU after the co-add.
+    * `data_path` (str): The basepath for the data files in the table.
+
+    ## Returns
+
+    * `scene` (numpy.ndarray): The co-add.
+    * `meta` (dict): The `image_list`, `mask_list`, `ranks` and `centers`
+      of the frames (`None` if the table doesn't have them) and the `hdu`,
+      `invert` and `square` settings used to load them.
+
+    """
+    if table_hdu is None:
+        table_hdu = scene_hdu + 1
+
+    meta = dict(image_list=None, mask_list=None, ranks=None, centers=None,
+                hdu=0, invert=False, square=False)
+    with pyfits.open(fn) as hdus:
+        scene = np.array(hdus[scene_hdu].data, dtype=float)
+        try:
+            table = hdus[table_hdu].data
+            meta["hdu"] = hdus[table_hdu].header.get("hdunum", 0)
+            meta["invert"] = hdus[table_hdu].header.get("invert", False)
+            meta["square"] = hdus[table_hdu].header.get("square", False)
+        except IndexError:
+            table = None
+
+        if table is not None:
+            try:
+                meta["image_list"] = [os.path.join(data_path, f)
+                                      for f in table["filename"]]
+                meta["ranks"] = np.array(table["rank"])
+                meta["centers"] = np.vstack([table["x0"],
+                                             table["y0"]]).T.astype(int)
+                meta["mask_list"] = [os.path.join(data_path, f)
+                                     for f in table["mask"]]
+            except KeyError:
+                pass
+            if meta["mask_list"] is not None and \
+                    np.any([m == "None" for m in table["mask"]]):
+                meta["mask_list"] = None
+
+    return scene, meta
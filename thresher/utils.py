@@ -1,8 +1,13 @@
-__all__ = ["load_image", "trim_image", "centroid_image", "unravel_scene",
-            "unravel_psf", "timer"]
+__all__ = ["load_image", "image_shape", "trim_image", "centroid_image",
+           "quadratic_peak", "fourier_shift", "unravel_scene", "unravel_psf",
+           "timer", "Metrics"]
 
+import os
+import json
 import time
 import logging
+from contextlib import contextmanager
+from collections import OrderedDict
 
 import numpy as np
 from scipy.signal import fftconvolve as convolve
@@ -24,22 +29,37 @@ def load_image(fn, hdu=0, dtype=float):
     return data
 
 
+def image_shape(size):
+    """
+    The shape `(ny, nx)` corresponding to a size that is either an integer
+    (for a square image) or a pair.
+
+    """
+    if np.isscalar(size):
+        return (int(size), int(size))
+    ny, nx = size
+    return (int(ny), int(nx))
+
+
 def trim_image(image, size):
     """
-    Trim an image to be square with shape `(size, size)`.
+    Trim an image about its center to have shape `(size, size)` or, if
+    `size` is a pair, `(ny, nx)`.
 
     """
     shape = np.array(image.shape)
+    size = np.array(image_shape(size))
     assert np.all(shape >= size), \
             "You can't 'trim' an image to be larger than it was!"
-    mn = (0.5 * (shape - np.array([size, size]))).astype(int)
-    return image[mn[0]:mn[0] + size, mn[1]:mn[1] + size]
+    mn = (0.5 * (shape - size)).astype(int)
+    return image[mn[0]:mn[0] + size[0], mn[1]:mn[1] + size[1]]
 
 
 def centroid_image(image, size, scene=None, coords=None, mask=None):
     """
     Centroid an image based on the current scene by projecting and
-    convolving.
+    convolving. The output has shape `(size, size)` or, if `size` is a
+    pair, `(ny, nx)`.
 
     """
     if coords is None:
@@ -60,6 +80,8 @@ def centroid_image(image, size, scene=None, coords=None, mask=None):
         center = np.array(coords)
 
     center = center.astype(int)
+    shape = image_shape(size)
+    size = np.array(shape)
 
     # Deal with the edges of the images.
     mn = np.floor(center - 0.5 * size).astype(int)
@@ -69,24 +91,115 @@ def centroid_image(image, size, scene=None, coords=None, mask=None):
 
     mx = np.floor(center + 0.5 * size).astype(int)
     m = mx > np.array(image.shape)
-    mx_r = size * np.ones_like(center)
+    mx_r = np.array(size, dtype=center.dtype)
     mx_r[m] -= mx[m] - np.array(image.shape)[m]
     mx[m] = np.array(image.shape)[m]
 
     # Build the mask for the output.
-    final_mask = np.zeros((size, size))
+    final_mask = np.zeros(shape)
     final_mask[mn_r[0]:mx_r[0], mn_r[1]:mx_r[1]] = 1.0
     if mask is not None:
         final_mask[mn_r[0]:mx_r[0], mn_r[1]:mx_r[1]] *= \
                 mask[mn[0]:mx[0], mn[1]:mx[1]]
 
     # Build the result.
-    result = np.zeros((size, size))
+    result = np.zeros(shape)
     result[mn_r[0]:mx_r[0], mn_r[1]:mx_r[1]] = image[mn[0]:mx[0], mn[1]:mx[1]]
 
     return center, result, final_mask.astype(float)
 
 
+# The design matrix for the 2nd order fit used by `quadratic_peak`. The
+# zeroth column of the 3x3 patch offsets is `_QY` and the first is `_QX`.
+_QX, _QY = np.meshgrid(range(-1, 2), range(-1, 2))
+_QX, _QY = _QX.flatten(), _QY.flatten()
+_QA = np.vstack([np.ones(9), _QX, _QY, _QX * _QX, _QX * _QY, _QY * _QY]).T
+_QATAinvA = np.dot(np.linalg.inv(np.dot(_QA.T, _QA)), _QA.T)
+
+
+def quadratic_peak(img, coords):
+    """
+    Refine the positions of a set of peaks in an image by fitting a 2nd
+    order polynomial to the 3x3 patch around each of them. All the peaks are
+    fit at once.
+
+    ## Arguments
+
+    * `img` (numpy.ndarray): The image.
+    * `coords` (numpy.ndarray): The integer positions of the peaks with two
+      columns for the zeroth and first dimensions of `img` respectively.
+
+    ## Returns
+
+    * `centers` (numpy.ndarray): The refined positions. These are just the
+      input positions for the peaks that couldn't be refined.
+    * `good` (numpy.ndarray): A boolean array indicating which peaks were
+      successfully refined (the fit has a maximum within one pixel of the
+      input position).
+
+    """
+    coords = np.atleast_2d(coords).astype(int)
+    x0, y0 = coords[:, 0], coords[:, 1]
+
+    # Peaks on the edge of the image can't be refined.
+    shape = img.shape
+    good = (x0 >= 1) * (x0 < shape[0] - 1) * (y0 >= 1) * (y0 < shape[1] - 1)
+    xi = np.clip(x0, 1, shape[0] - 2)
+    yi = np.clip(y0, 1, shape[1] - 2)
+
+    # Extract all the patches and do the fits.
+    patches = img[xi[:, None] + _QY[None, :], yi[:, None] + _QX[None, :]]
+    a, b, c, d, e, f = np.dot(patches, _QATAinvA.T).T
+
+    # Solve for the stationary point of each quadratic. This is only a
+    # maximum if the Hessian is negative definite.
+    det = e * e - 4 * d * f
+    det[det == 0] = np.inf
+    dy = (2 * d * c - e * b) / det
+    dx = (2 * f * b - e * c) / det
+
+    good *= np.isfinite(dx) * np.isfinite(dy) * (np.abs(dx) < 1) \
+            * (np.abs(dy) < 1) * (det < 0) * (d < 0) * (f < 0)
+    centers = np.array(coords, dtype=float)
+    centers[good, 0] += dy[good]
+    centers[good, 1] += dx[good]
+
+    return centers, good
+
+
+def fourier_shift(ft, shape, offsets):
+    """
+    Shift a stack of images by applying phase ramps to their Fourier
+    transforms.
+
+    ## Arguments
+
+    * `ft` (numpy.ndarray): The transforms (as computed by
+      `numpy.fft.rfftn` over the last two axes) with shape
+      `(N, shape[0], shape[1] // 2 + 1)`.
+    * `shape` (tuple): The shape of the real-space images.
+    * `offsets` (numpy.ndarray): The `(N, 2)` shifts to apply (in pixels).
+      A positive offset moves the flux towards larger indices.
+
+    ## Returns
+
+    * `shifted` (numpy.ndarray): The shifted images in real space with
+      shape `(N, shape[0], shape[1])`.
+
+    """
+    offsets = np.atleast_2d(offsets)
+    k0 = np.fft.fftfreq(shape[0])
+    k1 = np.fft.rfftfreq(shape[1])
+
+    # The ramps are separable so we only need to build two 1D arrays per
+    # image.
+    r0 = np.exp(-2j * np.pi * k0[None, :] * offsets[:, 0][:, None])
+    r1 = np.exp(-2j * np.pi * k1[None, :] * offsets[:, 1][:, None])
+    ft = ft * r0[:, :, None] * r1[:, None, :]
+
+    return np.fft.irfftn(ft, s=shape, axes=(-2, -1))
+
+
 #
 # Index gymnastics
 #
@@ -104,60 +217,96 @@ def index2xy(shape, i):
     return ((i / shape[1]), (i % shape[1]))
 
 
+def _memoize_geometry(f, maxsize=16):
+    """
+    Cache the index arrays for each scene shape and PSF size. The cached
+    arrays are read-only and shared by all the scenes with the same
+    geometry (and, after a fork, by the child processes). Only the
+    `maxsize` most recently used geometries are kept.
+
+    The decorated function has a `cache_clear` method and the original
+    function is available as `__wrapped__`.
+
+    """
+    cache = OrderedDict()
+
+    def _func(S, P):
+        key = (image_shape(S), int(P))
+        try:
+            result = cache.pop(key)
+        except KeyError:
+            result = f(*key)
+            for r in result if isinstance(result, tuple) else [result]:
+                r.setflags(write=False)
+            if len(cache) >= maxsize:
+                cache.popitem(last=False)
+        cache[key] = result
+        return result
+
+    _func.__name__ = f.__name__
+    _func.__doc__ = f.__doc__
+    _func.__wrapped__ = f
+    _func.cache = cache
+    _func.cache_clear = cache.clear
+    return _func
+
+
+@_memoize_geometry
 def unravel_scene(S, P):
     """
     Unravel the scene object to prepare for the least squares problem.
 
     ## Arguments
 
-    * `scene` (numpy.ndarray): The 2-D scene object.
+    * `S` (int or tuple): The size (or shape `(ny, nx)`) of the scene.
     * `P` (int): The half-width of the PSF object.
 
+    ## Returns
+
+    * `result` (numpy.ndarray): For each pixel in the valid data region,
+      the indices of the scene pixels under the PSF.
+
     """
     # Work out all the dimensions first.
-    D = S - 2 * P
-
-    psf_shape = 2 * P + 1
-    psf_size = psf_shape ** 2
+    scene_shape = image_shape(S)
+    data_shape = (scene_shape[0] - 2 * P, scene_shape[1] - 2 * P)
+    data_size = data_shape[0] * data_shape[1]
+    psf_size = (2 * P + 1) ** 2
 
-    data_shape = (D, D)
-    data_size = D ** 2
+    # The offsets of the PSF pixels and the corners of their footprints.
+    psfX, psfY = index2xy((2 * P + 1,) * 2, np.arange(psf_size))
+    dx, dy = index2xy(data_shape, np.arange(data_size))
 
-    # The layout of the scene.
-    scene = np.arange(S ** 2).reshape((S, S))
+    return xy2index(scene_shape, dx[:, None] + psfX[None, :],
+                    dy[:, None] + psfY[None, :])
 
-    # Build the output array.
-    result = np.empty((data_size, psf_size), dtype=int)
 
-    # Loop over the valid data region.
-    for k in xrange(data_size):
-        dx, dy = index2xy(data_shape, k)
-        grid = np.meshgrid(dy + np.arange(psf_shape),
-                           dx + np.arange(psf_shape))[::-1]
-        result[k, :] = scene[grid].flatten()
+@_memoize_geometry
+def unravel_psf(S, P):
+    """
+    The row and column indices of the non-zero elements of the sparse PSF
+    matrix.
 
-    return result
+    ## Arguments
 
+    * `S` (int or tuple): The size (or shape `(ny, nx)`) of the scene.
+    * `P` (int): The half-width of the PSF object.
 
-def unravel_psf(S, P):
-    D = S - 2 * P
-    data_size = D ** 2
+    """
+    scene_shape = image_shape(S)
+    data_shape = (scene_shape[0] - 2 * P, scene_shape[1] - 2 * P)
+    data_size = data_shape[0] * data_shape[1]
     psf_size = (2 * P + 1) ** 2
 
-    psfX, psfY = index2xy((2 * P + 1,) * 2, np.arange(psf_size))
-
-    rows = np.zeros(data_size * psf_size, dtype=int)
-    cols = np.zeros_like(rows)
-
-    for k in range(data_size):
-        dx, dy = index2xy((D, D), k)
-        s = slice(k * psf_size, (k + 1) * psf_size)
-        rows[s] = k
-        cols[s] = xy2index((S, S), psfX + dx, psfY + dy)
+    rows = np.repeat(np.arange(data_size), psf_size)
+    cols = unravel_scene(scene_shape, P).flatten()
 
     return rows, cols
 
 
+#
+# Profiling
+#
 def timer(f, lf=None):
     """
     A decorator used for some simple profiling.
@@ -175,3 +324,173 @@ def timer(f, lf=None):
         return r
 
     return _func
+
+
+def peak_memory():
+    """
+    The peak resident set size of the process in kilobytes (or `None` if
+    it isn't available on this platform).
+
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Metrics(object):
+    """
+    A low overhead recorder for per-frame timings and counters. The time
+    spent in each named stage and any counters are accumulated for the
+    current frame and written as a line of JSON when the frame is finished.
+    Anything recorded outside of a frame is accumulated in `totals`.
+
+    ## Keyword Arguments
+
+    * `fn` (str): The path to the JSON-lines output file. If this isn't
+      given, the records are only kept for the summary.
+
+    """
+    def __init__(self, fn=None):
+        self.fn = None
+        self._f = None
+        self.history = {}
+        self.totals = {}
+        self.current = self.totals
+        self._meta = []
+        self._start = None
+        self.nframes = 0
+        self.t0 = time.time()
+        if fn is not None:
+            self.open(fn)
+
+    def open(self, fn):
+        """
+        Start writing the frame records to a file.
+
+        """
+        self.close()
+        self.fn = fn
+        self._f = open(fn, "a")
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+    @contextmanager
+    def stage(self, name):
+        """
+        A context manager that adds the time spent in its body to the stage
+        `name` of the current frame.
+
+        """
+        t = time.time()
+        try:
+            yield
+        finally:
+            self.current[name] = self.current.get(name, 0.0) \
+                    + time.time() - t
+
+    def add(self, name, value):
+        """
+        Add `value` to the counter `name` for the current frame.
+
+        """
+        self.current[name] = self.current.get(name, 0) + value
+
+    def set(self, name, value):
+        """
+        Set the value `name` for the current frame.
+
+        """
+        self.current[name] = value
+
+    def start_frame(self, **meta):
+        """
+        Start recording a new frame. Any keyword arguments are included in
+        the record.
+
+        """
+        self.current = dict(meta)
+        self._meta = meta.keys()
+        self._start = time.time()
+
+    def discard_frame(self):
+        """
+        Drop the current frame without writing a record (e.g. when the frame
+        couldn't be loaded).
+
+        """
+        self.current = self.totals
+        self._start = None
+
+    def end_frame(self):
+        """
+        Finish the current frame and write its record.
+
+        """
+        rec = self.current
+        rec["total"] = time.time() - self._start
+        rec["time"] = time.time() - self.t0
+        rec["peak_rss_kb"] = peak_memory()
+        self.nframes += 1
+        for k, v in rec.iteritems():
+            if k not in self._meta and isinstance(v, (int, long, float)) \
+                    and not isinstance(v, bool):
+                self.history.setdefault(k, []).append(v)
+        if self._f is not None:
+            self._f.write(json.dumps(rec) + "\n")
+            self._f.flush()
+        self.current = self.totals
+        self._start = None
+        return rec
+
+    def summary(self, percentiles=[50, 90, 99]):
+        """
+        Summarize the recorded frames.
+
+        ## Returns
+
+        * `summary` (dict): The number of frames, the frame throughput, the
+          totals recorded outside of the frames and, for each stage or
+          counter, the total and the given percentiles over the frames.
+
+        """
+        dt = time.time() - self.t0
+        result = dict(nframes=self.nframes, elapsed=dt,
+                      frames_per_second=self.nframes / dt if dt > 0 else 0.0,
+                      peak_rss_kb=peak_memory(), stages={},
+                      totals=dict(self.totals))
+        for k, v in self.history.iteritems():
+            if k in ["time", "peak_rss_kb"]:
+                continue
+            v = np.array(v, dtype=float)
+            stats = dict(total=float(np.sum(v)), mean=float(np.mean(v)))
+            for q, p in zip(percentiles, np.percentile(v, percentiles)):
+                stats["p{0}".format(q)] = float(p)
+            result["stages"][k] = stats
+        return result
+
+    def report(self, fn=None):
+        """
+        Log a summary table and optionally save the summary as JSON.
+
+        """
+        s = self.summary()
+        logging.info("{0} frames in {1:.2f} seconds ({2:.3f} frames/s), "
+                     "peak memory {3} kB".format(s["nframes"], s["elapsed"],
+                     s["frames_per_second"], s["peak_rss_kb"]))
+        for k in sorted(s["stages"]):
+            v = s["stages"][k]
+            logging.info("{0:>16s}: total {1:10.4f}  p50 {2:10.4g}  "
+                         "p90 {3:10.4g}  p99 {4:10.4g}".format(k, v["total"],
+                         v["p50"], v["p90"], v["p99"]))
+        for k in sorted(s["totals"]):
+            logging.info("{0:>16s}: total {1:10.4f}".format(k,
+                         s["totals"][k]))
+        if fn is not None:
+            with open(fn, "w") as f:
+                json.dump(s, f, indent=2)
+        return s